@@ -5,11 +5,12 @@
 
 import os
 import base64
-import requests
+from utils import cascade, context_cache, file_handles, http_client, metrics, multigrade, payload, ratelimit, retry, rubrics, scoring, uploads
 import json
 import logging
 import sys
 
+
 # Configure logging to output to STDOUT
 logging.basicConfig(
     level=logging.INFO,
@@ -26,14 +27,23 @@ GROK_KEY = os.environ.get("GROK_API_KEY")
 if not GROK_KEY:
     raise RuntimeError("GROK_API_KEY not set")
 
-# Load prompt.txt
-with open("prompt.txt", "r", encoding="utf-8") as f:
-    txt = f.read().strip()
+# Rubrics (prompt.txt and rubrics/*.txt) come from the shared registry.
+# RUBRIC_TEXT / PROMPT_TEMPLATE are the default rubric as of startup.
+DEFAULT_RUBRIC = rubrics.registry.get()
+RUBRIC_TEXT, PROMPT_TEMPLATE = DEFAULT_RUBRIC.text, DEFAULT_RUBRIC.prompt
+
+MODEL = "gemini-2.5-flash"
+FAST_MODEL = os.environ.get("GEMINI_FAST_MODEL", "gemini-2.5-flash-lite")   # cascade first tier
+COMPARE_PROMPT = "Are these two photos of the same hand-drawn sketch, with nothing added, removed or changed? Differences in angle, lighting, crop or photo quality don't count. Answer with JSON {\"same\": true} or {\"same\": false}."
+# Point at tools/fake_provider.py for load tests
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
 
-parts = txt.split("\n=== PROMPT ===\n", 1)
-if len(parts) != 2:
-    raise RuntimeError("prompt.txt must contain '=== PROMPT ===' separator")
-RUBRIC_TEXT, PROMPT_TEMPLATE = parts[0].strip(), parts[1].strip()
+# Shared across gunicorn workers; 0 = no client-side limit
+LIMITER = ratelimit.RateLimiter(
+    "gemini",
+    rpm=int(os.environ.get("GEMINI_RPM", "0")),
+    tpm=int(os.environ.get("GEMINI_TPM", "0")),
+)
 
 logging.info("=== PROMPT SENT ===")
 logging.info(PROMPT_TEMPLATE)
@@ -95,41 +105,342 @@ logging.info("=== END PROMPT ===")
 #         logging.error(error)
 #         return {"success": False, "details": error}
 
-def analyze_image(image_path: str):
-    with open(image_path, "rb") as f:
-        encoded = base64.b64encode(f.read()).decode("utf-8")
-    
-    ext = os.path.splitext(image_path)[1].lower()
-    mime = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}.get(
-        ext.lstrip("."), "application/octet-stream"
-    )
+def structured_output(rubric, fields=None):
+    # Constrain the reply to JSON with an integer per rubric category
+    # (see utils/scoring.py). Rubrics without "(N%)" lines are sent as before.
+    if not (scoring.STRUCTURED_OUTPUT and rubric.categories):
+        return {}
+    return {
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": scoring.gemini_schema(rubric.categories, fields),
+        }
+    }
+
+def build_body(rubric):
+    # Gemini request body for one rubric. The registry serializes it once;
+    # each call only splices in the image.
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {"text": rubric.prompt},
+                    {"inline_data": {"mime_type": payload.MIME, "data": payload.IMAGE}}
+                ]
+            }
+        ],
+        **structured_output(rubric),
+    }
 
-    payload = {
+def build_fast_body(rubric):
+    # The cascade's first tier (utils/cascade.py): also asks for a confidence per category
+    body = {
         "contents": [
             {
                 "parts": [
-                    {"text": PROMPT_TEMPLATE},
-                    {"inline_data": {"mime_type": mime, "data": encoded}}
+                    {"text": cascade.prompt(rubric)},
+                    {"inline_data": {"mime_type": payload.MIME, "data": payload.IMAGE}}
                 ]
             }
+        ],
+    }
+    if scoring.STRUCTURED_OUTPUT and rubric.categories:
+        body["generationConfig"] = {"responseMimeType": "application/json",
+                                    "responseSchema": cascade.gemini_schema(rubric.categories)}
+    return body
+
+def tier(fast):
+    # (model, template name, body builder) for the full or the fast tier
+    return (FAST_MODEL, "gemini-fast", build_fast_body) if fast else (MODEL, "gemini", build_body)
+
+def build_cached_body(rubric, handle):
+    # build_body with the prompt replaced by its cached-content handle (utils/context_cache.py)
+    return {
+        "cachedContent": handle,
+        "contents": [
+            {
+                "role": "user",
+                "parts": [
+                    {"inline_data": {"mime_type": payload.MIME, "data": payload.IMAGE}}
+                ]
+            }
+        ],
+        **structured_output(rubric),
+    }
+
+def with_file(body, file):
+    # A request body with the photo's inline_data replaced by an uploaded file (utils/file_handles.py)
+    for content in body["contents"]:
+        content["parts"] = [
+            {"file_data": {"mime_type": file["mime"], "file_uri": file["uri"]}} if "inline_data" in part else part
+            for part in content["parts"]
         ]
+    return body
+
+def grade_request(image, mime, rubric, fast=False, handle=None, stream=False, file=None):
+    # (url, body) of a grading call. With a cached-content handle the body
+    # names the handle instead of carrying the prompt, and with an uploaded
+    # file it names the file instead of carrying the photo (v1beta features).
+    model, name, build = tier(fast)
+    version = "v1"
+    if handle is not None:
+        name, build, version = f"gemini-cached {handle}", lambda r: build_cached_body(r, handle), "v1beta"
+    with metrics.stage("encode"):
+        if file is None:
+            body = rubric.template(name, build).render(mime, image)
+        else:
+            # No photo to splice in: a small body, built per call
+            body = json.dumps(with_file(build(rubric), file), ensure_ascii=False).encode("utf-8")
+            version = "v1beta"
+    method = "streamGenerateContent?alt=sse&" if stream else "generateContent?"
+    return f"{GEMINI_BASE_URL}/{version}/models/{model}:{method}key={GEMINI_KEY}", body
+
+def post_grade(image, mime, rubric, fast=False, stream=False):
+    # Send a grading call -> retry.post's (resp, error). The prompt and the
+    # photo go by handle when there is one; a call whose handle is gone is
+    # sent again with that part inline.
+    handle = None if fast else PROMPT_CACHE.handle(rubric, MODEL)
+    file = FILES.get(image, mime)
+    while True:
+        url, body = grade_request(image, mime, rubric, fast, handle, stream, file)
+        resp, error = retry.post(
+            url, LIMITER, rubric.tokens, provider="Gemini",
+            data=body, headers={"Content-Type": "application/json"}, stream=stream,
+        )
+        if error and PROMPT_CACHE.gone(error, handle, rubric, MODEL):
+            handle = None
+        elif error and FILES.gone(error, file):
+            file = None
+        else:
+            return resp, error
+
+async def apost_grade(image, mime, rubric, fast=False, stream=False):
+    # post_grade for the ASGI app
+    handle = None if fast else await PROMPT_CACHE.handle_async(rubric, MODEL)
+    file = await FILES.get_async(image, mime)
+    while True:
+        url, body = grade_request(image, mime, rubric, fast, handle, stream, file)
+        resp, error = await retry.apost(
+            url, LIMITER, rubric.tokens, provider="Gemini",
+            data=body, headers={"Content-Type": "application/json"}, stream=stream,
+        )
+        if error and PROMPT_CACHE.gone(error, handle, rubric, MODEL):
+            handle = None
+        elif error and FILES.gone(error, file):
+            file = None
+        else:
+            return resp, error
+
+def create_cached_prompt(rubric, model, ttl):
+    # A cachedContents handle holding the rubric prompt for `model`, or None
+    url = f"{GEMINI_BASE_URL}/v1beta/cachedContents?key={GEMINI_KEY}"
+    body = {
+        "model": f"models/{model}",
+        "displayName": f"aigrademe {rubric.id} {rubric.version}",
+        "contents": [{"role": "user", "parts": [{"text": rubric.prompt}]}],
+        "ttl": f"{ttl}s",
     }
+    try:
+        resp = http_client.post(url, json=body)
+        if resp.status_code == 200:
+            return resp.json()["name"]
+        logging.warning("Gemini: could not cache the %s prompt: %s %s", rubric.id, resp.status_code, resp.text[:200])
+    except Exception as e:
+        logging.warning("Gemini: could not cache the %s prompt: %s: %s", rubric.id, type(e).__name__, e)
+    return None
 
-    url = f"https://generativelanguage.googleapis.com/v1/models/gemini-2.5-flash:generateContent?key={GEMINI_KEY}"
-    
+def refresh_cached_prompt(handle, ttl):
+    # Extend a cachedContents handle by ttl seconds. True if it worked.
+    url = f"{GEMINI_BASE_URL}/v1beta/{handle}?updateMask=ttl&key={GEMINI_KEY}"
     try:
-        resp = requests.post(url, json=payload, timeout=30)
-        if resp.status_code != 200:
-            return {"ai_error": "AI model may be overloaded. Please try again later."}
-    except:
-            return {"ai_error": "AI model may be overloaded. Please try again later."}
+        resp = http_client.request("PATCH", url, json={"ttl": f"{ttl}s"})
+        if resp.status_code == 200:
+            return True
+        logging.warning("Gemini: could not extend %s: %s %s", handle, resp.status_code, resp.text[:200])
+    except Exception as e:
+        logging.warning("Gemini: could not extend %s: %s: %s", handle, type(e).__name__, e)
+    return False
+
+PROMPT_CACHE = context_cache.ContextCache(create_cached_prompt, refresh_cached_prompt)
+
+def upload_file(image, mime):
+    # Gemini Files API (resumable protocol, in one piece) -> {"name", "uri", "mime"} or None
+    start = http_client.post(
+        f"{GEMINI_BASE_URL}/upload/v1beta/files?key={GEMINI_KEY}",
+        json={"file": {"display_name": "aigrademe sketch"}},
+        headers={
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(image)),
+            "X-Goog-Upload-Header-Content-Type": mime,
+        },
+    )
+    upload_url = start.headers.get("X-Goog-Upload-URL")
+    if start.status_code != 200 or not upload_url:
+        logging.warning("Gemini: file upload refused: %s %s", start.status_code, start.text[:200])
+        return None
+    resp = http_client.post(
+        upload_url, data=bytes(image),
+        headers={"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+    )
+    if resp.status_code != 200:
+        logging.warning("Gemini: file upload failed: %s %s", resp.status_code, resp.text[:200])
+        return None
+    file = resp.json().get("file") or {}
+    if file.get("state", "ACTIVE") != "ACTIVE" or not file.get("uri"):
+        return None
+    return {"name": file["name"], "uri": file["uri"], "mime": file.get("mimeType") or mime}
+
+FILES = file_handles.FileHandles(upload_file)
+
+def count_cached_tokens(result):
+    # Prompt tokens Gemini read from the handle instead of the request, for /metrics
+    cached = (result.get("usageMetadata") or {}).get("cachedContentTokenCount")
+    if cached:
+        metrics.inc("aigrademe_context_cache_tokens_total", value=cached)
+    return result
+
+def analyze_image(image_path: str):
+    with open(image_path, "rb") as f:
+        image = f.read()
+    return analyze_bytes(image, uploads.sniff(image[:16]) or payload.mime_for(image_path))
+
+def analyze_bytes(image, mime: str, rubric=None, fast=False):
+    # image: the raw upload (bytes or memoryview), no temp file needed
+    # fast: grade with FAST_MODEL, the cascade's first tier
+    rubric = rubric or rubrics.registry.get()
+    resp, error = post_grade(image, mime, rubric, fast)
+    if error:
+        return error
         
+    try:
+        return count_cached_tokens(resp.json())
+    except ValueError:
+        return retry.error("bad_response")
+
+def stream_bytes(image, mime: str, rubric=None):
+    # Like analyze_bytes, but yields the reply text as it is generated
+    # (streamGenerateContent over SSE). A failure is yielded as an error dict.
+    rubric = rubric or rubrics.registry.get()
+    resp, error = post_grade(image, mime, rubric, stream=True)
+    if error:
+        yield error
+        return
+    try:
+        for data in http_client.sse_events(resp):
+            try:
+                parts = json.loads(data)["candidates"][0]["content"]["parts"]
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue   # e.g. a final chunk with only usage metadata
+            text = "".join(part.get("text", "") for part in parts)
+            if text:
+                yield text
+    except Exception as e:
+        logging.error("Gemini stream broke off: %s: %s", type(e).__name__, e)
+        yield retry.error("connection", f"{type(e).__name__}: {e}")
+    finally:
+        resp.close()
+
+async def analyze_bytes_async(image, mime: str, rubric=None, fast=False):
+    # analyze_bytes for the ASGI app: waits on the network without a thread
+    rubric = rubric or rubrics.registry.get()
+    resp, error = await apost_grade(image, mime, rubric, fast)
+    if error:
+        return error
+    try:
+        return count_cached_tokens(resp.json())
+    except ValueError:
+        return retry.error("bad_response")
+
+def analyze_fast(image, mime: str, rubric=None):
+    return analyze_bytes(image, mime, rubric, fast=True)
+
+async def analyze_fast_async(image, mime: str, rubric=None):
+    return await analyze_bytes_async(image, mime, rubric, fast=True)
+
+async def stream_bytes_async(image, mime: str, rubric=None):
+    # stream_bytes for the ASGI app (async generator)
+    rubric = rubric or rubrics.registry.get()
+    resp, error = await apost_grade(image, mime, rubric, stream=True)
+    if error:
+        yield error
+        return
+    try:
+        async for data in http_client.asse_events(resp):
+            try:
+                parts = json.loads(data)["candidates"][0]["content"]["parts"]
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+            text = "".join(part.get("text", "") for part in parts)
+            if text:
+                yield text
+    except Exception as e:
+        logging.error("Gemini stream broke off: %s: %s", type(e).__name__, e)
+        yield retry.error("connection", f"{type(e).__name__}: {e}")
+    finally:
+        await resp.aclose()
+
+def compare_images(jpeg_a, jpeg_b):
+    # Confirm-only near-duplicate check on two small thumbnails (utils/phash.py)
+    body = {
+        "contents": [{"parts": [
+            {"text": COMPARE_PROMPT},
+            {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(jpeg_a).decode("ascii")}},
+            {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(jpeg_b).decode("ascii")}},
+        ]}],
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": {"type": "OBJECT", "properties": {"same": {"type": "BOOLEAN"}}, "required": ["same"]},
+        },
+    }
+    url = f"{GEMINI_BASE_URL}/v1/models/{MODEL}:generateContent?key={GEMINI_KEY}"
+    resp, error = retry.post(url, LIMITER, 2 * 258 + 100, provider="Gemini",
+                             json=body, headers={"Content-Type": "application/json"})
+    if error:
+        return error
+    try:
+        return {"same": json.loads(resp.json()["candidates"][0]["content"]["parts"][0]["text"])["same"] is True}
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+
+def analyze_many(items, rubric):
+    # Several photos in one call (utils/multigrade.py): the prompt is sent
+    # once, each photo after an "Image N:" label. Returns one result per
+    # photo, None where the reply skipped it, or one error dict for all.
+    parts = [{"text": multigrade.prompt(rubric, len(items))}]
+    with metrics.stage("encode"):
+        for number, (image, mime) in enumerate(items, 1):
+            parts.append({"text": f"Image {number}:"})
+            parts.append({"inline_data": {"mime_type": mime, "data": base64.b64encode(image).decode("ascii")}})
+    body = {"contents": [{"parts": parts}]}
+    if scoring.STRUCTURED_OUTPUT and rubric.categories:
+        body["generationConfig"] = {"responseMimeType": "application/json",
+                                    "responseSchema": multigrade.gemini_schema(rubric.categories)}
+    url = f"{GEMINI_BASE_URL}/v1/models/{MODEL}:generateContent?key={GEMINI_KEY}"
+    resp, error = retry.post(url, LIMITER, multigrade.tokens(rubric, len(items)), provider="Gemini",
+                             json=body, headers={"Content-Type": "application/json"})
+    if error:
+        return error
+    try:
+        text = resp.json()["candidates"][0]["content"]["parts"][0]["text"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+    return [reply and multigrade.as_result(reply) for reply in multigrade.split(text, len(items))]
+
+def complete_text(prompt: str, rubric, fields=None):
+    # Small text-only call (no image), e.g. to repair one field of a reply
+    body = {"contents": [{"parts": [{"text": prompt}]}], **structured_output(rubric, fields)}
+    url = f"{GEMINI_BASE_URL}/v1/models/{MODEL}:generateContent?key={GEMINI_KEY}"
+    resp, error = retry.post(
+        url, LIMITER, len(prompt) // 4 + ratelimit.REPLY_TOKENS, provider="Gemini",
+        json=body, headers={"Content-Type": "application/json"},
+    )
+    if error:
+        return error
     try:
         return resp.json()
-    except:
-        return {"ai_error": "AI response error. Please try again later."}
-    
-    # return resp.json()
+    except ValueError:
+        return retry.error("bad_response")
 
-def get_rubric() -> str:
-    return RUBRIC_TEXT
+def get_rubric(rubric_id=None) -> str:
+    return rubrics.registry.get(rubric_id).text
@@ -4,15 +4,19 @@
 # Description: 
 # Flask backend for grading hand-drawn floor plan sketches.
 
-from flask import Flask, request, jsonify
-from utils import gemini, grade
+from flask import Flask, request, jsonify, g
+from utils import gemini, grade, metrics, logs
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import tempfile
+import logging
+import time
 import os
 
 app = Flask(__name__)
 CORS(app)
+logs.setup()
+metrics.init_app(app)
 
 @app.route("/submit", methods=["POST"])
 def submit():
@@ -23,9 +27,10 @@ def submit():
     image = request.files.get("image")
 
     if image:
+        metrics.record_stage("upload", time.perf_counter() - g.metrics_start)
         # Save the uploaded image to a temporary file
         filename = secure_filename(image.filename)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp:
+        with metrics.stage("tempfile"), tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp:
             temp_path = tmp.name
             image.save(temp_path)
 
@@ -57,7 +62,7 @@ def submit():
                    .get("parts", [{}])[0]
                    .get("text", None)
         )
-        print("\n=== RAW GEMINI RESPONSE ===\n", raw_feedback, "\n===========================\n")
+        logs.event("ai_reply", logging.DEBUG, chars=len(raw_feedback or ""), reply=(raw_feedback or "")[:500])
     except:
         raw_feedback = None
 
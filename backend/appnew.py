@@ -4,149 +4,741 @@
 # Description:  
 # Backend for grading submitted images.
 
-from flask import Flask, request
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
-from aichecknew import analyze_image, get_rubric
+from werkzeug.exceptions import RequestEntityTooLarge
+from aichecknew import get_rubric
+from utils import jobs, http_client, cache, payload, images, router, batch, rubrics, scoring, metrics, logs, phash, uploads, multigrade, cascade, admission, submissions, analytics, resumable
+import aichecknew
+import gemininew
 import os
-import tempfile
 import json
-from datetime import datetime
+import time
+import zipfile
+import logging
+import hmac
 
 app = Flask(__name__)
-CORS(app)
+app.request_class = payload.InMemoryRequest
+CORS(app, expose_headers=["Retry-After"])   # the page reads it on a 503
+# JSON logs; /metrics, per-request counters and Server-Timing headers
+logs.setup()
+metrics.init_app(app)
 
-def extract_json(text):
-    text = text.strip()
-    if "```" in text:
-        start = text.find("{")
-        end = text.rfind("}") + 1
-        if start != -1 and end > start:
-            text = text[start:end]
+# Background grading pool used when a client asks for job mode
+job_queue = jobs.JobQueue()
+JOB_STREAM_TIMEOUT = int(os.environ.get("JOB_STREAM_TIMEOUT", "120"))
+
+# Identical resubmissions are answered from here instead of the AI provider
+grade_cache = cache.GradeCache()
+# New photos of an already graded sketch (same student + rubric) are found here
+near_index = phash.NearDuplicateIndex() if phash.PHASH else None
+
+# Gemini and Grok as interchangeable backends, tried in PROVIDERS order
+PROVIDERS = {
+    "gemini": router.Provider("gemini", aichecknew.analyze_bytes, aichecknew.MODEL,
+                              aichecknew.complete_text, aichecknew.stream_bytes, aichecknew.compare_images,
+                              aichecknew.analyze_bytes_async, aichecknew.stream_bytes_async, aichecknew.analyze_many),
+    "grok": router.Provider("grok", gemininew.analyze_bytes, gemininew.MODEL,
+                            gemininew.complete_text, gemininew.stream_bytes, gemininew.compare_images,
+                            gemininew.analyze_bytes_async, gemininew.stream_bytes_async, gemininew.analyze_many),
+}
+provider_router = router.ProviderRouter(
+    [PROVIDERS[name.strip()] for name in os.environ.get("PROVIDERS", "gemini,grok").split(",")]
+)
+# The cheap models, graded first for rubrics with a cascade policy (utils/cascade.py)
+FAST_PROVIDERS = {
+    "gemini": router.Provider("gemini-fast", aichecknew.analyze_fast, aichecknew.FAST_MODEL,
+                              analyze_async=aichecknew.analyze_fast_async),
+    "grok": router.Provider("grok-fast", gemininew.analyze_fast, gemininew.FAST_MODEL,
+                            analyze_async=gemininew.analyze_fast_async),
+}
+fast_router = router.ProviderRouter(
+    [FAST_PROVIDERS[name.strip()] for name in os.environ.get("PROVIDERS", "gemini,grok").split(",")]
+)
+grader = cascade.Cascade(fast_router, provider_router)
+# With MULTI_IMAGE_MAX > 1, grades waiting at the same time share one provider call
+multi_image = multigrade.Batcher(provider_router.analyze_many) if multigrade.MULTI_IMAGE_MAX > 1 else None
+
+UNREADABLE = "AI could not process the image. Please try again."
+
+# Every graded upload and its grade, kept to regrade after a rubric change (see /regrade)
+submission_store = submissions.SubmissionStore() if submissions.SUBMISSION_STORE else None
+
+# Photos arriving in chunks from the submission page (see /uploads)
+upload_sessions = resumable.UploadSessions()
+
+def reply_text(result):
+    # The model's text from a (Gemini-shaped) provider result, "" if there is none
     try:
-        return json.loads(text)
-    except:
-        return None
+        return result["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+def read_grade(result, rubric):
+    # Validated grade for a provider result (see utils/scoring.py), or None.
+    # A broken field is re-asked with a short text-only follow-up, preferably
+    # to the provider that wrote the reply, instead of regrading the image.
+    def repair(prompt, fields):
+        fix = provider_router.complete(prompt, rubric, fields, prefer=result.get("provider"))
+        return None if "ai_error" in fix else reply_text(fix)
+    return scoring.validate(reply_text(result), rubric, repair)
 
 @app.route("/submit", methods=["POST"])
 def submit():
-    name = request.form.get("name", "Student").strip()
-    email = request.form.get("email", "").strip()
+    # Stop reading as soon as the upload is bigger than one photo may be
+    request.upload_limit = uploads.UPLOAD_MAX_BYTES + uploads.FORM_OVERHEAD
+    try:
+        error, submission = read_submission(request)
+    except RequestEntityTooLarge:
+        error = upload_error(uploads.reject("too_large"))
+    if error:
+        return error
+    name, email, image, mime, rubric = submission
+    # Request start to here: receiving and parsing the multipart upload
+    metrics.record_stage("upload", time.perf_counter() - g.metrics_start)
+    return start_grade(image, mime, name, rubric, email, request.values.get("mode"))
+
+def start_grade(image, mime, name, rubric, email, mode):
+    # The answer to a checked submission, for /submit and /uploads/<id>/finish
+
+    # Job mode: hand the upload to the background pool and answer right away.
+    # The client then polls (or streams) GET /jobs/<id> for the HTML report.
+    if mode == "job":
+        try:
+            job_id = job_queue.submit(grade_job, image, mime, name, rubric, email)
+        except jobs.QueueFull:
+            return jsonify({"error": "Too many submissions right now. Please try again in a minute."}), 503, {"Retry-After": "30"}
+        return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+    # More grades than the providers can take right now: a quick 503 with the
+    # estimated wait instead of a worker timeout (see utils/admission.py)
+    try:
+        ticket = admission.controller.enter()
+    except admission.Overloaded as e:
+        return busy_response(e)
+
+    # Stream mode: server-sent events with each score and the feedback text
+    # as the model writes them, then the finished HTML card.
+    if mode == "stream":
+        response = Response(
+            grade_stream(image, mime, name, rubric, email),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        response.call_on_close(ticket.leave)   # when the stream ends or the student leaves
+        return response
+
+    with ticket:
+        return grade_image(image, mime, name, rubric, email)
+
+def read_submission(req):
+    # The /submit form -> (error response, None) or (None, (name, email, image, mime, rubric)).
+    # Shared with the ASGI app (asgi.py).
+    name = req.form.get("name", "Student").strip()
+    email = req.form.get("email", "").strip()
  
-    if not name or not email or "image" not in request.files:
-        return '<div style="color:red;font-weight:bold;">Missing name, email, or image</div>', 400
+    if not name or not email or "image" not in req.files:
+        return ('<div style="color:red;font-weight:bold;">Missing name, email, or image</div>', 400), None
        
-    file = request.files["image"]
+    file = req.files["image"]
     if not file or not file.filename:
-        return '<div style="color:red;font-weight:bold;">No image selected</div>', 400
-    suffix = os.path.splitext(secure_filename(file.filename))[1] or ".jpg"
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    file.save(tmp.name)
-    path = tmp.name
-   
+        return ('<div style="color:red;font-weight:bold;">No image selected</div>', 400), None
+    try:
+        rubric = rubrics.registry.get(req.values.get("rubric"))
+    except KeyError:
+        return ('<div style="color:red;font-weight:bold;">Unknown assignment</div>', 400), None
+    # The real format from the file's bytes, not its name; bad photos stop here
     try:
-        print(f"[{datetime.now()}] Starting AI analysis for {name} – file: {path}")
-        result = analyze_image(path)
-        print(f"[{datetime.now()}] AI analysis finished    ")
+        with metrics.stage("validate"):
+            image, mime = uploads.check(payload.upload_bytes(file))
+    except uploads.Rejected as e:
+        return upload_error(e), None
+    return None, (name, email, image, mime, rubric)
+
+@app.route("/uploads/config", methods=["GET"])
+def upload_config():
+    # What the page shrinks a photo to before a chunked upload, and the chunk size
+    return jsonify(resumable.client_config())
+
+@app.route("/uploads", methods=["POST"])
+def upload_start():
+    # Chunked upload, step 1 (see utils/resumable.py)
+    return open_upload(request.get_json(silent=True) or request.form)
+
+@app.route("/uploads/<upload_id>", methods=["GET", "PATCH"])
+def upload_chunk(upload_id):
+    # GET: how many bytes have arrived. PATCH ?offset=N: the next chunk.
+    if request.method == "GET":
+        return upload_status(upload_id)
+    # A chunk is small: refuse a bigger body before reading it
+    request.upload_limit = resumable.UPLOAD_CHUNK_BYTES
+    try:
+        data = request.get_data(cache=False)
+    except RequestEntityTooLarge:
+        return chunk_too_large()
+    return append_chunk(upload_id, request.args.get("offset", type=int), data)
+
+@app.route("/uploads/<upload_id>/finish", methods=["POST"])
+def upload_finish(upload_id):
+    # Chunked upload, last step: grade it as /submit would (mode=stream|job)
+    error, submission = finished_upload(upload_id)
+    if error:
+        return error
+    name, email, image, mime, rubric = submission
+    response = app.make_response(start_grade(image, mime, name, rubric, email, request.values.get("mode")))
+    if response.status_code != 503:
+        upload_sessions.discard(upload_id)   # kept on a 503, to finish again after the wait
+    return response
+
+# The chunked-upload steps, shared with the ASGI app (asgi.py). Each
+# returns a Flask-style (body, status, headers) reply.
+
+def open_upload(fields):
+    # The form fields and the photo's size, checked before any of the photo is sent
+    name = str(fields.get("name") or "").strip()
+    email = str(fields.get("email") or "").strip()
+    if not name or not email:
+        return json_reply({"error": "Missing name or email"}, 400)
+    try:
+        rubric = rubrics.registry.get(fields.get("rubric"))
+    except KeyError:
+        return json_reply({"error": "Unknown assignment"}, 400)
+    try:
+        size = int(fields.get("size") or 0)
+        upload_id = upload_sessions.create(size, {"name": name, "email": email, "rubric": rubric.id})
+    except ValueError:
+        return json_reply({"error": "Missing or invalid size"}, 400)
+    except resumable.UploadError as e:
+        return upload_session_error(e)
+    return json_reply({"upload_id": upload_id, "offset": 0, "chunk_bytes": resumable.UPLOAD_CHUNK_BYTES,
+                       "upload_url": f"/uploads/{upload_id}"}, 201)
+
+def upload_status(upload_id):
+    try:
+        return json_reply(upload_sessions.status(upload_id))
+    except resumable.UploadError as e:
+        return upload_session_error(e)
+
+def append_chunk(upload_id, offset, data):
+    if offset is None:
+        return json_reply({"error": "Missing offset"}, 400)
+    try:
+        offset = upload_sessions.append(upload_id, offset, data)
+    except resumable.UploadError as e:
+        return upload_session_error(e)
+    return json_reply({"upload_id": upload_id, "offset": offset})
+
+def chunk_too_large():
+    return json_reply({"error": f"Chunks are at most {resumable.UPLOAD_CHUNK_BYTES} bytes"}, 413)
+
+def finished_upload(upload_id):
+    # A complete upload -> (error reply, None) or (None, (name, email, image, mime, rubric)),
+    # like read_submission. A photo that fails the checks is discarded.
+    try:
+        fields, data = upload_sessions.read(upload_id)
+    except resumable.UploadError as e:
+        return upload_session_error(e), None
+    try:
+        rubric = rubrics.registry.get(fields["rubric"])
+        with metrics.stage("validate"):
+            image, mime = uploads.check(data)
+    except KeyError:
+        upload_sessions.discard(upload_id, "rejected")
+        return json_reply({"error": "Unknown assignment"}, 400), None
+    except uploads.Rejected as e:
+        upload_sessions.discard(upload_id, "rejected")
+        return upload_error(e), None
+    return None, (fields["name"], fields["email"], image, mime, rubric)
+
+def upload_session_error(error):
+    body = {"error": str(error)}
+    if error.offset is not None:
+        body["offset"] = error.offset   # resume from here
+    return json_reply(body, error.status)
+
+def json_reply(body, status=200):
+    return json.dumps(body), status, {"Content-Type": "application/json"}
+
+def busy_response(overloaded):
+    # The page shows the wait and tries again after Retry-After seconds
+    message = f"The graders are busy right now. Please try again in about {overloaded.retry_after} seconds."
+    return (json.dumps({"error": message, "retry_after": overloaded.retry_after}), 503,
+            {"Content-Type": "application/json", "Retry-After": str(overloaded.retry_after)})
+
+def upload_error(rejected):
+    return f'<div style="color:red;font-weight:bold;">{rejected}</div>', rejected.status
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def grade_stream(image, mime, name, rubric, email=None):
+    # Events: "score" {key, label, score, max}, "feedback" {text} (appended
+    # pieces), then "done" {total, possible, html} or "error" {html}.
+    try:
+        yield from stream_events(image, mime, name, rubric, email)
+    except Exception:
+        logging.exception("Streaming grade failed for %s", name)
+        yield sse("error", {"html": error_html(name, "Something went wrong. Try again.")})
+
+def stream_events(image, mime, name, rubric, email):
+    start = time.perf_counter()
+    # Resized on the image pool while the caches are checked
+    prepared = images.normalize_async(image, mime)
+    try:
+        key = cache.make_key(image, rubric.prompt, provider_router.model)
+        result = grade_cache.get(key)
+        fingerprint = None
+        if result is None:
+            fingerprint, result = near_duplicate(image, rubric, email)
+        if result is None:
+            yield ": grading\n\n"   # first byte now, not after the upload is processed
+            parser = scoring.StreamParser(rubric.categories)
+            chunks, provider = [], None
+            for provider, item in provider_router.stream(*prepared.result(), rubric):
+                if isinstance(item, dict):
+                    logs.event("grade_failed", logging.WARNING, rubric=rubric.id, bytes=len(image),
+                               error_kind=item.get("error_kind"), seconds=round(time.perf_counter() - start, 3))
+                    store(image, mime, name, email, rubric, None, item)
+                    yield sse("error", {"html": error_html(name, item["ai_error"])})
+                    return
+                chunks.append(item)
+                for event, data in parser.feed(item):
+                    yield sse(event, data)
+            result = {"candidates": [{"content": {"parts": [{"text": "".join(chunks)}]}}], "provider": provider}
+            if scoring.is_valid(reply_text(result), rubric):
+                grade_cache.put(key, result)
+                remember(fingerprint, rubric, email, key)
+        yield stream_result(result, image, mime, name, rubric, start, email)
+    finally:
+        prepared.cancel()   # not needed after a cache hit
+
+def stream_result(result, image, mime, name, rubric, start, email=None):
+    # The final "done" (or "error") event of a streamed grade
+    grade = read_grade(result, rubric)
+    logs.event("graded", rubric=rubric.id, bytes=len(image), mime=mime, provider=result.get("provider"),
+               total=grade and grade["total"], seconds=round(time.perf_counter() - start, 3), streamed=True)
+    store(image, mime, name, email, rubric, grade, result)
+    if grade is None:
+        return sse("error", {"html": error_html(name, UNREADABLE)})
+    return sse("done", {"total": grade["total"], "possible": sum(top for _, _, top in grade["scores"]),
+                        "html": report_html(name, grade, result.get("near_duplicate"))})
+
+def grade_image(image, mime, name, rubric, email=None):
+    # Runs the AI analysis on an uploaded image and returns (html, status).
+    # Used inline by /submit and by background jobs.
+    try:
+        start = time.perf_counter()
+        result = cached_analyze(image, mime, rubric, email)
+        return grade_response(result, image, mime, name, rubric, start, email)
+    except Exception as e:
+        logging.exception("Grading failed for %s", name)
+        return failure_response(name)
+
+def grade_job(image, mime, name, rubric, email=None):
+    # grade_image for the job pool: takes an admission slot like an inline
+    # grade, waiting for one rather than failing (see utils/admission.py)
+    with admission.controller.wait():
+        return grade_image(image, mime, name, rubric, email)
+
+def grade_response(result, image, mime, name, rubric, start, email=None):
+    # Provider result -> (html, status[, headers]) for /submit
+    if "ai_error" in result:
+        logs.event("grade_failed", logging.WARNING, rubric=rubric.id, bytes=len(image),
+                   error_kind=result.get("error_kind"), seconds=round(time.perf_counter() - start, 3))
+        store(image, mime, name, email, rubric, None, result)
+        return error_html(name, result["ai_error"]), 200
+    raw = reply_text(result)
+    logs.event("ai_reply", logging.DEBUG, provider=result.get("provider"), chars=len(raw), reply=raw[:500])
+    with metrics.stage("parse"):
+        grade = read_grade(result, rubric)
+    logs.event("graded", rubric=rubric.id, bytes=len(image), mime=mime, provider=result.get("provider"),
+               total=grade and grade["total"], seconds=round(time.perf_counter() - start, 3))
+    store(image, mime, name, email, rubric, grade, result)
+    if grade is None:
+        return error_html(name, UNREADABLE), 200
+    with metrics.stage("render"):
+        html = report_html(name, grade, result.get("near_duplicate"))
+    return html, 200, {'Content-Type': 'text/html'}
+
+def store(image, mime, name, email, rubric, grade, result):
+    # Keep the upload and its grade (or why it failed) under this rubric version
+    if submission_store is not None:
+        error = result.get("ai_error", UNREADABLE) if grade is None else None
+        with metrics.stage("store"):
+            submission_store.save(image, mime, name, email or "", rubric, grade, error, result.get("provider"))
+
+def regrade(image, mime, rubric):
+    # A stored submission graded again -> (grade or None, error, provider); see utils/submissions.py
+    with admission.controller.wait():
+        result = cached_analyze(image, mime, rubric)
         if "ai_error" in result:
-            return f"<p style='text-align:center;color:#dc2626;font-size:18px;margin-top:40px;'>{name} — {result['ai_error']}</p>"
-        raw = result["candidates"][0]["content"]["parts"][0]["text"]
-        print("RAW API RESPONSE:", raw)
-        data = extract_json(raw)
-        # === 6 SCORES: AI defines labels & values. No hardcoded names. ===
-        if not data or "scores" not in data or not isinstance(data["scores"], dict):
-            print("Fallback triggered.")
-            score_items = [("Score 1", 0), ("Score 2", 0), ("Score 3", 0), ("Score 4", 0), ("Score 5", 0), ("Score 6", 0)]
-            feedback = "AI could not process the image. Please try again."
-        else:
-            scores_dict = data["scores"]
-            # Take first 6 items (in order), convert to int
-            items = list(scores_dict.items())[:6]
-            if len(items) < 6:
-                items += [("Score", 0)] * (6 - len(items))
-            score_items = []
-            for label, value in items:
-                #try:
-                #    # val = int(value)
-                #    val = int(value.split("/")[0])
-                #except:
-                #    val = 0
-                #score_items.append((label.replace("_", " ").title(), val))
-                score_items.append((label.replace("_", " ").title(), value))
-            feedback = data.get("feedback", "Great job!").strip()
-        #total = sum(val for _, val in score_items)
-        total = sum(int(value.split("/")[0]) for label, value in score_items)
+            return None, result["ai_error"], result.get("provider")
+        grade = read_grade(result, rubric)
+    return grade, None if grade else UNREADABLE, result.get("provider")
+
+regrader = submissions.Regrader(submission_store, regrade) if submission_store is not None else None
+
+def failure_response(name):
+    return (
+        f"<div style='text-align:center;padding:100px;font-family:system-ui;background:#fef2f2'>"
+        f"<h1 style='font-size:90px;color:#ef4444;margin:0'>Error</h1>"
+        f"<p style='font-size:26px'><strong>{name}</strong> — Something went wrong. Try again.</p>"
+        f"</div>",
+        500,
+        {'Content-Type': 'text/html'}
+    )
+
+def error_html(name, message):
+    return f"<p style='text-align:center;color:#dc2626;font-size:18px;margin-top:40px;'>{name} — {message}</p>"
+
+def report_html(name, grade, near_duplicate=None):
+    # The grade report card for a validated grade (see read_grade)
+    note = ""
+    if near_duplicate:
+        note = ("<p style='text-align:center;color:#475569'>This looks like the same sketch you "
+                "submitted before, so your earlier grade is shown.</p>")
+    possible = sum(top for _, _, top in grade["scores"])
+    rows = "\n".join(
+        f'                <tr><td class="label">{label}</td><td class="value">{score}/{top}</td></tr>'
+        for label, score, top in grade["scores"]
+    )
+    feedback_html = grade["feedback"].replace('\n', '<br>')
    
-        # HTML Output
-        html = f"""
-        <style>
-                .card {{max-width:820px;margin:40px auto;background:white;border-radius:28px;overflow:hidden;}}
-                .content {{padding:60px 70px}}
-                .form-area:has( #result:not(:empty) ) {{padding: 0;}}
-                table {{width:80%;font-size:25px;border-collapse:collapse; margin: 0 auto;}}
-                tr {{border-bottom:1px solid #e2e8f0}}
-                td {{padding:22px 0}}
-                .label {{font-weight:600;color:#1e293b}}
-                .value {{text-align:right;font-weight:700;color:#1d4ed8}}
-                .feedback {{margin-top:60px;padding:36px;background:#dbdbdb;border-left:8px solid #777777;border-radius:18px;font-size:19px;line-height:1.9;color:#222222}}
-                
-                #uploadForm {{display: none;}}
-                .rubric-btn {{display: none;}}   
-        </style>        
-        <div class="card">
-            <div class="grade-report-header">
-                <h1>{name}'s Grade Report</h1>
-                <div class="score-display">{total}/100</div>
-            </div>
+    # HTML Output
+    html = f"""
+    <style>
+            .card {{max-width:820px;margin:40px auto;background:white;border-radius:28px;overflow:hidden;}}
+            .content {{padding:60px 70px}}
+            .form-area:has( #result:not(:empty) ) {{padding: 0;}}
+            table {{width:80%;font-size:25px;border-collapse:collapse; margin: 0 auto;}}
+            tr {{border-bottom:1px solid #e2e8f0}}
+            td {{padding:22px 0}}
+            .label {{font-weight:600;color:#1e293b}}
+            .value {{text-align:right;font-weight:700;color:#1d4ed8}}
+            .feedback {{margin-top:60px;padding:36px;background:#dbdbdb;border-left:8px solid #777777;border-radius:18px;font-size:19px;line-height:1.9;color:#222222}}
+            
+            #uploadForm {{display: none;}}
+            .rubric-btn {{display: none;}}   
+    </style>        
+    <div class="card">
+        <div class="grade-report-header">
+            <h1>{name}'s Grade Report</h1>
+            <div class="score-display">{grade['total']}/{possible}</div>
+        </div>
 
-            <div class="content">
-                <table>
-                    <tr><td class="label">{score_items[0][0]}</td><td class="value">{score_items[0][1]}</td></tr>
-                    <tr><td class="label">{score_items[1][0]}</td><td class="value">{score_items[1][1]}</td></tr>
-                    <tr><td class="label">{score_items[2][0]}</td><td class="value">{score_items[2][1]}</td></tr>
-                    <tr><td class="label">{score_items[3][0]}</td><td class="value">{score_items[3][1]}</td></tr>
-                    <tr><td class="label">{score_items[4][0]}</td><td class="value">{score_items[4][1]}</td></tr>
-                    <tr><td class="label">{score_items[5][0]}</td><td class="value">{score_items[5][1]}</td></tr>
-                </table>
-
-                <div class="feedback">
-                    <strong>AI Feedback:</strong><br>{feedback.replace('\n','<br>')}
-                </div>
+        <div class="content">
+            {note}
+            <table>
+{rows}
+            </table>
+
+            <div class="feedback">
+                <strong>AI Feedback:</strong><br>{feedback_html}
             </div>
         </div>
+    </div>
 
-        <!-- Force the "Grade Another" button to appear BELOW the result -->
-        <div class="new-submission" style="margin-top:60px">
-            <h2>Ready for another?</h2>
-            <button onclick="location.reload()" style="background:#5b21b6;    ">Grade Another Sketch</button>
-        </div>
-        """
-        return html, 200, {'Content-Type': 'text/html'}
+    <!-- Force the "Grade Another" button to appear BELOW the result -->
+    <div class="new-submission" style="margin-top:60px">
+        <h2>Ready for another?</h2>
+        <button onclick="location.reload()" style="background:#5b21b6;    ">Grade Another Sketch</button>
+    </div>
+    """
+    return html
 
-    except Exception as e:
-        print(f"CRITICAL ERROR ({type(e).__name__}): {e}")
-        return (
-            f"<div style='text-align:center;padding:100px;font-family:system-ui;background:#fef2f2'>"
-            f"<h1 style='font-size:90px;color:#ef4444;margin:0'>Error</h1>"
-            f"<p style='font-size:26px'><strong>{name}</strong> — Something went wrong. Try again.</p>"
-            f"</div>",
-            500,
-            {'Content-Type': 'text/html'}
-        )
+def cached_analyze(image, mime, rubric, email=None):
+    # Same image + same rubric prompt + same model = same grade. Errors aren't cached.
+    # The photo is downscaled on the image pool while the cache is checked;
+    # the key uses the original upload bytes, so a cache hit skips that work.
+    # On a miss, a new photo of a sketch this student already had graded
+    # gets the earlier grade (see near_duplicate).
+    prepared = images.normalize_async(image, mime)
+    key = cache.make_key(image, rubric.prompt, provider_router.model)
+
+    def compute():
+        fingerprint, result = near_duplicate(image, rubric, email)
+        if result is None:
+            if multi_image is not None:
+                # None back means this photo wasn't graded in the shared call
+                result = multi_image.submit(*prepared.result(), rubric).result()
+            if result is None:
+                result = grader.analyze(*prepared.result(), rubric)
+            if should_store(result, rubric):
+                remember(fingerprint, rubric, email, key)
+        return result
+
+    try:
+        return grade_cache.get_or_compute(key, compute, should_store=lambda result: should_store(result, rubric))
     finally:
+        prepared.cancel()
+
+def should_store(result, rubric):
+    # Replies that need repair aren't cached, so a resubmission gets a fresh grade.
+    # Reused near-duplicate grades already have their own entry.
+    return ("ai_error" not in result and "near_duplicate" not in result
+            and scoring.is_valid(reply_text(result), rubric))
+
+def near_duplicate(image, rubric, email):
+    # -> (fingerprint, earlier result or None). Within PHASH_REUSE_DISTANCE
+    # bits (by default: an identical hash) the earlier grade is reused as
+    # is; up to PHASH_CONFIRM_DISTANCE a cheap two-thumbnail "same sketch?"
+    # call decides, so a corrected sketch isn't given its old grade.
+    if near_index is None or not email:
+        return None, None
+    with metrics.stage("phash"):
+        fingerprint = phash.fingerprint(image)
+    if fingerprint is None:
+        return None, None
+    match = near_index.nearest(near_scope(rubric, email), fingerprint[0])
+    if match is None:
+        return fingerprint, None
+    distance, row_id, earlier_key = match
+    result = grade_cache.get(earlier_key)
+    if result is None:
+        return fingerprint, None   # the earlier grade has expired
+    if distance > phash.PHASH_REUSE_DISTANCE:
+        thumb = near_index.thumbnail(row_id)
+        check = provider_router.compare(thumb, fingerprint[1]) if thumb else {}
+        if check.get("same") is not True:
+            metrics.inc("aigrademe_near_duplicates_total", {"outcome": "different"})
+            return fingerprint, None
+    outcome = "reused" if distance <= phash.PHASH_REUSE_DISTANCE else "confirmed"
+    metrics.inc("aigrademe_near_duplicates_total", {"outcome": outcome})
+    logs.event("near_duplicate", rubric=rubric.id, distance=distance, outcome=outcome)
+    return fingerprint, dict(result, near_duplicate={"distance": distance, "confirmed": outcome == "confirmed"})
+
+def near_scope(rubric, email):
+    # A changed rubric must not reuse grades from the old one
+    return f"{email.strip().lower()}|{rubric.id}|{rubric.version}"
+
+def remember(fingerprint, rubric, email, key):
+    if near_index is not None and fingerprint is not None and email:
+        near_index.add(near_scope(rubric, email), fingerprint[0], key, fingerprint[1])
+
+def instructor_only(turned_off):
+    # None when the request carries the instructor token (REGRADE_TOKEN),
+    # else the error response. turned_off: the 403 message when none is set.
+    if not submissions.REGRADE_TOKEN:
+        return jsonify({"error": turned_off}), 403
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode("utf-8"), submissions.REGRADE_TOKEN.encode("utf-8")):
+        return jsonify({"error": "Missing or wrong instructor token"}), 401, {"WWW-Authenticate": "Bearer"}
+    return None
+
+@app.route("/batch", methods=["POST"])
+def batch_grade():
+    # Instructor bulk grading. Form fields:
+    #   images   – one or more image files, and/or
+    #   archive  – a ZIP of images
+    #   roster   – optional CSV with file,name,email columns
+    #   rubric   – optional assignment id (default rubric otherwise)
+    #   format   – "ndjson" (default) or "csv"
+    #   concurrency, batch_id – optional; the same batch_id (or the same
+    #   files) resumes a batch without regrading finished sketches
+    # Up to hundreds of paid provider calls: instructors only
+    denied = instructor_only("Bulk grading is turned off; set REGRADE_TOKEN")
+    if denied:
+        return denied
+    request.upload_limit = batch.BATCH_MAX_REQUEST_BYTES
+    try:
+        request.form   # reads the upload, refusing it once it passes the limit
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"The upload is over {batch.BATCH_MAX_REQUEST_BYTES // (1024 * 1024)} MB"}), 413
+    try:
+        rubric = rubrics.registry.get(request.values.get("rubric"))
+    except KeyError:
+        return jsonify({"error": "Unknown assignment"}), 400
+    archive = request.files.get("archive")
+    roster_file = request.files.get("roster")
+    try:
+        roster = batch.read_roster(roster_file.read().decode("utf-8-sig")) if roster_file else {}
+    except UnicodeDecodeError:
+        return jsonify({"error": "The roster must be a UTF-8 CSV file (in Excel: Save As > CSV UTF-8)"}), 400
+    try:
+        items = batch.collect_items(
+            request.files.getlist("images"),
+            payload.upload_bytes(archive) if archive else None,
+            roster,
+        )
+    except zipfile.BadZipFile:
+        return jsonify({"error": "The archive is not a valid ZIP file"}), 400
+    except batch.ArchiveTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    if not items:
+        return jsonify({"error": "No JPG or PNG sketches found in the upload"}), 400
+
+    try:
+        concurrency = int(request.values.get("concurrency", batch.BATCH_CONCURRENCY))
+        run = batch.BatchRun(request.values.get("batch_id") or batch.batch_id_for(items, rubric.version), items)
+    except ValueError:
+        return jsonify({"error": "Invalid concurrency or batch_id"}), 400
+    logs.event("batch_started", batch_id=run.batch_id, to_grade=len(run.todo), already_graded=len(run.done))
+
+    records = run.stream(lambda image, mime, name, email: grade_record(image, mime, rubric, name, email), concurrency)
+    headers = {"X-Batch-Id": run.batch_id, "X-Accel-Buffering": "no"}
+    fmt = request.values.get("format") or ("csv" if "text/csv" in request.headers.get("Accept", "") else "ndjson")
+    if fmt == "csv":
+        return Response(batch.to_csv(records), mimetype="text/csv", headers=headers)
+    return Response(batch.to_ndjson(run, records), mimetype="application/x-ndjson", headers=headers)
+
+def grade_record(image, mime, rubric, name="", email=""):
+    # One batch item -> result record (same checks, analysis + parsing as /submit).
+    # mime is only the file extension's guess; the check sniffs the real format.
+    # Grades and failures are stored like /submit's, so /regrade can redo them.
+    try:
+        with metrics.stage("validate"):
+            image, mime = uploads.check(image)
+    except uploads.Rejected as e:
+        return {"status": "rejected", "reason": e.reason, "error": str(e)}
+    # Batch items take admission slots like /submit's grades (waiting for one)
+    with admission.controller.wait():
+        result = cached_analyze(image, mime, rubric)
+        if "ai_error" in result:
+            store(image, mime, name, email, rubric, None, result)
+            return {"status": "error", "error": result["ai_error"]}
+        with metrics.stage("parse"):
+            grade = read_grade(result, rubric)
+    store(image, mime, name, email, rubric, grade, result)
+    if grade is None:
+        return {"status": "error", "error": "AI could not process the image."}
+    scores = {label: f"{score}/{top}" for label, score, top in grade["scores"]}
+    return {"status": "graded", "total": grade["total"], "scores": scores, "feedback": grade["feedback"]}
+
+@app.route("/regrade", methods=["GET", "POST"])
+def regrade_submissions():
+    # GET: stored submissions per rubric (current, outdated, failed) and the
+    # current run. POST: regrade the outdated and failed ones in the
+    # background. Form fields: rubric (optional, default all), concurrency.
+    if regrader is None:
+        return jsonify({"error": "The submission store is turned off (SUBMISSION_STORE=0)"}), 404
+    if request.method == "GET":
+        return jsonify({"submissions": submission_store.summary(), "run": regrader.status()})
+    # Every regrade is a paid provider call: instructors only
+    denied = instructor_only("Regrading over HTTP is turned off; run tools/regrade.py or set REGRADE_TOKEN")
+    if denied:
+        return denied
+    rubric_id = request.values.get("rubric")
+    if rubric_id:
         try:
-            os.unlink(path)
-        except:
-            pass
+            rubrics.registry.get(rubric_id)
+        except KeyError:
+            return jsonify({"error": "Unknown assignment"}), 400
+    try:
+        concurrency = int(request.values.get("concurrency", submissions.REGRADE_CONCURRENCY))
+    except ValueError:
+        return jsonify({"error": "Invalid concurrency"}), 400
+    run = regrader.start([rubric_id] if rubric_id else None, concurrency)
+    return jsonify({"submissions": submission_store.summary(), "run": run}), 202
+
+@app.route("/analytics", methods=["GET"])
+def grade_analytics():
+    # Class-wide score distributions for an assignment: ?rubric= (default
+    # rubric otherwise), ?version= for an older rubric version. Answered
+    # from counts kept as grades land, not by reading every grade.
+    # The whole class's grades: instructors only
+    denied = instructor_only("Analytics are turned off; set REGRADE_TOKEN")
+    if denied:
+        return denied
+    if submission_store is None:
+        return jsonify({"error": "The submission store is turned off (SUBMISSION_STORE=0)"}), 404
+    try:
+        rubric = rubrics.registry.get(request.args.get("rubric"))
+    except KeyError:
+        return jsonify({"error": "Unknown assignment"}), 404
+    version = request.args.get("version") or rubric.version
+    with metrics.stage("analytics"):
+        categories, totals = submission_store.counts(rubric.id, version)
+        report = analytics.summarize(categories, totals, [label for _, label, _ in rubric.categories])
+    other_versions = {v: n for v, n in submission_store.versions(rubric.id).items() if v != version}
+    return jsonify(dict(report, rubric=rubric.id, version=version, other_versions=other_versions))
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    # Poll: returns the job as JSON. Stream: send "Accept: text/event-stream"
+    # (or ?stream=1) to get server-sent events until the job finishes.
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if "text/event-stream" in request.headers.get("Accept", "") or request.args.get("stream"):
+        return Response(
+            job_events(job_id, job),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return jsonify(job)
+
+def job_events(job_id, job):
+    deadline = time.monotonic() + JOB_STREAM_TIMEOUT
+    last_status = None
+    while True:
+        if job is None:
+            yield "event: error\ndata: {\"error\": \"Unknown or expired job\"}\n\n"
+            return
+        if job["status"] != last_status:
+            last_status = job["status"]
+            event = "done" if last_status in ("done", "error") else "status"
+            yield f"event: {event}\ndata: {json.dumps(job)}\n\n"
+            if event == "done":
+                return
+        else:
+            yield ": keep-alive\n\n"
+        if time.monotonic() > deadline:
+            return
+        job = job_queue.wait(job_id, timeout=15)
 
 @app.route("/", methods=["GET"])
 def home():
     return "Ready."
 
+@app.route("/stats/http", methods=["GET"])
+def http_stats():
+    # Connection reuse per provider host, for checking the keep-alive pool
+    return jsonify(http_client.stats())
+
+@app.route("/stats/providers", methods=["GET"])
+def provider_stats():
+    # Latency, error rate and circuit state per AI provider
+    return jsonify(provider_router.stats())
+
+@app.route("/stats/cascade", methods=["GET"])
+def cascade_stats():
+    # Calls, latency and tokens per model tier, and how often the fast tier escalated
+    return jsonify(grader.stats())
+
+@app.route("/stats/admission", methods=["GET"])
+def admission_stats():
+    # Grades running and waiting in this process, and the current estimated wait
+    return jsonify(admission.controller.stats())
+
+@app.route("/stats/context-cache", methods=["GET"])
+def context_cache_stats():
+    # This process's cached rubric prompt handles and seconds until they expire
+    return jsonify(aichecknew.PROMPT_CACHE.stats())
+
+@app.route("/stats/files", methods=["GET"])
+def file_handle_stats():
+    # Photos this process has uploaded to Gemini and still refers to by handle
+    return jsonify(aichecknew.FILES.stats())
+
+@app.route("/stats/parse", methods=["GET"])
+def parse_stats():
+    # How often AI replies needed repair (or were unusable)
+    return jsonify(scoring.stats())
+
 @app.route("/rubric", methods=["GET"])
 def rubric():
-    # Return the student-facing rubric from prompt.txt
-    return get_rubric(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    # Return the student-facing rubric (prompt.txt, or rubrics/<id>.txt with ?rubric=<id>)
+    try:
+        text = get_rubric(request.args.get("rubric"))
+    except KeyError:
+        return "Unknown assignment", 404, {"Content-Type": "text/plain; charset=utf-8"}
+    return text, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+@app.route("/rubrics", methods=["GET"])
+def rubric_list():
+    # Assignment ids that /submit, /batch and /rubric accept
+    return jsonify(rubrics.registry.ids())
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
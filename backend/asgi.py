@@ -0,0 +1,439 @@
+# AIGradeMe Backend, ASGI entry point
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description:
+# Serves appnew.py on an asyncio event loop:
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT
+#
+# Under gunicorn each grade holds a thread for the whole provider call,
+# which is mostly waiting on the network. Here POST /submit (all modes),
+# the chunked uploads (/uploads, /uploads/<id>, /uploads/<id>/finish),
+# GET /rubric and GET / run as coroutines, and the provider calls go
+# through httpx's async client (utils/http_client.apost), so one process
+# can have hundreds of grades in flight. Each provider takes at most
+# PROVIDER_CONCURRENCY calls at once; the rest wait their turn.
+# CPU work (multipart parsing, image resizing, hashing, cache reads,
+# score repair) still runs on thread pools.
+#
+# All other routes (/batch, /jobs, /stats, /metrics...) are the Flask views
+# from appnew.py, run through asgiref's WSGI adapter on a pool of
+# WSGI_THREADS threads. (asgiref's default runs every WSGI call on one
+# shared thread, so an open /jobs/<id>?stream=1 or /batch stream would
+# hold up all the others; the views are thread-safe, as under gunicorn.)
+
+import asyncio
+import io
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+import appnew
+from appnew import grade_cache, job_queue, provider_router
+from utils import admission, cache, images, jobs, logs, metrics, payload, resumable, router, rubrics, scoring, uploads
+
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "32"))   # Flask views running at once
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi with each request on its own pool thread instead of one shared thread."""
+
+    def __init__(self, wsgi_application, threads=WSGI_THREADS):
+        super().__init__(wsgi_application)
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+        class Instance(WsgiToAsgiInstance):
+            run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False,
+                                         executor=executor)
+
+        self._instance = Instance
+
+    async def __call__(self, scope, receive, send):
+        await self._instance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+flask_app = ThreadedWsgiToAsgi(appnew.app)
+
+# One event loop can wait on many more grades than a gunicorn worker has
+# threads: unless ADMISSION_MAX_IN_FLIGHT is set, admit as many as the
+# providers take at once.
+if "ADMISSION_MAX_IN_FLIGHT" not in os.environ:
+    admission.controller = admission.Admission(max_in_flight=router.PROVIDER_CONCURRENCY)
+
+HTML = "text/html; charset=utf-8"
+TEXT = "text/plain; charset=utf-8"
+JSON = "application/json"
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    handler, endpoint, args = route(scope)
+    if scope["type"] != "http" or handler is None:
+        return await flask_app(scope, receive, send)
+    await observed(handler, scope, receive, send, endpoint, args)
+
+
+def route(scope):
+    # -> (handler, endpoint label for the metrics, path arguments), or Nones
+    method, path = scope.get("method"), scope.get("path")
+    handler = ROUTES.get((method, path))
+    if handler is not None:
+        return handler, path, ()
+    for route_method, pattern, handler, endpoint in PATTERN_ROUTES:
+        match = pattern.match(path or "")
+        if route_method == method and match:
+            return handler, endpoint, match.groups()   # the label, not the id: one series per route
+    return None, None, ()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def observed(handler, scope, receive, send, endpoint, args=()):
+    # What metrics.init_app does for the Flask views: counters, duration,
+    # in-flight gauge and the Server-Timing header.
+    start = time.perf_counter()
+    metrics.begin_request()
+    metrics.gauge_add("aigrademe_requests_in_flight", 1)
+    status = None
+
+    async def send_observed(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers = list(message.get("headers", []))
+            headers.append((b"access-control-allow-origin", b"*"))   # as flask_cors does
+            headers.append((b"access-control-expose-headers", b"Retry-After"))
+            timing = metrics.server_timing()
+            if timing:
+                headers.append((b"server-timing", timing.encode("latin-1")))
+            message = dict(message, headers=headers)
+        await send(message)
+
+    try:
+        await handler(Request(scope, receive), send_observed, *args)
+    except ClientGone:
+        status = status or 499
+    except Exception:
+        logging.exception("%s %s failed", scope["method"], endpoint)
+        if status is None:
+            await respond(send_observed, 500, "Internal Server Error", TEXT)
+    finally:
+        metrics.gauge_add("aigrademe_requests_in_flight", -1)
+        metrics.observe("aigrademe_request_seconds", time.perf_counter() - start, {"endpoint": endpoint})
+        metrics.inc("aigrademe_requests_total", {"endpoint": endpoint, "status": status})
+
+
+class ClientGone(Exception):
+    """The client disconnected before the request body was read."""
+
+
+class TooLarge(Exception):
+    """The request body is over the route's limit."""
+
+
+class Request:
+    """The parts of an ASGI request the native routes need."""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.start = time.perf_counter()
+
+    async def body(self, limit=None):
+        # Raises TooLarge as soon as the body passes limit, without reading the rest
+        if limit is not None:
+            for name, value in self.scope.get("headers", []):
+                if name == b"content-length" and value.isdigit() and int(value) > limit:
+                    raise TooLarge()
+        chunks, size = [], 0
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ClientGone()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise TooLarge()
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    def query(self, name):
+        values = parse_qs(self.scope.get("query_string", b"").decode("latin-1")).get(name)
+        return values[0] if values else None
+
+    async def form(self, limit=None):
+        # werkzeug's multipart parser (in memory, like appnew) on a worker thread
+        body = await self.body(limit)
+        return await asyncio.to_thread(self.parse, body)
+
+    def parse(self, body):
+        req = payload.InMemoryRequest(self.environ(body))
+        req.form   # parses the multipart body (form and files)
+        return req
+
+    def environ(self, body=b""):
+        scope = self.scope
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": unquote(scope["path"]),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": "asgi",
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": io.StringIO(),
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            key = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if key == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif key != "CONTENT_LENGTH":
+                environ[f"HTTP_{key}"] = value
+        return environ
+
+
+async def respond(send, status, body, content_type=HTML, headers=None):
+    raw = body.encode("utf-8") if isinstance(body, str) else body
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode("latin-1")), (b"content-length", str(len(raw)).encode())]
+        + [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in (headers or {}).items()],
+    })
+    await send({"type": "http.response.body", "body": raw})
+
+
+async def respond_flask(send, reply):
+    # A Flask-style (body, status[, headers]) tuple from appnew's helpers
+    body, status, headers = (reply + ({},))[:3]
+    headers = dict(headers)
+    content_type = headers.pop("Content-Type", HTML)
+    await respond(send, status, body, content_type, headers)
+
+
+# ----------------------------------------------------------------------
+# Routes (same contracts as appnew.py)
+# ----------------------------------------------------------------------
+async def home(request, send):
+    await respond(send, 200, "Ready.")
+
+
+async def rubric(request, send):
+    req = payload.InMemoryRequest(request.environ())
+    try:
+        text = rubrics.registry.get(req.args.get("rubric")).text
+    except KeyError:
+        return await respond(send, 404, "Unknown assignment", TEXT)
+    await respond(send, 200, text, TEXT)
+
+
+async def submit(request, send):
+    try:
+        req = await request.form(limit=uploads.UPLOAD_MAX_BYTES + uploads.FORM_OVERHEAD)
+    except TooLarge:
+        return await respond_flask(send, appnew.upload_error(uploads.reject("too_large")))
+    # Validation decodes the image header (and may convert the photo): off the loop
+    error, submission = await asyncio.to_thread(appnew.read_submission, req)
+    if error:
+        return await respond_flask(send, error)
+    name, email, image, mime, rubric = submission
+    metrics.record_stage("upload", time.perf_counter() - request.start)
+
+    await start_grade(send, image, mime, name, rubric, email, req.values.get("mode"))
+
+
+async def start_grade(send, image, mime, name, rubric, email, mode):
+    # The answer to a checked submission, for /submit and /uploads/<id>/finish
+    # (as appnew.start_grade). Returns the status sent.
+    if mode == "job":
+        try:
+            job_id = job_queue.submit(appnew.grade_job, image, mime, name, rubric, email)
+        except jobs.QueueFull:
+            await respond(send, 503, json.dumps({"error": "Too many submissions right now. Please try again in a minute."}),
+                          JSON, {"Retry-After": "30"})
+            return 503
+        await respond(send, 202, json.dumps({"job_id": job_id, "status": "queued",
+                                             "status_url": f"/jobs/{job_id}"}), JSON)
+        return 202
+    try:
+        ticket = await admission.controller.enter_async()
+    except admission.Overloaded as e:
+        await respond_flask(send, appnew.busy_response(e))
+        return 503
+    with ticket:
+        if mode == "stream":
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                            (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")],
+            })
+            async for event in grade_stream(image, mime, name, rubric, email):
+                await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+            return 200
+
+        reply = await grade_image(image, mime, name, rubric, email)
+        await respond_flask(send, reply)
+        return reply[1]
+
+
+# Chunked uploads (see utils/resumable.py). The session files are small
+# reads and writes, done on worker threads like the other file work.
+async def upload_config(request, send):
+    await respond(send, 200, json.dumps(resumable.client_config()), JSON)
+
+
+async def upload_start(request, send):
+    try:
+        body = await request.body(limit=uploads.FORM_OVERHEAD)
+    except TooLarge:
+        return await respond_flask(send, appnew.json_reply({"error": "Request too large"}, 413))
+    try:
+        fields = json.loads(body)
+    except ValueError:
+        fields = None
+    if not isinstance(fields, dict):
+        fields = (await asyncio.to_thread(request.parse, body)).form
+    await respond_flask(send, await asyncio.to_thread(appnew.open_upload, fields))
+
+
+async def upload_status(request, send, upload_id):
+    await respond_flask(send, await asyncio.to_thread(appnew.upload_status, upload_id))
+
+
+async def upload_chunk(request, send, upload_id):
+    try:
+        data = await request.body(limit=resumable.UPLOAD_CHUNK_BYTES)
+    except TooLarge:
+        return await respond_flask(send, appnew.chunk_too_large())
+    try:
+        offset = int(request.query("offset"))
+    except (TypeError, ValueError):
+        offset = None
+    await respond_flask(send, await asyncio.to_thread(appnew.append_chunk, upload_id, offset, data))
+
+
+async def upload_finish(request, send, upload_id):
+    try:
+        req = await request.form(limit=uploads.FORM_OVERHEAD)
+    except TooLarge:
+        return await respond_flask(send, appnew.json_reply({"error": "Request too large"}, 413))
+    error, submission = await asyncio.to_thread(appnew.finished_upload, upload_id)
+    if error:
+        return await respond_flask(send, error)
+    name, email, image, mime, rubric = submission
+    metrics.record_stage("upload", time.perf_counter() - request.start)
+    status = await start_grade(send, image, mime, name, rubric, email, req.values.get("mode"))
+    if status != 503:
+        await asyncio.to_thread(appnew.upload_sessions.discard, upload_id)   # kept on a 503, as in appnew
+
+
+# ----------------------------------------------------------------------
+# Grading (the async twins of appnew.grade_image / grade_stream)
+# ----------------------------------------------------------------------
+async def grade_image(image, mime, name, rubric, email=None):
+    try:
+        start = time.perf_counter()
+        result = await cached_analyze(image, mime, rubric, email)
+        # Parsing may ask the provider to repair a field: a short blocking call
+        return await asyncio.to_thread(appnew.grade_response, result, image, mime, name, rubric, start, email)
+    except Exception:
+        logging.exception("Grading failed for %s", name)
+        return appnew.failure_response(name)
+
+
+async def cached_analyze(image, mime, rubric, email=None):
+    prepared = images.normalize_async(image, mime)
+    key = cache.make_key(image, rubric.prompt, provider_router.model)
+
+    async def compute():
+        fingerprint, result = await asyncio.to_thread(appnew.near_duplicate, image, rubric, email)
+        if result is None:
+            if appnew.multi_image is not None:
+                prepared_image = await asyncio.wrap_future(prepared)
+                result = await asyncio.wrap_future(appnew.multi_image.submit(*prepared_image, rubric))
+            if result is None:
+                result = await appnew.grader.analyze_async(*await asyncio.wrap_future(prepared), rubric)
+            if appnew.should_store(result, rubric):
+                await asyncio.to_thread(appnew.remember, fingerprint, rubric, email, key)
+        return result
+
+    try:
+        return await grade_cache.get_or_compute_async(
+            key, compute, should_store=lambda result: appnew.should_store(result, rubric))
+    finally:
+        prepared.cancel()
+
+
+async def grade_stream(image, mime, name, rubric, email=None):
+    start = time.perf_counter()
+    try:
+        key = cache.make_key(image, rubric.prompt, provider_router.model)
+        result = await asyncio.to_thread(grade_cache.get, key)
+        fingerprint = None
+        if result is None:
+            fingerprint, result = await asyncio.to_thread(appnew.near_duplicate, image, rubric, email)
+        if result is None:
+            yield ": grading\n\n"
+            parser = scoring.StreamParser(rubric.categories)
+            chunks, provider = [], None
+            prepared = await asyncio.wrap_future(images.normalize_async(image, mime))
+            async for provider, item in provider_router.stream_async(*prepared, rubric):
+                if isinstance(item, dict):
+                    logs.event("grade_failed", logging.WARNING, rubric=rubric.id, bytes=len(image),
+                               error_kind=item.get("error_kind"), seconds=round(time.perf_counter() - start, 3))
+                    await asyncio.to_thread(appnew.store, image, mime, name, email, rubric, None, item)
+                    yield appnew.sse("error", {"html": appnew.error_html(name, item["ai_error"])})
+                    return
+                chunks.append(item)
+                for event, data in parser.feed(item):
+                    yield appnew.sse(event, data)
+            result = {"candidates": [{"content": {"parts": [{"text": "".join(chunks)}]}}], "provider": provider}
+            if scoring.is_valid(appnew.reply_text(result), rubric):
+                await asyncio.to_thread(grade_cache.put, key, result)
+                await asyncio.to_thread(appnew.remember, fingerprint, rubric, email, key)
+        yield await asyncio.to_thread(appnew.stream_result, result, image, mime, name, rubric, start, email)
+    except Exception:
+        logging.exception("Streaming grade failed for %s", name)
+        yield appnew.sse("error", {"html": appnew.error_html(name, "Something went wrong. Try again.")})
+
+
+ROUTES = {
+    ("GET", "/"): home,
+    ("GET", "/rubric"): rubric,
+    ("POST", "/submit"): submit,
+    ("GET", "/uploads/config"): upload_config,
+    ("POST", "/uploads"): upload_start,
+}
+
+# (method, path pattern, handler, endpoint label): the handler gets the groups
+PATTERN_ROUTES = [
+    ("GET", re.compile(r"^/uploads/([0-9a-f]{32})$"), upload_status, "/uploads/<upload_id>"),
+    ("PATCH", re.compile(r"^/uploads/([0-9a-f]{32})$"), upload_chunk, "/uploads/<upload_id>"),
+    ("POST", re.compile(r"^/uploads/([0-9a-f]{32})/finish$"), upload_finish, "/uploads/<upload_id>/finish"),
+]
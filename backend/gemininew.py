@@ -5,7 +5,7 @@
 
 import os
 import base64
-import requests
+from utils import cascade, http_client, metrics, multigrade, payload, ratelimit, retry, rubrics, scoring, uploads
 import json
 import logging
 import sys
@@ -26,14 +26,23 @@ GROK_KEY = os.environ.get("GROK_API_KEY")
 if not GROK_KEY:
     raise RuntimeError("GROK_API_KEY not set")
 
-# Load prompt.txt
-with open("prompt.txt", "r", encoding="utf-8") as f:
-    txt = f.read().strip()
+# Rubrics (prompt.txt and rubrics/*.txt) come from the shared registry.
+# RUBRIC_TEXT / PROMPT_TEMPLATE are the default rubric as of startup.
+DEFAULT_RUBRIC = rubrics.registry.get()
+RUBRIC_TEXT, PROMPT_TEMPLATE = DEFAULT_RUBRIC.text, DEFAULT_RUBRIC.prompt
 
-parts = txt.split("\n=== PROMPT ===\n", 1)
-if len(parts) != 2:
-    raise RuntimeError("prompt.txt must contain '=== PROMPT ===' separator")
-RUBRIC_TEXT, PROMPT_TEMPLATE = parts[0].strip(), parts[1].strip()
+MODEL = "grok-4-0709"
+FAST_MODEL = os.environ.get("GROK_FAST_MODEL", "grok-4-fast-non-reasoning")   # cascade first tier
+COMPARE_PROMPT = "Are these two photos of the same hand-drawn sketch, with nothing added, removed or changed? Differences in angle, lighting, crop or photo quality don't count. Answer with JSON {\"same\": true} or {\"same\": false}."
+# Point at tools/fake_provider.py for load tests
+GROK_BASE_URL = os.environ.get("GROK_BASE_URL", "https://api.x.ai").rstrip("/")
+
+# Shared across gunicorn workers; 0 = no client-side limit
+LIMITER = ratelimit.RateLimiter(
+    "grok",
+    rpm=int(os.environ.get("GROK_RPM", "0")),
+    tpm=int(os.environ.get("GROK_TPM", "0")),
+)
 
 logging.info("=== PROMPT SENT ===")
 logging.info(PROMPT_TEMPLATE)
@@ -53,47 +62,271 @@ logging.info("=== END PROMPT ===")
 #     resp = requests.post(url, json=payload)
 #     return resp.json() if resp.status_code == 200 else {"success": False, "details": resp.text}
 
+def structured_output(rubric, fields=None):
+    # Constrain the reply to JSON with an integer per rubric category
+    # (see utils/scoring.py). Rubrics without "(N%)" lines are sent as before.
+    if not (scoring.STRUCTURED_OUTPUT and rubric.categories):
+        return {}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "grade", "strict": True,
+                            "schema": scoring.json_schema(rubric.categories, fields)},
+        }
+    }
+
+def build_body(rubric):
+    # Grok request body for one rubric. The registry serializes it once;
+    # each call only splices in the image.
+    return {
+        "model": MODEL,
+        "messages": [{
+            "role": "user",  # ← String "user" — no enums
+            "content": [
+                {"type": "text", "text": rubric.prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{payload.MIME};base64,{payload.IMAGE}"}}
+            ]
+        }],
+        "temperature": 0.3,
+        "max_tokens": 400,
+        **structured_output(rubric),
+    }
+
+def build_fast_body(rubric):
+    # The cascade's first tier (utils/cascade.py): also asks for a confidence per category
+    body = {
+        "model": FAST_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": cascade.prompt(rubric)},
+                {"type": "image_url", "image_url": {"url": f"data:{payload.MIME};base64,{payload.IMAGE}"}}
+            ]
+        }],
+        "temperature": 0.3,
+        "max_tokens": 500,
+    }
+    if scoring.STRUCTURED_OUTPUT and rubric.categories:
+        body["response_format"] = {"type": "json_schema", "json_schema": {
+            "name": "grade", "strict": True, "schema": cascade.json_schema(rubric.categories)}}
+    return body
+
+def tier(fast):
+    # (template name, body builder) for the full or the fast tier
+    return ("grok-fast", build_fast_body) if fast else ("grok", build_body)
+
+def build_stream_body(rubric):
+    return dict(build_body(rubric), stream=True)
+
 def analyze_image(image_path: str):
     logging.info(f"Analyzing image: {image_path}")
     
     with open(image_path, "rb") as f:
-        encoded = base64.b64encode(f.read()).decode("utf-8")
-    
-    ext = os.path.splitext(image_path)[1].lower()
-    mime = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}.get(
-        ext.lstrip("."), "application/octet-stream"
-    )
+        image = f.read()
+    return analyze_bytes(image, uploads.sniff(image[:16]) or payload.mime_for(image_path))
 
+def analyze_bytes(image, mime: str, rubric=None, fast=False):
     # === RAW REQUESTS FOR GROK (OpenAI endpoint) ===
+    # fast: grade with FAST_MODEL, the cascade's first tier
     headers = {
         "Authorization": f"Bearer {GROK_KEY}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "model": "grok-4-0709",
-        "messages": [{
-            "role": "user",  # ← String "user" — no enums
-            "content": [
-                {"type": "text", "text": PROMPT_TEMPLATE},
-                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{encoded}"}}
-            ]
-        }],
+    rubric = rubric or rubrics.registry.get()
+    with metrics.stage("encode"):
+        body = rubric.template(*tier(fast)).render(mime, image)
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+
+    resp, error = retry.post(url, LIMITER, rubric.tokens, provider="Grok", data=body, headers=headers)
+    if error:
+        return error
+    
+    logging.info("Grok response received")
+    try:
+        data = resp.json()
+        content = data["choices"][0]["message"]["content"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+    # Return Gemini-compatible structure (plus the token usage, for utils/cascade.py)
+    return {"candidates": [{"content": {"parts": [{"text": content}]}}], "usage": data.get("usage")}
+
+def stream_bytes(image, mime: str, rubric=None):
+    # Like analyze_bytes, but yields the reply text as it is generated
+    # (chat completions with stream=true, SSE). A failure is yielded as an error dict.
+    headers = {
+        "Authorization": f"Bearer {GROK_KEY}",
+        "Content-Type": "application/json"
+    }
+    rubric = rubric or rubrics.registry.get()
+    with metrics.stage("encode"):
+        body = rubric.template("grok-stream", build_stream_body).render(mime, image)
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+
+    resp, error = retry.post(url, LIMITER, rubric.tokens, provider="Grok", data=body, headers=headers, stream=True)
+    if error:
+        yield error
+        return
+    try:
+        for data in http_client.sse_events(resp):
+            if data == "[DONE]":
+                break
+            try:
+                text = json.loads(data)["choices"][0]["delta"].get("content")
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                continue
+            if text:
+                yield text
+    except Exception as e:
+        logging.error("Grok stream broke off: %s: %s", type(e).__name__, e)
+        yield retry.error("connection", f"{type(e).__name__}: {e}")
+    finally:
+        resp.close()
+
+async def analyze_bytes_async(image, mime: str, rubric=None, fast=False):
+    # analyze_bytes for the ASGI app: waits on the network without a thread
+    headers = {
+        "Authorization": f"Bearer {GROK_KEY}",
+        "Content-Type": "application/json"
+    }
+    rubric = rubric or rubrics.registry.get()
+    with metrics.stage("encode"):
+        body = rubric.template(*tier(fast)).render(mime, image)
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+
+    resp, error = await retry.apost(url, LIMITER, rubric.tokens, provider="Grok", data=body, headers=headers)
+    if error:
+        return error
+    try:
+        data = resp.json()
+        content = data["choices"][0]["message"]["content"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+    return {"candidates": [{"content": {"parts": [{"text": content}]}}], "usage": data.get("usage")}
+
+def analyze_fast(image, mime: str, rubric=None):
+    return analyze_bytes(image, mime, rubric, fast=True)
+
+async def analyze_fast_async(image, mime: str, rubric=None):
+    return await analyze_bytes_async(image, mime, rubric, fast=True)
+
+async def stream_bytes_async(image, mime: str, rubric=None):
+    # stream_bytes for the ASGI app (async generator)
+    headers = {
+        "Authorization": f"Bearer {GROK_KEY}",
+        "Content-Type": "application/json"
+    }
+    rubric = rubric or rubrics.registry.get()
+    with metrics.stage("encode"):
+        body = rubric.template("grok-stream", build_stream_body).render(mime, image)
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+
+    resp, error = await retry.apost(url, LIMITER, rubric.tokens, provider="Grok", data=body, headers=headers, stream=True)
+    if error:
+        yield error
+        return
+    try:
+        async for data in http_client.asse_events(resp):
+            if data == "[DONE]":
+                break
+            try:
+                text = json.loads(data)["choices"][0]["delta"].get("content")
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                continue
+            if text:
+                yield text
+    except Exception as e:
+        logging.error("Grok stream broke off: %s: %s", type(e).__name__, e)
+        yield retry.error("connection", f"{type(e).__name__}: {e}")
+    finally:
+        await resp.aclose()
+
+def compare_images(jpeg_a, jpeg_b):
+    # Confirm-only near-duplicate check on two small thumbnails (utils/phash.py)
+    headers = {
+        "Authorization": f"Bearer {GROK_KEY}",
+        "Content-Type": "application/json"
+    }
+    def image_part(jpeg):
+        return {"type": "image_url",
+                "image_url": {"url": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii")}}
+    body = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": COMPARE_PROMPT}, image_part(jpeg_a), image_part(jpeg_b),
+        ]}],
+        "temperature": 0,
+        "max_tokens": 20,
+        "response_format": {"type": "json_schema", "json_schema": {"name": "same", "strict": True, "schema": {
+            "type": "object", "properties": {"same": {"type": "boolean"}},
+            "required": ["same"], "additionalProperties": False,
+        }}},
+    }
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+    resp, error = retry.post(url, LIMITER, 2 * 258 + 100, provider="Grok", json=body, headers=headers)
+    if error:
+        return error
+    try:
+        return {"same": json.loads(resp.json()["choices"][0]["message"]["content"])["same"] is True}
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+
+def analyze_many(items, rubric):
+    # Several photos in one call (utils/multigrade.py): the prompt is sent
+    # once, each photo after an "Image N:" label. Returns one result per
+    # photo, None where the reply skipped it, or one error dict for all.
+    headers = {
+        "Authorization": f"Bearer {GROK_KEY}",
+        "Content-Type": "application/json"
+    }
+    content = [{"type": "text", "text": multigrade.prompt(rubric, len(items))}]
+    with metrics.stage("encode"):
+        for number, (image, mime) in enumerate(items, 1):
+            content.append({"type": "text", "text": f"Image {number}:"})
+            content.append({"type": "image_url",
+                            "image_url": {"url": f"data:{mime};base64," + base64.b64encode(image).decode("ascii")}})
+    body = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": content}],
         "temperature": 0.3,
-        "max_tokens": 400
+        "max_tokens": 400 * len(items),
     }
-    url = "https://api.x.ai/v1/chat/completions"
+    if scoring.STRUCTURED_OUTPUT and rubric.categories:
+        body["response_format"] = {"type": "json_schema", "json_schema": {
+            "name": "grades", "strict": True, "schema": multigrade.json_schema(rubric.categories)}}
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+    resp, error = retry.post(url, LIMITER, multigrade.tokens(rubric, len(items)), provider="Grok",
+                             json=body, headers=headers)
+    if error:
+        return error
+    try:
+        text = resp.json()["choices"][0]["message"]["content"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+    return [reply and multigrade.as_result(reply) for reply in multigrade.split(text, len(items))]
 
-    resp = requests.post(url, json=payload, headers=headers)
-    
-    if resp.status_code == 200:
-        logging.info("Grok response received")
+def complete_text(prompt: str, rubric, fields=None):
+    # Small text-only call (no image), e.g. to repair one field of a reply
+    headers = {
+        "Authorization": f"Bearer {GROK_KEY}",
+        "Content-Type": "application/json"
+    }
+    body = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 400,
+        **structured_output(rubric, fields),
+    }
+    url = f"{GROK_BASE_URL}/v1/chat/completions"
+    resp, error = retry.post(url, LIMITER, len(prompt) // 4 + ratelimit.REPLY_TOKENS, provider="Grok",
+                             json=body, headers=headers)
+    if error:
+        return error
+    try:
         content = resp.json()["choices"][0]["message"]["content"]
-        # Return Gemini-compatible structure
-        return {"candidates": [{"content": {"parts": [{"text": content}]}}]}
-    else:
-        error = f"Grok error {resp.status_code}: {resp.text[:200]}"
-        logging.error(error)
-        return {"success": False, "details": error}
-
-def get_rubric() -> str:
-    return RUBRIC_TEXT
+    except (ValueError, KeyError, IndexError, TypeError):
+        return retry.error("bad_response")
+    return {"candidates": [{"content": {"parts": [{"text": content}]}}]}
+
+def get_rubric(rubric_id=None) -> str:
+    return rubrics.registry.get(rubric_id).text
@@ -0,0 +1,73 @@
+# tests/conftest.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Shared fixtures: the backend on sys.path, dummy API keys,
+# and tools/fake_provider.py running on a free port.
+#
+# Run from backend/:   python -m pytest -q tests
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("GROK_API_KEY", "test-key")
+
+
+class FakeProvider:
+    """A running tools/fake_provider.py: its base URL, /stats and raw requests."""
+
+    def __init__(self, url, process):
+        self.url = url
+        self.process = process
+
+    def stats(self):
+        with urllib.request.urlopen(f"{self.url}/stats") as resp:
+            return json.load(resp)
+
+    def delete(self, name):
+        urllib.request.urlopen(urllib.request.Request(f"{self.url}/v1beta/{name}", method="DELETE")).close()
+
+
+def start_fake_provider(*args):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND, "tools", "fake_provider.py"), "--port", str(port),
+         "--latency", "fixed:0", "--reply", "canned", *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    fake = FakeProvider(f"http://127.0.0.1:{port}", process)
+    for _ in range(100):
+        try:
+            fake.stats()
+            return fake
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("the fake provider did not start")
+
+
+@pytest.fixture
+def fake_provider(request, monkeypatch):
+    """A fresh fake provider with Gemini pointed at it. Extra flags: @pytest.mark.fake_args(...)."""
+    import aichecknew
+    marker = request.node.get_closest_marker("fake_args")
+    fake = start_fake_provider(*(marker.args if marker else ()))
+    monkeypatch.setattr(aichecknew, "GEMINI_BASE_URL", fake.url)
+    yield fake
+    fake.process.kill()
+    fake.process.wait()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "fake_args(*flags): extra tools/fake_provider.py flags")
@@ -0,0 +1,106 @@
+# tests/test_context_cache.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Cached rubric prompts (utils/context_cache.py) against the
+# fake provider's cachedContents endpoints.
+
+import time
+
+import pytest
+
+import aichecknew
+from utils import context_cache, rubrics
+
+IMAGE = b"\xff\xd8\xff" + bytes(2000)
+
+
+@pytest.fixture
+def prompt_cache(fake_provider, monkeypatch, tmp_path):
+    def make(ttl=3600, refresh_margin=300):
+        cache = context_cache.ContextCache(aichecknew.create_cached_prompt, aichecknew.refresh_cached_prompt,
+                                           enabled=True, ttl=ttl, refresh_margin=refresh_margin,
+                                           state_dir=str(tmp_path))
+        monkeypatch.setattr(aichecknew, "PROMPT_CACHE", cache)
+        return cache
+    return make
+
+
+def grade():
+    result = aichecknew.analyze_bytes(IMAGE, "image/jpeg")
+    assert "candidates" in result, result
+    return result
+
+
+def test_handle_created(fake_provider, prompt_cache):
+    cache = prompt_cache()
+    result = grade()
+    stats = fake_provider.stats()
+    assert stats["cache_creates"] == 1
+    assert stats["cache_hits"] == 1
+    assert result["usageMetadata"]["cachedContentTokenCount"] > 0
+    key = context_cache._key(rubrics.registry.get(), aichecknew.MODEL)
+    assert cache.stats()["handles"][key]["name"].startswith("cachedContents/")
+
+
+def test_handle_reused(fake_provider, prompt_cache):
+    prompt_cache()
+    grade()
+    grade()
+    stats = fake_provider.stats()
+    assert stats["cache_creates"] == 1
+    assert stats["cache_hits"] == 2
+    assert stats["cache_refreshes"] == 0
+
+
+def test_handle_shared_between_processes(fake_provider, prompt_cache):
+    # A second cache on the same state file (another worker) uses the same handle
+    prompt_cache()
+    grade()
+    prompt_cache()
+    grade()
+    assert fake_provider.stats()["cache_creates"] == 1
+
+
+def test_refreshed_near_expiry(fake_provider, prompt_cache):
+    cache = prompt_cache(ttl=4)   # extended once less than 2 s are left
+    grade()
+    key = context_cache._key(rubrics.registry.get(), aichecknew.MODEL)
+    name = cache.stats()["handles"][key]["name"]
+    time.sleep(2.5)
+    grade()
+    stats = fake_provider.stats()
+    assert stats["cache_refreshes"] == 1
+    assert stats["cache_creates"] == 1
+    assert stats["cache_hits"] == 2
+    assert cache.stats()["handles"][key]["name"] == name
+    assert cache.stats()["handles"][key]["expires"] > 3
+
+
+def test_gone_handle_falls_back_inline(fake_provider, prompt_cache):
+    cache = prompt_cache()
+    grade()
+    key = context_cache._key(rubrics.registry.get(), aichecknew.MODEL)
+    fake_provider.delete(cache.stats()["handles"][key]["name"])
+
+    result = grade()   # 403 for the handle, then the same call with the prompt inline
+    stats = fake_provider.stats()
+    assert stats["cache_misses"] == 1
+    assert stats["cache_hits"] == 1
+    assert result["usageMetadata"]["cachedContentTokenCount"] == 0
+    assert key not in cache.stats()["handles"]
+
+    grade()   # the next grade makes a new handle
+    assert fake_provider.stats()["cache_creates"] == 2
+
+
+@pytest.mark.fake_args("--cache-min-tokens", "100000")
+def test_prompt_inline_when_no_handle(fake_provider, prompt_cache):
+    cache = prompt_cache()
+    grade()
+    grade()   # not tried again before retry_after
+    stats = fake_provider.stats()
+    assert stats["cache_creates"] == 0
+    assert stats["cache_hits"] == 0
+    assert stats["ok"] == 2
+    key = context_cache._key(rubrics.registry.get(), aichecknew.MODEL)
+    assert cache.stats()["handles"][key]["retry_at"] > 0
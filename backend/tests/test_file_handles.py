@@ -0,0 +1,85 @@
+# tests/test_file_handles.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Uploaded photo handles (utils/file_handles.py) against the
+# fake provider's Files API.
+
+import pytest
+
+import aichecknew
+from utils import file_handles
+
+IMAGE = b"\xff\xd8\xff" + bytes(20000)
+
+
+@pytest.fixture
+def files(fake_provider, monkeypatch):
+    handles = file_handles.FileHandles(aichecknew.upload_file, enabled=True, min_bytes=1000)
+    monkeypatch.setattr(aichecknew, "FILES", handles)
+    return handles
+
+
+def grade(image=IMAGE):
+    result = aichecknew.analyze_bytes(image, "image/jpeg")
+    assert "candidates" in result, result
+    return result
+
+
+def test_uploaded_once_then_reused(fake_provider, files):
+    grade()
+    before = fake_provider.stats()
+    grade()
+    grade(bytes(IMAGE))   # same photo, another buffer
+    stats = fake_provider.stats()
+    assert stats["uploads"] == 1
+    assert stats["upload_bytes"] == len(IMAGE)
+    assert stats["file_refs"] == 3
+    # The calls after the upload carry the file URI, not the photo
+    assert stats["bytes_in"] - before["bytes_in"] < len(IMAGE) // 2
+    assert files.stats()["handles"] == 1
+
+
+@pytest.mark.fake_args("--error-rate", "0.5", "--seed", "1")
+def test_retries_reuse_the_handle(fake_provider, files):
+    for _ in range(4):
+        grade()
+    stats = fake_provider.stats()
+    assert stats["errors"] > 0
+    assert stats["uploads"] == 1
+    assert stats["file_refs"] == stats["requests"] - 2   # all but the upload's two requests
+
+
+def test_gone_file_is_sent_inline(fake_provider, files):
+    grade()
+    name = next(iter(files._entries.values()))[1]["name"]
+    fake_provider.delete(name)
+
+    grade()   # 403 for the file, then the same call with the photo inline
+    stats = fake_provider.stats()
+    assert stats["file_misses"] == 1
+    assert stats["file_refs"] == 1
+    assert stats["images"] == 2
+    assert files.stats()["handles"] == 0
+
+    grade()   # uploaded again
+    assert fake_provider.stats()["uploads"] == 2
+
+
+@pytest.mark.fake_args("--upload-error-rate", "1")
+def test_failed_upload_sends_inline(fake_provider, files):
+    grade()
+    grade()   # not tried again before retry_after
+    stats = fake_provider.stats()
+    assert stats["uploads"] == 0
+    assert stats["file_refs"] == 0
+    assert stats["images"] == 2
+    assert stats["ok"] == 2
+    assert stats["bytes_in"] > 2 * len(IMAGE)   # the photo went with each call
+    assert files.stats()["failed"] == 1
+
+
+def test_small_photos_inline(fake_provider, files):
+    grade(IMAGE[:500])
+    stats = fake_provider.stats()
+    assert stats["uploads"] == 0
+    assert stats["images"] == 1
@@ -0,0 +1,62 @@
+# tests/test_resumable.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Chunked upload sessions (utils/resumable.py): late chunks
+# and the files sweep() cleans up.
+
+import os
+import time
+
+import pytest
+
+from utils import resumable
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    return resumable.UploadSessions(str(tmp_path))
+
+
+def test_chunks_and_offsets(sessions):
+    upload_id = sessions.create(6, {"name": "Ann"})
+    assert sessions.append(upload_id, 0, b"abc") == 3
+    with pytest.raises(resumable.UploadError) as e:
+        sessions.append(upload_id, 0, b"abc")   # a retried chunk
+    assert (e.value.status, e.value.offset) == (409, 3)
+    sessions.append(upload_id, 3, b"def")
+    assert sessions.read(upload_id) == ({"name": "Ann"}, b"abcdef")
+
+
+def test_late_chunk_after_discard(sessions, tmp_path):
+    upload_id = sessions.create(6, {})
+    sessions.discard(upload_id)
+    with pytest.raises(resumable.UploadError) as e:
+        sessions.append(upload_id, 0, b"abc")
+    assert e.value.status == 404
+    assert os.listdir(tmp_path) == []
+
+
+def test_late_chunk_after_meta_removed(sessions, tmp_path):
+    # The .json goes first when an upload is discarded: a chunk in between is refused
+    upload_id = sessions.create(6, {})
+    meta = sessions._meta(upload_id)
+    os.remove(tmp_path / f"{upload_id}.json")
+    sessions._meta = lambda _: meta
+    with pytest.raises(resumable.UploadError) as e:
+        sessions.append(upload_id, 0, b"abc")
+    assert e.value.status == 404
+    assert os.path.getsize(tmp_path / f"{upload_id}.part") == 0
+
+
+def test_sweep_removes_orphan_parts(sessions, tmp_path):
+    kept = sessions.create(6, {})
+    orphan = tmp_path / f"{'0' * 32}.part"
+    orphan.write_bytes(b"abc")
+    fresh = tmp_path / f"{'1' * 32}.part"   # maybe an upload being created right now
+    fresh.write_bytes(b"")
+    old = time.time() - 3600
+    os.utime(orphan, (old, old))
+    sessions.sweep()
+    assert not orphan.exists()
+    assert fresh.exists()
+    assert sessions.status(kept)["offset"] == 0
@@ -0,0 +1,75 @@
+# tests/test_submissions.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: The submission store's score counts for /analytics
+# (utils/submissions.py): one counted grade per student.
+
+import os
+import sys
+
+import pytest
+
+from utils import rubrics, submissions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+from loadtest import sample_sketch  # noqa: E402
+
+
+def grade(total):
+    return {"total": total, "scores": [["Lines", total, 10]], "feedback": "ok"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return submissions.SubmissionStore(str(tmp_path))
+
+
+def totals(store):
+    rubric = rubrics.registry.get()
+    return store.counts(rubric.id, rubric.version)[1]
+
+
+def test_resubmission_replaces_count(store):
+    rubric = rubrics.registry.get()
+    store.save(b"first photo", "image/jpeg", "Ann", "ann@example.com", rubric, grade(3))
+    store.save(b"second photo", "image/jpeg", "Ann", "Ann@example.com", rubric, grade(9))
+    store.save(b"bob's photo", "image/jpeg", "Bob", "bob@example.com", rubric, grade(5))
+    assert totals(store) == {9: 1, 5: 1}
+    assert store.versions(rubric.id) == {rubric.version: 2}
+
+
+def test_failed_resubmission_keeps_last_grade(store):
+    rubric = rubrics.registry.get()
+    store.save(b"first photo", "image/jpeg", "Ann", "ann@example.com", rubric, grade(3))
+    store.save(b"second photo", "image/jpeg", "Ann", "ann@example.com", rubric, None, "overloaded")
+    assert totals(store) == {3: 1}
+
+    row_id = store.claim(rubric, before=float("inf"))[0]   # the failed one, regraded
+    store.update(row_id, rubric, grade(7))
+    assert totals(store) == {7: 1}
+
+
+def test_rows_without_email_count_separately(store):
+    rubric = rubrics.registry.get()
+    store.save(b"photo a", "image/jpeg", "a", "", rubric, grade(4))
+    store.save(b"photo b", "image/jpeg", "b", "", rubric, grade(4))
+    assert totals(store) == {4: 2}
+
+
+def test_recount_of_older_store(store, tmp_path):
+    rubric = rubrics.registry.get()
+    store.save(b"first photo", "image/jpeg", "Ann", "ann@example.com", rubric, grade(3))
+    store.save(b"second photo", "image/jpeg", "Ann", "ann@example.com", rubric, grade(9))
+    store._db().execute("DROP TABLE counted")
+    assert totals(submissions.SubmissionStore(str(tmp_path))) == {9: 1}
+
+
+def test_batch_resubmission_replaces_count(fake_provider, store, monkeypatch):
+    import appnew
+    monkeypatch.setattr(appnew, "submission_store", store)
+    rubric = rubrics.registry.get()
+    for _ in range(2):   # two different photos of the same student's, from two /batch runs
+        record = appnew.grade_record(sample_sketch(), "image/png", rubric, "Ann", "ann@example.com")
+        assert record["status"] == "graded", record
+    assert sum(totals(store).values()) == 1
+    assert store.summary()[rubric.id]["current"] == 2
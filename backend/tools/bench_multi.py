@@ -0,0 +1,96 @@
+# tools/bench_multi.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: One image per call vs. multi-image calls (utils/multigrade.py).
+#
+# Run from backend/:   python tools/bench_multi.py [-n 200] [-c 16] [--k 1,4,8]
+#
+# Starts tools/fake_provider.py and grades -n sample sketches from -c
+# concurrent clients through the Gemini provider, first one image per call
+# (k=1), then with the window batcher for each other k. Reports sketches
+# per second, latency, provider calls, and estimated tokens and cost per
+# sketch (prompt and reply characters / 4, plus ratelimit.IMAGE_TOKENS per
+# image, at --input-price / --output-price dollars per million tokens).
+# --fake-args "--image-latency 0.3" makes bigger calls slower, as real
+# ones are; "--drop-rate 0.05" exercises the single-call fallback.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from loadtest import BACKEND_DIR, free_port, sample_sketch, wait_ready  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=200, help="sketches per run")
+    parser.add_argument("-c", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--k", default="1,4,8", help="images per call to compare (1 = one per call)")
+    parser.add_argument("--window", type=float, default=0.2, help="seconds to wait for more images")
+    parser.add_argument("--fake-args", default="--latency lognormal:2.5,0.4 --reply canned",
+                        help="fake_provider.py options")
+    parser.add_argument("--input-price", type=float, default=0.30, help="$ per million input tokens")
+    parser.add_argument("--output-price", type=float, default=2.50, help="$ per million output tokens")
+    args = parser.parse_args()
+
+    port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, "tools", "fake_provider.py"), "--port", str(port)]
+        + args.fake_args.split(), cwd=BACKEND_DIR)
+    stats_url = f"http://127.0.0.1:{port}/stats"
+    try:
+        wait_ready(stats_url, fake)
+        os.environ.update(GEMINI_BASE_URL=f"http://127.0.0.1:{port}", GEMINI_API_KEY="bench",
+                          GROK_API_KEY=os.environ.get("GROK_API_KEY", "bench"), HEDGE="0")
+        import aichecknew
+        from utils import multigrade, ratelimit, router, rubrics
+        from utils.router import percentile
+
+        rubric = rubrics.registry.get()
+        image = sample_sketch()
+        print(f"{args.n} sketches, {args.c} clients, prompt {len(rubric.prompt)} chars, "
+              f"window {args.window:g} s, fake provider: {args.fake_args}")
+        print(f"{'k':>3} {'sketches/s':>11} {'p50 s':>7} {'p95 s':>7} {'calls':>6} "
+              f"{'in tok/sketch':>14} {'out tok/sketch':>15} {'$/1000 sketches':>16}")
+
+        for k in [int(v) for v in args.k.split(",")]:
+            provider = router.Provider("gemini", aichecknew.analyze_bytes, aichecknew.MODEL,
+                                       analyze_many=aichecknew.analyze_many)
+            grader = router.ProviderRouter([provider], max_workers=args.c)
+            batcher = multigrade.Batcher(grader.analyze_many, max_items=k, window=args.window) if k > 1 else None
+
+            def grade(_):
+                start = time.perf_counter()
+                result = batcher.submit(image, "image/jpeg", rubric).result() if batcher else None
+                if result is None:
+                    result = grader.analyze(image, "image/jpeg", rubric)
+                if "ai_error" in result:
+                    raise RuntimeError(result["ai_error"])
+                return time.perf_counter() - start
+
+            before = requests.get(stats_url).json()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.c) as pool:
+                latencies = list(pool.map(grade, range(args.n)))
+            elapsed = time.perf_counter() - start
+            after = requests.get(stats_url).json()
+            used = {key: after[key] - before[key] for key in ("requests", "images", "text_chars", "reply_chars")}
+
+            tokens_in = (used["text_chars"] / 4 + used["images"] * ratelimit.IMAGE_TOKENS) / args.n
+            tokens_out = used["reply_chars"] / 4 / args.n
+            cost = (tokens_in * args.input_price + tokens_out * args.output_price) / 1000
+            print(f"{k:>3} {args.n / elapsed:>11.2f} {percentile(latencies, 50):>7.2f} "
+                  f"{percentile(latencies, 95):>7.2f} {used['requests']:>6} "
+                  f"{tokens_in:>14.0f} {tokens_out:>15.0f} {cost:>16.3f}")
+    finally:
+        fake.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# tools/bench_phash.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Near-duplicate lookup time, BK-tree vs. comparing every hash.
+#
+# Run from backend/:   python tools/bench_phash.py [--hashes 50000] [--lookups 2000]
+#
+# Random 64-bit hashes stand in for a term's worth of uploads, spread over
+# --scopes students (the index keeps one tree per student + rubric version).
+# Half of the lookups are a stored hash with a few bits flipped (a
+# re-photographed sketch), half are unrelated. --scopes 1 shows one huge
+# tree: at the confirm distance a BK-tree over random hashes visits most
+# nodes, so it only pays off for the small per-student trees or small radii.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import phash  # noqa: E402
+
+
+def flip(value, bits):
+    for bit in random.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hashes", type=int, default=50000)
+    parser.add_argument("--scopes", type=int, default=500, help="students the hashes are spread over")
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--distance", type=int, default=phash.PHASH_CONFIRM_DISTANCE)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    stored = [[] for _ in range(args.scopes)]
+    for _ in range(args.hashes):
+        stored[random.randrange(args.scopes)].append(random.getrandbits(64))
+    trees = []
+    start = time.perf_counter()
+    for values in stored:
+        tree = phash.BKTree()
+        for i, value in enumerate(values):
+            tree.add(value, i)
+        trees.append(tree)
+    build = time.perf_counter() - start
+
+    queries = []
+    for i in range(args.lookups):
+        scope = random.randrange(args.scopes)
+        if i % 2 and stored[scope]:
+            queries.append((scope, flip(random.choice(stored[scope]), random.randint(0, 4))))
+        else:
+            queries.append((scope, random.getrandbits(64)))
+
+    start = time.perf_counter()
+    tree_hits = sum(bool(trees[scope].search(q, args.distance)) for scope, q in queries)
+    tree_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scan_hits = sum(any(phash.distance(q, v) <= args.distance for v in stored[scope]) for scope, q in queries)
+    scan_time = time.perf_counter() - start
+
+    print(f"{args.hashes} hashes in {args.scopes} scopes, {args.lookups} lookups, max distance {args.distance}")
+    print(f"  build      {build:8.2f} s")
+    print(f"  BK-tree    {tree_time / args.lookups * 1000:8.3f} ms/lookup  ({tree_hits} matches)")
+    print(f"  full scan  {scan_time / args.lookups * 1000:8.3f} ms/lookup  ({scan_hits} matches)")
+
+
+if __name__ == "__main__":
+    main()
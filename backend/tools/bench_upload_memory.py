@@ -0,0 +1,121 @@
+# tools/bench_upload_memory.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Peak memory per request, old upload path vs. in-memory path.
+#
+# Run from backend/:   python tools/bench_upload_memory.py [--mb 10]
+#
+# Each path runs in a fresh Python process, so ru_maxrss (peak RSS) is not
+# polluted by the other run. Nothing is sent over the network: the request
+# body is built and then read out block by block, the way urllib3 sends it.
+
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+PROMPT = "Grade the attached hand-drawn floor plan according to the rubric above. " * 40
+
+
+def _rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _multipart_environ(size):
+    from werkzeug.test import EnvironBuilder
+    import io
+    builder = EnvironBuilder(
+        method="POST",
+        data={"name": "A", "email": "a@b.c", "image": (io.BytesIO(os.urandom(size)), "photo.jpg")},
+    )
+    env = builder.get_environ()
+    # Materialize the body once, so both paths start from the same bytes.
+    body = env["wsgi.input"].read()
+    env["wsgi.input"] = io.BytesIO(body)
+    return env
+
+
+def _drain(body):
+    # What urllib3 does with a file-like body: read fixed-size blocks.
+    while body.read(64 * 1024):
+        pass
+
+
+def run_old(env):
+    # Baseline: temp file, base64 str, dict, json= serialization.
+    import requests
+    from flask import Request
+    req = Request(env)
+    file = req.files["image"]
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
+    file.save(tmp.name)
+    try:
+        with open(tmp.name, "rb") as f:
+            encoded = base64.b64encode(f.read()).decode("utf-8")
+        payload = {"contents": [{"parts": [
+            {"text": PROMPT},
+            {"inline_data": {"mime_type": "image/jpeg", "data": encoded}},
+        ]}]}
+        prepared = requests.Request("POST", "https://example.invalid/", json=payload).prepare()
+        _ = len(prepared.body)
+    finally:
+        os.unlink(tmp.name)
+
+
+def run_new(env):
+    import requests
+    from utils import payload
+    req = payload.InMemoryRequest(env)
+    image = payload.upload_bytes(req.files["image"])
+    template = payload.JsonTemplate({"contents": [{"parts": [
+        {"text": PROMPT},
+        {"inline_data": {"mime_type": payload.MIME, "data": payload.IMAGE}},
+    ]}]})
+    body = template.render("image/jpeg", image)
+    prepared = requests.Request("POST", "https://example.invalid/", data=body).prepare()
+    _drain(prepared.body)
+
+
+def child(mode, size):
+    env = _multipart_environ(size)
+    import requests, flask  # noqa: F401  (load libraries before the baseline)
+    from utils import payload  # noqa: F401
+    before = _rss_kb()
+    {"old": run_old, "new": run_new}[mode](env)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "baseline_kb": before, "peak_kb": peak, "delta_kb": peak - before}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS per request, old vs. in-memory upload path")
+    parser.add_argument("--mb", type=float, default=10, help="upload size in MB (default 10)")
+    parser.add_argument("--child", choices=["old", "new"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = int(args.mb * 1024 * 1024)
+    if args.child:
+        child(args.child, size)
+        return
+
+    print(f"Upload size: {size / 1024 / 1024:.1f} MB")
+    for mode in ("old", "new"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--mb", str(args.mb), "--child", mode],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        r = json.loads(out)
+        print(f"{mode:>4}: peak RSS {r['peak_kb'] / 1024:7.1f} MB, "
+              f"+{r['delta_kb'] / 1024:6.1f} MB over baseline for one request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,510 @@
+# tools/fake_provider.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Local stand-in for the Gemini and xAI (Grok) APIs, for load tests.
+#
+# Run from backend/:   python tools/fake_provider.py [--port 8099] [--latency lognormal:2.5,0.4]
+# Then start the backend with
+#   GEMINI_BASE_URL=http://127.0.0.1:8099 GROK_BASE_URL=http://127.0.0.1:8099
+#
+# Serves POST /v1/models/<model>:generateContent (and /v1beta/...) and
+# POST /v1/chat/completions, plus their streaming forms
+# (:streamGenerateContent?alt=sse, "stream": true). Each call sleeps for a
+# sampled latency, may fail with a 5xx or a 429 (with Retry-After), and
+# otherwise answers with grading JSON for the default rubric's categories
+# ({"same": true} for near-duplicate checks, {"grades": [...]} with one
+# entry per image for multi-image calls; --drop-rate leaves some out).
+# Replies carry token usage (usageMetadata / usage). Cascade first-tier
+# calls (models named *-lite or *-fast*) also get a confidence per category,
+# below 0.5 in --low-confidence-rate of them, after --fast-latency.
+# Streams send the reply a few characters at a time. GET /stats shows counts.
+#
+# Context caching (utils/context_cache.py): POST /v1beta/cachedContents
+# stores a prompt for "ttl" seconds (refused below --cache-min-tokens, as
+# the real API refuses small prompts), PATCH .../cachedContents/<id>
+# extends it, GET and DELETE work too. A generateContent call naming an
+# unknown or expired "cachedContent" gets a 403, as from Gemini; one with a
+# live handle reports the cached tokens in usageMetadata.
+#
+# Files (utils/file_handles.py): POST /upload/v1beta/files starts a
+# resumable upload and the returned X-Goog-Upload-URL takes the bytes
+# ("upload, finalize"); the file lives --file-ttl seconds, and GET and
+# DELETE /v1beta/files/<id> work. A call naming an unknown or expired
+# file_data URI gets a 403, as from Gemini. --upload-error-rate refuses
+# some uploads with a 503.
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+FEEDBACK = [
+    "Clear floor plan with labeled rooms. Add a scale bar and a north arrow next time.",
+    "Good sketch and description. Some room dimensions are missing.",
+    "Nice work overall; the comparison with a professional plan is a bit short.",
+]
+GENERATE_RE = re.compile(r"^/v1(beta)?/models/[^/:]+:generateContent$")
+STREAM_RE = re.compile(r"^/v1(beta)?/models/[^/:]+:streamGenerateContent$")
+CACHED_RE = re.compile(r"^/v1beta/(cachedContents/[^/:]+)$")
+FILE_RE = re.compile(r"^/v1beta/(files/[^/:]+)$")
+
+
+def parse_latency(spec):
+    """
+    "fixed:S", "uniform:LO,HI" or "lognormal:MEDIAN,SIGMA" (seconds) -> a
+    function returning one sample.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(*values)
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise argparse.ArgumentTypeError(f"bad latency spec: {spec}")
+
+
+def default_categories():
+    try:
+        from utils import rubrics
+        categories = [(key, top) for key, _, top in rubrics.registry.get().categories]
+    except Exception:
+        categories = []
+    return categories or [("sketch", 25), ("description", 25), ("dimensions", 25),
+                          ("scale", 10), ("compass", 10), ("differences", 5)]
+
+
+class FakeProvider:
+    def __init__(self, args):
+        self.args = args
+        self.latency = args.latency
+        self.categories = default_categories()
+        self.counts = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "malformed": 0, "bytes_in": 0,
+                       "images": 0, "text_chars": 0, "reply_chars": 0, "dropped": 0,
+                       "cache_creates": 0, "cache_refreshes": 0, "cache_hits": 0, "cache_misses": 0,
+                       "cached_chars": 0, "uploads": 0, "upload_bytes": 0, "file_refs": 0, "file_misses": 0}
+        self.caches = {}   # "cachedContents/<id>" -> {"model", "text", "expires"}
+        self.uploads = {}  # upload id -> {"size", "mime"}
+        self.files = {}    # "files/<id>" -> {"size", "mime", "expires"}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def cached(self, name):
+        """The live cache entry called name, or None."""
+        with self._lock:
+            entry = self.caches.get(name)
+            if entry is not None and entry["expires"] <= time.time():
+                del self.caches[name]
+                entry = None
+        return entry
+
+    def file(self, name):
+        """The live file called name, or None."""
+        with self._lock:
+            entry = self.files.get(name)
+            if entry is not None and entry["expires"] <= time.time():
+                del self.files[name]
+                entry = None
+        return entry
+
+    def grade_text(self, body):
+        """Grading JSON. A repair call asks for some fields only (see the schema)."""
+        if is_compare(body):
+            return json.dumps({"same": True})
+        if is_multi(body):
+            grades = []
+            for number in range(1, count_images(body) + 1):
+                if random.random() < self.args.drop_rate:
+                    self.count("dropped")
+                    continue
+                grades.append(dict(json.loads(self.grade_text({})), image=number))
+            return json.dumps({"grades": grades})
+        fields = wanted_fields(body)
+        if wants_confidence(body):
+            low = random.random() < self.args.low_confidence_rate
+            data = json.loads(self.grade_text({}))
+            data["confidence"] = {key: round(random.uniform(0.2, 0.5) if low else random.uniform(0.8, 1.0), 2)
+                                  for key, _ in self.categories}
+            return json.dumps(data)
+        scores = {}
+        for key, top in self.categories:
+            if fields is None or key in fields:
+                scores[key] = top if self.args.reply == "canned" else random.randint(top // 2, top)
+        data = {"scores": scores}
+        if fields is None or "feedback" in fields:
+            data["feedback"] = FEEDBACK[0] if self.args.reply == "canned" else random.choice(FEEDBACK)
+        if fields is None and scores and random.random() < self.args.malformed_rate:
+            # One out-of-range score: exercises the single-field repair path.
+            self.count("malformed")
+            data["scores"][random.choice(list(scores))] = 999
+        return json.dumps(data)
+
+
+def is_compare(body):
+    """A near-duplicate check ("same sketch?") rather than a grade."""
+    schema = (body.get("generationConfig") or {}).get("responseSchema") \
+        or ((body.get("response_format") or {}).get("json_schema") or {}).get("schema") or {}
+    return "same" in schema.get("properties", {})
+
+
+def is_multi(body):
+    """A multi-image grade (utils/multigrade.py)."""
+    schema = (body.get("generationConfig") or {}).get("responseSchema") \
+        or ((body.get("response_format") or {}).get("json_schema") or {}).get("schema") or {}
+    return "grades" in schema.get("properties", {}) or "Image 1:" in request_text(body)
+
+
+def wants_confidence(body):
+    """A cascade first-tier grade (utils/cascade.py)."""
+    schema = (body.get("generationConfig") or {}).get("responseSchema") \
+        or ((body.get("response_format") or {}).get("json_schema") or {}).get("schema") or {}
+    return "confidence" in schema.get("properties", {})
+
+
+def is_fast_model(path, body):
+    model = body.get("model") or path.rsplit("/", 1)[-1].split(":")[0]
+    return model.endswith("-lite") or "-fast" in model
+
+
+def parse_ttl(ttl):
+    # "3600s" (a protobuf Duration) -> seconds
+    try:
+        return float(str(ttl or "3600s").rstrip("s"))
+    except ValueError:
+        return 3600.0
+
+
+def cache_resource(name, entry):
+    expire = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry["expires"]))
+    return {"name": name, "model": entry["model"], "expireTime": expire,
+            "usageMetadata": {"totalTokenCount": len(entry["text"]) // 4}}
+
+
+def file_resource(name, entry, base):
+    expire = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry["expires"]))
+    return {"name": name, "uri": f"{base}/v1beta/{name}", "mimeType": entry["mime"],
+            "sizeBytes": str(entry["size"]), "state": "ACTIVE", "expirationTime": expire}
+
+
+def file_uris(body):
+    return [part["file_data"].get("file_uri") or "" for part in parts(body) if "file_data" in part]
+
+
+def parts(body):
+    # Gemini parts or chat completion content items, flattened
+    for content in body.get("contents") or []:
+        yield from content.get("parts") or []
+    for message in body.get("messages") or []:
+        content = message.get("content")
+        yield from ([{"text": content}] if isinstance(content, str) else content or [])
+
+
+def count_images(body):
+    return sum(1 for part in parts(body) if "inline_data" in part or "file_data" in part or "image_url" in part)
+
+
+def request_text(body):
+    return "".join(part.get("text") or "" for part in parts(body))
+
+
+def wanted_fields(body):
+    """Fields the response schema asks for, or None for a full grade."""
+    schema = (body.get("generationConfig") or {}).get("responseSchema") \
+        or ((body.get("response_format") or {}).get("json_schema") or {}).get("schema")
+    if not schema:
+        return None
+    props = schema.get("properties", {})
+    fields = set(props.get("scores", {}).get("properties", {}))
+    if "feedback" in props:
+        fields.add("feedback")
+    return fields
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, like the real APIs
+    fake = None
+
+    def log_message(self, fmt, *args):
+        if self.fake.args.verbose:
+            super().log_message(fmt, *args)
+
+    def _send(self, status, data, headers=None):
+        raw = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _stream(self, pieces):
+        # SSE over chunked transfer encoding, one event per piece
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, data in enumerate(pieces):
+            if i:
+                time.sleep(self.fake.args.token_interval)
+            raw = f"data: {data}\r\n\r\n".encode("utf-8")
+            self.wfile.write(f"{len(raw):x}\r\n".encode("ascii") + raw + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/stats":
+            with self.fake._lock:
+                stats = dict(self.fake.counts, max_in_flight=self.fake.max_in_flight,
+                             live_caches=len(self.fake.caches), live_files=len(self.fake.files))
+            self._send(200, stats)
+        elif FILE_RE.match(path):
+            name = FILE_RE.match(path).group(1)
+            entry = self.fake.file(name)
+            if entry is None:
+                return self._file_missing(name)
+            self._send(200, file_resource(name, entry, self._base()))
+        elif CACHED_RE.match(path):
+            name = CACHED_RE.match(path).group(1)
+            entry = self.fake.cached(name)
+            if entry is None:
+                return self._cache_missing()
+            self._send(200, cache_resource(name, entry))
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_PATCH(self):
+        # Only the ttl can be changed (?updateMask=ttl)
+        path = self.path.split("?", 1)[0]
+        body = self._json_body()
+        match = CACHED_RE.match(path)
+        if match is None or body is None:
+            return self._send(404, {"error": {"message": f"unknown endpoint {path}"}})
+        name = match.group(1)
+        entry = self.fake.cached(name)
+        if entry is None:
+            return self._cache_missing()
+        entry["expires"] = time.time() + parse_ttl(body.get("ttl"))
+        self.fake.count("cache_refreshes")
+        self._send(200, cache_resource(name, entry))
+
+    def do_DELETE(self):
+        path = self.path.split("?", 1)[0]
+        match = CACHED_RE.match(path) or FILE_RE.match(path)
+        if match is None:
+            return self._send(404, {"error": {"message": f"unknown endpoint {path}"}})
+        with self.fake._lock:
+            self.fake.caches.pop(match.group(1), None)
+            self.fake.files.pop(match.group(1), None)
+        self._send(200, {})
+
+    def _json_body(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return None
+
+    def _cache_missing(self):
+        self._send(403, {"error": {"code": 403, "message": "CachedContent not found (or permission denied)",
+                                   "status": "PERMISSION_DENIED"}})
+
+    def _file_missing(self, name):
+        self._send(403, {"error": {"code": 403, "status": "PERMISSION_DENIED", "message":
+                                   f"You do not have permission to access the File {name} or it may not exist."}})
+
+    def _base(self):
+        return f"http://{self.headers.get('Host') or 'localhost'}"
+
+    def _upload(self, raw):
+        # Resumable upload: "start" hands out an upload URL, "upload, finalize" takes the bytes
+        fake = self.fake
+        command = self.headers.get("X-Goog-Upload-Command") or ""
+        if command == "start":
+            if random.random() < fake.args.upload_error_rate:
+                fake.count("errors")
+                return self._send(503, {"error": {"message": "The service is currently unavailable"}})
+            upload_id = uuid.uuid4().hex[:16]
+            with fake._lock:
+                fake.uploads[upload_id] = {
+                    "size": int(self.headers.get("X-Goog-Upload-Header-Content-Length") or 0),
+                    "mime": self.headers.get("X-Goog-Upload-Header-Content-Type") or "application/octet-stream",
+                }
+            return self._send(200, {}, {"X-Goog-Upload-URL": f"{self._base()}/upload/v1beta/files?upload_id={upload_id}",
+                                        "X-Goog-Upload-Status": "active"})
+        upload_id = (self.path.split("upload_id=", 1) + [""])[1].split("&")[0]
+        with fake._lock:
+            upload = fake.uploads.pop(upload_id, None)
+        if upload is None or "finalize" not in command or len(raw) != upload["size"]:
+            return self._send(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                              "message": "Failed to finalize the upload"}})
+        name = f"files/{uuid.uuid4().hex[:12]}"
+        entry = dict(upload, expires=time.time() + fake.args.file_ttl)
+        with fake._lock:
+            fake.files[name] = entry
+        fake.count("uploads")
+        fake.count("upload_bytes", len(raw))
+        self._send(200, {"file": file_resource(name, entry, self._base())}, {"X-Goog-Upload-Status": "final"})
+
+    def _create_cache(self, body):
+        fake = self.fake
+        text = request_text(body)
+        if not body.get("model") or len(text) // 4 < fake.args.cache_min_tokens:
+            return self._send(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message":
+                                              f"Cached content is too small. total_token_count={len(text) // 4}, "
+                                              f"min_total_token_count={fake.args.cache_min_tokens}"}})
+        name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+        entry = {"model": body["model"], "text": text, "expires": time.time() + parse_ttl(body.get("ttl"))}
+        with fake._lock:
+            fake.caches[name] = entry
+        fake.count("cache_creates")
+        self._send(200, cache_resource(name, entry))
+
+    def do_POST(self):
+        fake = self.fake
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        path = self.path.split("?", 1)[0]
+        fake.count("requests")
+        fake.count("bytes_in", len(raw))
+        if path == "/upload/v1beta/files":
+            return self._upload(raw)
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            return self._send(400, {"error": {"message": "invalid JSON"}})
+        if path == "/v1beta/cachedContents":
+            return self._create_cache(body)
+
+        cached_text = ""
+        if body.get("cachedContent"):
+            entry = fake.cached(body["cachedContent"])
+            if entry is None or not path.startswith("/v1beta/"):
+                fake.count("cache_misses")
+                return self._cache_missing()
+            cached_text = entry["text"]
+            fake.count("cache_hits")
+            fake.count("cached_chars", len(cached_text))
+            # The handle's prompt comes first, as if it had been sent inline
+            body = dict(body, contents=[{"parts": [{"text": cached_text}]}] + list(body.get("contents") or []))
+
+        for uri in file_uris(body):
+            name = uri.split("/v1beta/", 1)[-1]
+            if fake.file(name) is None or not path.startswith("/v1beta/"):
+                fake.count("file_misses")
+                return self._file_missing(name)
+            fake.count("file_refs")
+
+        images = count_images(body)
+        fake.count("images", images)
+        fake.count("text_chars", len(request_text(body)) - len(cached_text))
+        with fake._lock:
+            fake.in_flight += 1
+            fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+        try:
+            latency = fake.args.fast_latency if fake.args.fast_latency and is_fast_model(path, body) else fake.latency
+            time.sleep(max(0.0, latency() + fake.args.image_latency * max(0, images - 1)))
+            roll = random.random()
+            if roll < fake.args.rate_limit_rate:
+                fake.count("rate_limited")
+                return self._send(429, {"error": {"message": "Resource exhausted"}},
+                                  {"Retry-After": str(fake.args.retry_after)})
+            if roll < fake.args.rate_limit_rate + fake.args.error_rate:
+                fake.count("errors")
+                return self._send(503, {"error": {"message": "The model is overloaded"}})
+
+            text = fake.grade_text(body)
+            fake.count("reply_chars", len(text))
+            tokens_in, tokens_out = len(request_text(body)) // 4 + 258 * images, len(text) // 4
+            size = fake.args.chunk_chars
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            if STREAM_RE.match(path):
+                fake.count("ok")
+                return self._stream(
+                    json.dumps({"candidates": [{"content": {"parts": [{"text": chunk}], "role": "model"}}]})
+                    for chunk in chunks
+                )
+            if path == "/v1/chat/completions" and body.get("stream"):
+                fake.count("ok")
+                events = [json.dumps({"choices": [{"index": 0, "delta": {"content": chunk}}]}) for chunk in chunks]
+                return self._stream(events + ["[DONE]"])
+            if GENERATE_RE.match(path):
+                fake.count("ok")
+                return self._send(200, {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"},
+                                                        "finishReason": "STOP"}],
+                                        "usageMetadata": {"promptTokenCount": tokens_in,
+                                                          "candidatesTokenCount": tokens_out,
+                                                          "cachedContentTokenCount": len(cached_text) // 4}})
+            if path == "/v1/chat/completions":
+                fake.count("ok")
+                return self._send(200, {"choices": [{"index": 0, "finish_reason": "stop",
+                                                     "message": {"role": "assistant", "content": text}}],
+                                        "usage": {"prompt_tokens": tokens_in, "completion_tokens": tokens_out}})
+            self._send(404, {"error": {"message": f"unknown endpoint {path}"}})
+        finally:
+            with fake._lock:
+                fake.in_flight -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini / xAI endpoints for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("lognormal:2.5,0.4"),
+                        help="fixed:S | uniform:LO,HI | lognormal:MEDIAN,SIGMA, in seconds "
+                             "(default lognormal:2.5,0.4)")
+    parser.add_argument("--fast-latency", type=parse_latency,
+                        help="latency of cascade first-tier models (default: --latency)")
+    parser.add_argument("--low-confidence-rate", type=float, default=0.0,
+                        help="fraction of first-tier grades with low confidence")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 answers")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of 429 answers")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on 429s")
+    parser.add_argument("--reply", choices=["random", "canned"], default="random",
+                        help="random scores, or full marks every time")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="fraction of grades with one out-of-range score")
+    parser.add_argument("--image-latency", type=float, default=0.0,
+                        help="extra seconds per image after the first (multi-image calls)")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="fraction of images left out of multi-image replies")
+    parser.add_argument("--cache-min-tokens", type=int, default=0,
+                        help="refuse to cache prompts under this many tokens (Gemini: 1024 or more)")
+    parser.add_argument("--upload-error-rate", type=float, default=0.0, help="fraction of file uploads refused")
+    parser.add_argument("--file-ttl", type=float, default=48 * 3600, help="seconds an uploaded file lives")
+    parser.add_argument("--chunk-chars", type=int, default=16, help="characters per streamed chunk")
+    parser.add_argument("--token-interval", type=float, default=0.05, help="seconds between streamed chunks")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    Handler.fake = FakeProvider(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Fake provider on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# tools/loadtest.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Load test for POST /submit, against tools/fake_provider.py.
+#
+# Run from backend/:
+#   python tools/loadtest.py --spawn appnew -c 16 -n 200
+#   python tools/loadtest.py --spawn asgi -c 300 -n 3000
+#   python tools/loadtest.py --url http://127.0.0.1:5000 --pid 1234 -c 16 -n 200
+#
+# --spawn starts the fake provider and the backend (app or appnew, under
+# gunicorn with --workers if installed, else the Flask server; asgi under
+# one uvicorn process) pointed at it.
+# Each request uploads a sample sketch, made unique so the grading cache
+# can't answer it (--repeat allows cache hits). Reports p50/p95/p99 latency,
+# throughput, error rate and peak worker RSS; --json FILE appends the result
+# with the git commit, to compare runs between commits.
+
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.router import percentile  # noqa: E402
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def sample_sketch():
+    """A plain floor-plan-like JPEG (~1600x1200), or random bytes without Pillow."""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return os.urandom(300 * 1024)
+    img = Image.new("RGB", (1600, 1200), "white")
+    draw = ImageDraw.Draw(img)
+    for box in [(100, 100, 800, 600), (800, 100, 1500, 600), (100, 600, 1500, 1100)]:
+        draw.rectangle(box, outline="black", width=6)
+    for _ in range(40):
+        x, y = random.randrange(120, 1400), random.randrange(120, 1000)
+        draw.line((x, y, x + random.randrange(20, 120), y + random.randrange(-10, 10)), fill="gray", width=3)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+def load_samples(folder):
+    if not folder:
+        return [("sketch.jpg", sample_sketch())]
+    samples = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png")):
+            with open(os.path.join(folder, name), "rb") as f:
+                samples.append((name, f.read()))
+    if not samples:
+        sys.exit(f"No JPG/PNG files in {folder}")
+    return samples
+
+
+def rss_kb(pids):
+    """Total RSS of the given processes and all their children."""
+    total = 0
+    seen = set()
+    todo = list(pids)
+    while todo:
+        pid = todo.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                todo.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pids, interval=0.2):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.peak = 0
+        self.start_kb = rss_kb(pids) if pids else 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, rss_kb(self.pids))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.start_kb, max(self.peak, self.start_kb)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"{' '.join(proc.args)} exited with {proc.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    sys.exit(f"{url} did not come up in {timeout}s")
+
+
+def spawn(args):
+    """Start the fake provider and the backend. Returns (backend url, backend pid, processes)."""
+    fake_port, app_port = free_port(), free_port()
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, "tools", "fake_provider.py"), "--port", str(fake_port)]
+        + args.fake_args.split(),
+        cwd=BACKEND_DIR,
+    )
+    wait_ready(f"http://127.0.0.1:{fake_port}/stats", fake)
+    env = dict(
+        os.environ,
+        GEMINI_BASE_URL=f"http://127.0.0.1:{fake_port}",
+        GROK_BASE_URL=f"http://127.0.0.1:{fake_port}",
+        GEMINI_API_KEY=os.environ.get("GEMINI_API_KEY", "fake"),
+        GROK_API_KEY=os.environ.get("GROK_API_KEY", "fake"),
+        PORT=str(app_port),
+    )
+    if args.spawn == "asgi":
+        cmd = [sys.executable, "-m", "uvicorn", "--host", "127.0.0.1", "--port", str(app_port),
+               "--no-access-log", "asgi:app"]
+    else:
+        try:
+            import gunicorn  # noqa: F401
+            cmd = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{app_port}", "-w", str(args.workers),
+                   "--threads", str(args.threads), f"{args.spawn}:app"]
+        except ImportError:
+            cmd = [sys.executable, "-c",
+                   f"from {args.spawn} import app; app.run(host='127.0.0.1', port={app_port}, threaded=True)"]
+    app = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env,
+                           stdout=subprocess.DEVNULL if not args.verbose else None,
+                           stderr=subprocess.DEVNULL if not args.verbose else None)
+    url = f"http://127.0.0.1:{app_port}"
+    wait_ready(url + "/", app)
+    return url, app.pid, [app, fake]
+
+
+def one_request(session, args, samples, index):
+    name, image = samples[index % len(samples)]
+    if not args.repeat:
+        # Bytes after the JPEG end marker are ignored by decoders but change the hash.
+        image = image + os.urandom(16)
+    data = {"name": f"Student {index}", "email": f"s{index}@example.edu"}
+    if args.job:
+        data["mode"] = "job"
+    start = time.monotonic()
+    try:
+        resp = session.post(args.url + "/submit", data=data, files={"image": (name, image)}, timeout=args.timeout)
+        ok = resp.status_code in (200, 202)
+        if ok and args.job:
+            status_url = args.url + resp.json()["status_url"]
+            while True:
+                job = session.get(status_url, timeout=args.timeout).json()
+                if job.get("status") in ("done", "error"):
+                    ok = job["status"] == "done" and args.error_marker not in (job.get("html") or "")
+                    break
+                time.sleep(0.1)
+        elif ok:
+            ok = args.error_marker not in resp.text
+        status = resp.status_code
+    except requests.RequestException as e:
+        ok, status = False, type(e).__name__
+    return time.monotonic() - start, ok, status
+
+
+def run(args, samples, pids):
+    sessions = threading.local()
+
+    def task(index):
+        if not hasattr(sessions, "s"):
+            sessions.s = requests.Session()
+        return one_request(sessions.s, args, samples, index)
+
+    sampler = MemorySampler(pids)
+    sampler.start()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(task, range(args.requests)))
+    elapsed = time.monotonic() - start
+    rss_start, rss_peak = sampler.stop()
+
+    latencies = [latency for latency, ok, _ in results if ok]
+    statuses = {}
+    for _, ok, status in results:
+        if not ok:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(results),
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "error_rate": round(1 - len(latencies) / len(results), 4),
+        "errors": statuses,
+        "p50": round(percentile(latencies, 50), 3) if latencies else None,
+        "p95": round(percentile(latencies, 95), 3) if latencies else None,
+        "p99": round(percentile(latencies, 99), 3) if latencies else None,
+        "rss_start_mb": round(rss_start / 1024, 1) if pids else None,
+        "rss_peak_mb": round(rss_peak / 1024, 1) if pids else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test POST /submit")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://127.0.0.1:5000", help="backend to test")
+    target.add_argument("--spawn", choices=["app", "appnew", "asgi"], help="start fake provider + this backend")
+    parser.add_argument("--pid", type=int, action="append", default=[],
+                        help="backend process to measure RSS of (with children); repeatable")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-n", "--requests", type=int, default=100)
+    parser.add_argument("--images", help="folder of sample sketches (default: a generated one)")
+    parser.add_argument("--repeat", action="store_true", help="send identical bytes (allows cache hits)")
+    parser.add_argument("--job", action="store_true", help="use mode=job and poll until done (appnew)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--error-marker", default="try again",
+                        help="a 200 response containing this text counts as an error")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers with --spawn")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker with --spawn")
+    parser.add_argument("--fake-args", default="", help='extra fake_provider.py options, e.g. "--error-rate 0.05"')
+    parser.add_argument("--label", help="name for this run in --json output (default: git commit)")
+    parser.add_argument("--json", help="append the result as one JSON line to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the spawned backend's output")
+    args = parser.parse_args()
+
+    procs = []
+    pids = list(args.pid)
+    if args.spawn:
+        args.url, pid, procs = spawn(args)
+        pids.append(pid)
+    args.url = args.url.rstrip("/")
+    try:
+        samples = load_samples(args.images)
+        result = run(args, samples, pids)
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+    result = dict(label=args.label or git_commit(), target=args.spawn or args.url, **result)
+    print(f"{result['requests']} requests, concurrency {result['concurrency']}, {result['seconds']}s")
+    print(f"  throughput  {result['throughput_rps']} req/s")
+    print(f"  latency     p50 {result['p50']}s  p95 {result['p95']}s  p99 {result['p99']}s")
+    print(f"  errors      {result['error_rate']:.2%} {result['errors'] or ''}")
+    if result["rss_peak_mb"] is not None:
+        print(f"  worker RSS  {result['rss_start_mb']} MB at start, {result['rss_peak_mb']} MB peak")
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
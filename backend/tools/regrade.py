@@ -0,0 +1,42 @@
+# tools/regrade.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Regrade stored submissions from the command line (utils/submissions.py).
+#
+# Run from backend/, with the same environment as the app:
+#   python tools/regrade.py [--rubric ID] [-c 2] [--dry-run]
+#
+# Grades again every stored submission that was graded under an older
+# version of its rubric, or failed, and prints the counts before and after.
+# Same as POST /regrade, but in the foreground. Safe to stop and run again:
+# finished submissions are not regraded.
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rubric", help="only this assignment (default: all)")
+    parser.add_argument("-c", "--concurrency", type=int, help="regrades at once (default REGRADE_CONCURRENCY)")
+    parser.add_argument("--dry-run", action="store_true", help="only show what is out of date")
+    args = parser.parse_args()
+
+    import appnew
+    if appnew.regrader is None:
+        sys.exit("The submission store is turned off (SUBMISSION_STORE=0)")
+    print(json.dumps(appnew.submission_store.summary(), indent=2))
+    if args.dry_run:
+        return
+    run = appnew.regrader.run([args.rubric] if args.rubric else None, args.concurrency)
+    print(f"{run['regraded']} regraded, {run['failed']} failed "
+          f"in {run['finished'] - run['started']:.1f} s")
+    print(json.dumps(appnew.submission_store.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# utils/admission.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Admission control for grades: how many run at once, how
+# many may wait, and a quick 503 for the rest.
+#
+# When a provider slows down, grades used to pile up until gunicorn's
+# worker timeout killed them, and the student saw a generic error after
+# waiting the whole time. Now at most ADMISSION_MAX_IN_FLIGHT grades per
+# process (and ADMISSION_MAX_TOTAL across all processes on the machine, if
+# set) run at once. Up to ADMISSION_QUEUE more wait in line, first come
+# first served, for at most ADMISSION_MAX_WAIT seconds. Anything beyond
+# that is turned away at once with Overloaded, which /submit answers with a
+# 503 and a Retry-After: (requests ahead + 1) x the recent grade time
+# / the slots. A request whose estimated wait is already over
+# ADMISSION_MAX_WAIT is turned away right away too, instead of timing out
+# in line (once some grades have been timed). Background grades (jobs,
+# batch items, regrades) take the same slots but wait their turn instead
+# of failing (wait()), so every provider call counts against the cap.
+#
+# The cross-process count is a small JSON file {pid: grades running},
+# locked with flock like the rate limiter's buckets; dead processes' entries
+# are dropped.
+
+import asyncio
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from utils import metrics
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "8"))   # per process, 0 = no admission control
+ADMISSION_MAX_TOTAL = int(os.environ.get("ADMISSION_MAX_TOTAL", "0"))           # all processes, 0 = no shared cap
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", "16"))                  # waiting grades per process
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "10"))          # seconds; below the worker timeout
+ADMISSION_DIR = os.environ.get("ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-admission"))
+
+DEFAULT_SERVICE_TIME = 8.0   # seconds per grade until some have been timed
+POLL_INTERVAL = 0.1          # how often a waiter rechecks the shared count
+
+
+class Overloaded(Exception):
+    """Too busy to take this grade. retry_after: whole seconds to wait."""
+
+    def __init__(self, reason, retry_after, waiting):
+        super().__init__(f"{reason}: {waiting} waiting, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.waiting = waiting
+
+
+class SharedCount:
+    """Grades running per process, in one flock'd file for the whole machine."""
+
+    def __init__(self, limit, state_dir=ADMISSION_DIR):
+        self.limit = limit
+        self.path = os.path.join(state_dir, "in_flight.json")
+        os.makedirs(state_dir, exist_ok=True)
+
+    def take(self):
+        """One slot if the machine-wide count is under the limit. Returns True if taken."""
+        return self._update(1)
+
+    def give_back(self):
+        self._update(-1)
+
+    def _update(self, delta):
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    counts = json.loads(f.read() or "{}")
+                except ValueError:
+                    counts = {}
+                counts = {pid: n for pid, n in counts.items() if n > 0 and _alive(int(pid))}
+                pid = str(os.getpid())
+                if delta > 0 and sum(counts.values()) >= self.limit:
+                    return False
+                counts[pid] = max(0, counts.get(pid, 0) + delta)
+                f.seek(0)
+                f.truncate()
+                json.dump(counts, f)
+                return True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Ticket:
+    """A running grade's slot. leave() (or the with block) gives it back."""
+
+    def __init__(self, admission):
+        self._admission = admission
+        self._start = time.monotonic()
+        self._left = False
+
+    def leave(self):
+        if not self._left:
+            self._left = True
+            self._admission._release(time.monotonic() - self._start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.leave()
+
+
+class Admission:
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_total=ADMISSION_MAX_TOTAL,
+                 queue_size=ADMISSION_QUEUE, max_wait=ADMISSION_MAX_WAIT, state_dir=ADMISSION_DIR):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.shared = SharedCount(max_total, state_dir) if max_in_flight and max_total else None
+        self._in_flight = 0
+        self._waiters = deque()                # Futures, first come first served
+        self._service = deque(maxlen=100)      # seconds per finished grade
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """A Ticket once this grade may run; raises Overloaded if it can't soon."""
+        waiter, start = self._arrive(), time.monotonic()
+        while waiter is not None:
+            remaining = start + self.max_wait - time.monotonic()
+            try:
+                waiter.result(timeout=max(0.0, min(POLL_INTERVAL, remaining)))
+                waiter = None
+            except FutureTimeout:
+                waiter = self._recheck(waiter, remaining <= 0)
+        return self._admitted(start)
+
+    async def enter_async(self):
+        """enter() for the event loop."""
+        waiter, start = self._arrive(), time.monotonic()
+        try:
+            while waiter is not None:
+                remaining = start + self.max_wait - time.monotonic()
+                try:
+                    await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter)),
+                                           max(0.0, min(POLL_INTERVAL, remaining)))
+                    waiter = None
+                except asyncio.TimeoutError:
+                    waiter = self._recheck(waiter, remaining <= 0)
+        except asyncio.CancelledError:
+            self._abandon(waiter)   # the client went away while waiting
+            raise
+        return self._admitted(start)
+
+    def wait(self):
+        """
+        enter() for background grades (jobs, batch items, regrades): no
+        student is waiting on a 503, so wait out Overloaded instead.
+        """
+        while True:
+            try:
+                return self.enter()
+            except Overloaded as e:
+                time.sleep(min(e.retry_after, 1.0))   # the line may clear sooner than estimated
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": self._in_flight, "waiting": len(self._waiters),
+                    "max_in_flight": self.max_in_flight, "queue_size": self.queue_size,
+                    "service_time": round(self._service_time(), 3), "estimated_wait": self._estimate(len(self._waiters))}
+
+    # ------------------------------------------------------------------
+    def _arrive(self):
+        # None if admitted at once, else a Future that is set when a slot is handed over
+        if not self.max_in_flight:
+            return None
+        with self._lock:
+            if not self._waiters and self._take():
+                return None
+            waiting = len(self._waiters)
+            if waiting >= self.queue_size:
+                raise self._reject("queue_full", waiting)
+            if self._service and self._estimate(waiting) > self.max_wait + 1:
+                raise self._reject("too_slow", waiting)
+            waiter = Future()
+            self._waiters.append(waiter)
+        metrics.gauge_add("aigrademe_admission_waiting", 1)
+        return waiter
+
+    def _recheck(self, waiter, expired):
+        # Still waiting: maybe the shared cap has room now, or the deadline passed
+        with self._lock:
+            if waiter.done():
+                return waiter     # handed a slot just now; the next result() returns at once
+            if self._waiters and self._waiters[0] is waiter and self._take():
+                self._waiters.popleft()
+                waiter.set_result(True)
+            elif expired:
+                self._waiters.remove(waiter)
+                metrics.gauge_add("aigrademe_admission_waiting", -1)
+                raise self._reject("timed_out", len(self._waiters))
+            else:
+                return waiter
+        metrics.gauge_add("aigrademe_admission_waiting", -1)
+        return None
+
+    def _abandon(self, waiter):
+        with self._lock:
+            if waiter.done():
+                handed = True
+            else:
+                handed = False
+                self._waiters.remove(waiter)
+        if handed:
+            self._release(None)   # a slot was handed over as we left: pass it on
+        else:
+            metrics.gauge_add("aigrademe_admission_waiting", -1)
+
+    def _admitted(self, start):
+        waited = time.monotonic() - start
+        metrics.inc("aigrademe_admission_total", {"outcome": "queued" if waited > 0.001 else "admitted"})
+        if waited > 0.001:
+            metrics.record_stage("admission", waited)
+        return Ticket(self)
+
+    def _release(self, seconds):
+        if not self.max_in_flight:
+            return
+        with self._lock:
+            if seconds is not None:
+                self._service.append(seconds)
+            if self._waiters:
+                # Hand the slot (and its shared count) straight to the next in line
+                waiter = self._waiters.popleft()
+                waiter.set_result(True)
+                handed = True
+            else:
+                self._in_flight -= 1
+                handed = False
+            if not handed and self.shared is not None:
+                self.shared.give_back()
+        if handed:
+            metrics.gauge_add("aigrademe_admission_waiting", -1)
+
+    def _take(self):
+        # Caller holds the lock
+        if self._in_flight >= self.max_in_flight:
+            return False
+        if self.shared is not None and not self.shared.take():
+            return False
+        self._in_flight += 1
+        return True
+
+    def _service_time(self):
+        if not self._service:
+            return DEFAULT_SERVICE_TIME
+        times = sorted(self._service)
+        return times[len(times) // 2]
+
+    def _estimate(self, ahead):
+        # Caller holds the lock. Every slot finishes a grade about every service time.
+        return max(1, math.ceil((ahead + 1) * self._service_time() / self.max_in_flight)) if self.max_in_flight else 0
+
+    def _reject(self, reason, waiting):
+        # Caller holds the lock
+        retry_after = self._estimate(waiting)
+        metrics.inc("aigrademe_admission_total", {"outcome": reason})
+        logging.warning("Admission: turned a grade away (%s, %d waiting, retry after %ds)", reason, waiting, retry_after)
+        return Overloaded(reason, retry_after, waiting)
+
+
+controller = Admission()
@@ -0,0 +1,79 @@
+# utils/analytics.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Class-wide grade analytics for one assignment (GET /analytics).
+#
+# Instructors used to export every grade and work the numbers out in a
+# spreadsheet. /analytics answers from the score counts the submission
+# store keeps up to date as each grade lands (utils/submissions.py): how
+# many students got each score in each category, so means, percentiles and
+# "how often were points lost here" come from a few dozen counts. A query
+# costs the same for ten submissions or ten thousand.
+
+import math
+
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def distribution(counts):
+    """
+    Summary of {score: submissions}: submissions, mean, standard deviation,
+    min, max, percentiles (nearest rank) and the histogram.
+    """
+    n = sum(counts.values())
+    if not n:
+        return {"submissions": 0}
+    scores = sorted(score for score, k in counts.items() if k)
+    mean = sum(score * k for score, k in counts.items()) / n
+    variance = sum(k * (score - mean) ** 2 for score, k in counts.items()) / n
+    percentiles, seen, i = {}, 0, 0
+    for p in PERCENTILES:
+        rank = max(1, math.ceil(p / 100 * n))
+        while seen + counts[scores[i]] < rank:
+            seen += counts[scores[i]]
+            i += 1
+        percentiles[f"p{p}"] = scores[i]
+    return {
+        "submissions": n,
+        "mean": round(mean, 2),
+        "stdev": round(math.sqrt(variance), 2),
+        "min": scores[0],
+        "max": scores[-1],
+        **percentiles,
+        "histogram": [[score, counts[score]] for score in scores],
+    }
+
+
+def summarize(categories, totals, order=()):
+    """
+    The /analytics report from SubmissionStore.counts(): per category its
+    distribution and how often points were lost, the total's distribution,
+    and the categories ranked by how often they were missed. `order` lists
+    category labels in rubric order.
+    """
+    position = {label: i for i, label in enumerate(order)}
+    report = []
+    for label in sorted(categories, key=lambda label: (position.get(label, len(position)), label)):
+        top, counts = categories[label]
+        summary = distribution(counts)
+        n = summary["submissions"]
+        if not n:
+            continue
+        report.append({
+            "category": label,
+            "possible": top,
+            **summary,
+            "missed_rate": round(1 - counts.get(top, 0) / n, 4),    # lost at least one point
+            "zero_rate": round(counts.get(0, 0) / n, 4),            # got nothing at all
+            "avg_points_lost": round(top - summary["mean"], 2),
+        })
+    missed = sorted(report, key=lambda c: (-c["missed_rate"], -c["avg_points_lost"] / (c["possible"] or 1)))
+    return {
+        "submissions": sum(totals.values()),
+        "total": distribution(totals),
+        "categories": report,
+        "most_missed": [
+            {key: c[key] for key in ("category", "missed_rate", "zero_rate", "avg_points_lost", "possible")}
+            for c in missed if c["missed_rate"] > 0
+        ],
+    }
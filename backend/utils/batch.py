@@ -0,0 +1,203 @@
+# utils/batch.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Grades a whole section's sketches in one request.
+#
+# Input is a ZIP and/or several uploaded files, plus an optional roster
+# CSV (file,name,email). Sketches are graded concurrently and each result
+# is streamed back (NDJSON or CSV) as soon as it finishes. Every finished
+# result is also appended to BATCH_DIR/<batch_id>.ndjson, so re-sending
+# the same batch only grades what is missing.
+
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import payload
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "300"))
+BATCH_MAX_MEMBER_BYTES = int(os.environ.get("BATCH_MAX_MEMBER_BYTES", str(15 * 1024 * 1024)))     # per ZIP member
+BATCH_MAX_ARCHIVE_BYTES = int(os.environ.get("BATCH_MAX_ARCHIVE_BYTES", str(512 * 1024 * 1024)))  # all members
+# The whole POST body: photos barely compress, so about the ZIP's members, plus the roster and form
+BATCH_MAX_REQUEST_BYTES = int(os.environ.get("BATCH_MAX_REQUEST_BYTES", str(BATCH_MAX_ARCHIVE_BYTES + 16 * 1024 * 1024)))
+BATCH_DIR = os.environ.get("BATCH_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-batches"))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+BATCH_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+CSV_COLUMNS = ["file", "name", "email", "status", "total", "scores", "feedback", "error"]
+
+
+class ArchiveTooLarge(ValueError):
+    """A ZIP whose images would decompress to more than the limits allow."""
+
+
+class Item:
+    """One sketch in a batch. Bytes are loaded only when it is graded."""
+
+    def __init__(self, file, fingerprint, load, name="", email=""):
+        self.file = file
+        self.fingerprint = fingerprint   # identifies the content, for resuming
+        self.load = load
+        self.name = name
+        self.email = email
+        self.mime = payload.mime_for(file)   # a guess from the name; uploads.check sniffs the real one
+
+    @property
+    def key(self):
+        return f"{self.file}:{self.fingerprint}"
+
+
+def read_roster(text):
+    """Roster CSV -> {file name (lower case): (name, email)}."""
+    roster = {}
+    for row in csv.DictReader(io.StringIO(text)):
+        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        file = row.get("file") or row.get("filename") or row.get("image")
+        if file:
+            roster[os.path.basename(file).lower()] = (row.get("name", ""), row.get("email", ""))
+    return roster
+
+
+def collect_items(files, archive=None, roster=None):
+    """
+    Build Items from uploaded FileStorage objects and/or ZIP bytes.
+    Raises ArchiveTooLarge before anything is decompressed if a member is
+    over BATCH_MAX_MEMBER_BYTES or all of them over BATCH_MAX_ARCHIVE_BYTES.
+    """
+    roster = roster or {}
+    items = []
+    for f in files:
+        if f and f.filename and f.filename.lower().endswith(IMAGE_EXTENSIONS):
+            data = payload.upload_bytes(f)
+            items.append(Item(os.path.basename(f.filename), hashlib.sha256(data).hexdigest()[:16],
+                              lambda data=data: data))
+    if archive:
+        zf = zipfile.ZipFile(io.BytesIO(archive))
+        lock = threading.Lock()
+
+        def load(info):
+            with lock:   # one reader at a time on the shared ZIP file
+                # zipfile stops at the directory's file_size (checked below)
+                # and fails the CRC if the member claimed less than it holds
+                return zf.read(info)
+
+        total = 0
+        for info in zf.infolist():
+            base = os.path.basename(info.filename)
+            if info.is_dir() or base.startswith(".") or "__MACOSX" in info.filename:
+                continue
+            if base.lower().endswith(IMAGE_EXTENSIONS) and len(items) < BATCH_MAX_FILES:
+                if info.file_size > BATCH_MAX_MEMBER_BYTES:
+                    raise ArchiveTooLarge(f"{base} is larger than {BATCH_MAX_MEMBER_BYTES // (1024 * 1024)} MB")
+                total += info.file_size
+                if total > BATCH_MAX_ARCHIVE_BYTES:
+                    raise ArchiveTooLarge(f"The archive's images add up to more than "
+                                          f"{BATCH_MAX_ARCHIVE_BYTES // (1024 * 1024)} MB")
+                # CRC + size come from the ZIP directory, no need to decompress
+                items.append(Item(base, f"{info.CRC:08x}{info.file_size:x}", lambda info=info: load(info)))
+    for item in items:
+        stem = os.path.splitext(item.file)[0]
+        item.name, item.email = roster.get(item.file.lower(), (stem, ""))
+    return items[:BATCH_MAX_FILES]
+
+
+def batch_id_for(items, rubric_version=""):
+    """Same sketches + same rubric -> same id, so a re-upload resumes automatically."""
+    h = hashlib.sha256(rubric_version.encode("utf-8") + b"\n")
+    for key in sorted(item.key for item in items):
+        h.update(key.encode("utf-8") + b"\n")
+    return h.hexdigest()[:32]
+
+
+class BatchRun:
+    """One batch: what is already graded (from the log) and what is left."""
+
+    def __init__(self, batch_id, items, batch_dir=BATCH_DIR):
+        if not BATCH_ID_RE.match(batch_id):
+            raise ValueError("invalid batch id")
+        os.makedirs(batch_dir, exist_ok=True)
+        self.batch_id = batch_id
+        self.path = os.path.join(batch_dir, batch_id + ".ndjson")
+        self._lock = threading.Lock()
+        done = self._load_done()
+        self.done = [dict(done[item.key], resumed=True) for item in items if item.key in done]
+        self.todo = [item for item in items if item.key not in done]
+
+    def _load_done(self):
+        done = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue   # a half-written last line from a crash
+                    if record.get("status") == "graded":
+                        done[record["key"]] = record
+        except FileNotFoundError:
+            pass
+        return done
+
+    def _log(self, record):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def stream(self, grade, concurrency=BATCH_CONCURRENCY):
+        """
+        Yield result records: already-graded ones first, then each new one as
+        it finishes. grade(image, mime, name, email) returns a dict with at
+        least "status".
+        """
+        yield from self.done
+        if not self.todo:
+            return
+        pool = ThreadPoolExecutor(max_workers=max(1, min(concurrency, BATCH_MAX_CONCURRENCY)),
+                                  thread_name_prefix="batch")
+        try:
+            futures = [pool.submit(self._grade_one, item, grade) for item in self.todo]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # If the client went away, stop starting new grades. Ones already
+            # running still finish and land in the log for the next resume.
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _grade_one(self, item, grade):
+        record = {"key": item.key, "file": item.file, "name": item.name, "email": item.email}
+        try:
+            record.update(grade(item.load(), item.mime, item.name, item.email))
+        except Exception as e:
+            logging.exception("Batch %s: grading %s failed", self.batch_id, item.file)
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+        self._log(record)
+        return record
+
+
+def to_ndjson(run, records):
+    yield json.dumps({"batch_id": run.batch_id, "items": len(run.done) + len(run.todo),
+                      "already_graded": len(run.done)}) + "\n"
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def to_csv(records):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    yield out.getvalue()
+    for record in records:
+        out.seek(0)
+        out.truncate()
+        scores = "; ".join(f"{label}={value}" for label, value in (record.get("scores") or {}).items())
+        writer.writerow([scores if col == "scores" else record.get(col, "") for col in CSV_COLUMNS])
+        yield out.getvalue()
@@ -0,0 +1,202 @@
+# utils/cache.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Content-addressed cache for AI grading results.
+#
+# A resubmitted photo (double click, refresh, retry after "overloaded")
+# has the same bytes, so it gets the same key and skips the provider.
+# Two tiers: a small in-memory LRU per process, and a SQLite file shared
+# by every gunicorn worker on the machine.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from utils import metrics
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+CACHE_TTL = int(os.environ.get("CACHE_TTL", "86400"))                     # seconds an entry lives
+CACHE_MEMORY_ITEMS = int(os.environ.get("CACHE_MEMORY_ITEMS", "256"))     # LRU entries per process
+CACHE_MAX_ROWS = int(os.environ.get("CACHE_MAX_ROWS", "10000"))           # entries kept on disk
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_DB = os.environ.get("CACHE_DB", os.path.join(tempfile.gettempdir(), "aigrademe-cache.sqlite3"))
+
+
+def image_digest(image_bytes) -> str:
+    """sha256 of the raw upload bytes."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def make_key(image_bytes, prompt: str, model: str) -> str:
+    """Cache key: the same image graded with the same prompt by the same model."""
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8") + b"\0")
+    h.update(hashlib.sha256(prompt.encode("utf-8")).digest())
+    h.update(bytes.fromhex(image_digest(image_bytes)))
+    return h.hexdigest()
+
+
+class GradeCache:
+    """
+    LRU + SQLite cache with TTL and size-based eviction.
+
+    get_or_compute() also merges identical concurrent requests: while one
+    thread is calling the provider for a key, other threads asking for the
+    same key wait on that call instead of making their own.
+    """
+
+    def __init__(self, db_path=CACHE_DB, ttl=CACHE_TTL, memory_items=CACHE_MEMORY_ITEMS,
+                 max_rows=CACHE_MAX_ROWS, max_bytes=CACHE_MAX_BYTES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()   # key -> (expires, value)
+        self._inflight = {}            # key -> Future
+        self._inflight_async = {}      # key -> asyncio.Future (ASGI app, one event loop)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS grades ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db().execute("CREATE INDEX IF NOT EXISTS grades_accessed ON grades (accessed)")
+
+    def _db(self):
+        # sqlite3 connections can't be shared between threads; keep one each.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        with metrics.stage("cache"):
+            value = self._get(key)
+        metrics.inc("aigrademe_cache_total", {"result": "miss" if value is None else "hit"})
+        return value
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._memory[key]
+        try:
+            row = self._db().execute(
+                "SELECT value, expires FROM grades WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                self._db().execute("UPDATE grades SET accessed = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logging.warning("Grade cache read failed: %s", e)
+            row = None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        value = json.loads(row[0])
+        self._remember(key, value, row[1])
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        now = time.time()
+        expires = now + self.ttl
+        self._remember(key, value, expires)
+        text = json.dumps(value)
+        try:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO grades (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, text, len(text), expires, now),
+            )
+            self._evict(db, now)
+        except sqlite3.Error as e:
+            logging.warning("Grade cache write failed: %s", e)
+
+    def get_or_compute(self, key, compute, should_store=lambda value: True):
+        """Return the cached value for key, or call compute() once and store it."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            value = compute()
+            if should_store(value):
+                self.put(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def get_or_compute_async(self, key, compute, should_store=lambda value: True):
+        """get_or_compute() for the event loop; compute is an async function."""
+        value = await asyncio.to_thread(self.get, key)
+        if value is not None:
+            return value
+        future = self._inflight_async.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._inflight_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+            if should_store(value):
+                await asyncio.to_thread(self.put, key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()   # retrieved: no "never retrieved" warning if nobody waits
+            raise
+        finally:
+            self._inflight_async.pop(key, None)
+
+    def _remember(self, key, value, expires):
+        with self._lock:
+            self._memory[key] = (expires, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM grades WHERE expires <= ?", (now,))
+        rows, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM grades").fetchone()
+        if rows <= self.max_rows and size <= self.max_bytes:
+            return
+        # Drop the least recently used tenth, or more if still over the row limit.
+        drop = max(rows - self.max_rows, rows // 10, 1)
+        db.execute(
+            "DELETE FROM grades WHERE key IN (SELECT key FROM grades ORDER BY accessed LIMIT ?)", (drop,)
+        )
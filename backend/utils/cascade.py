@@ -0,0 +1,226 @@
+# utils/cascade.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Model cascade: a fast, cheap model grades first; only the
+# grades it is unsure about go to the full model.
+#
+# Most sketches are easy to grade, but every one used to go to the large
+# model. With a cascade, the fast tier (GEMINI_FAST_MODEL / GROK_FAST_MODEL)
+# grades first and also returns a confidence from 0 to 1 per category.
+# Its grade is kept unless
+# - the reply doesn't parse or has invalid fields,
+# - any category's confidence is below min_confidence, or
+# - the total is within margin points of one of the grade thresholds,
+# in which case the full tier (the usual providers) grades again.
+#
+# The policy is per rubric: an optional "=== CASCADE ===" section at the
+# end of the rubric file, one "key: value" per line, e.g.
+#     enabled: yes
+#     min_confidence: 0.8
+#     margin: 3
+#     thresholds: 60, 70, 80, 90
+# Keys left out use the CASCADE_* settings below. Cached grades are kept
+# when a policy changes (they are valid grades either way).
+#
+# Calls, escalations (by reason), latency and provider-reported token usage
+# are counted per tier, on /metrics and /stats/cascade.
+
+import logging
+import os
+import threading
+import time
+
+from utils import logs, metrics, retry, scoring
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+CASCADE = os.environ.get("CASCADE", "0").lower() in ("1", "true", "yes")         # default for every rubric
+CASCADE_MIN_CONFIDENCE = float(os.environ.get("CASCADE_MIN_CONFIDENCE", "0.7"))  # per category, 0-1
+CASCADE_MARGIN = int(os.environ.get("CASCADE_MARGIN", "2"))                      # points around a threshold
+CASCADE_THRESHOLDS = os.environ.get("CASCADE_THRESHOLDS", "")                    # e.g. "60,70,80,90"
+
+TIERS = ("fast", "full")
+REASONS = ("error", "parse", "confidence", "threshold")
+
+
+class Policy:
+    """When a rubric's fast-tier grades are kept. See the module comment."""
+
+    def __init__(self, enabled=CASCADE, min_confidence=CASCADE_MIN_CONFIDENCE, margin=CASCADE_MARGIN,
+                 thresholds=CASCADE_THRESHOLDS):
+        self.enabled = enabled
+        self.min_confidence = min_confidence
+        self.margin = margin
+        self.thresholds = [int(t) for t in str(thresholds).replace(",", " ").split()]
+
+    @classmethod
+    def parse(cls, text):
+        """Policy from the lines of a rubric's CASCADE section. Raises ValueError."""
+        fields = {}
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, colon, value = line.partition(":")
+            key, value = key.strip().lower(), value.strip()
+            if not colon or key not in ("enabled", "min_confidence", "margin", "thresholds"):
+                raise ValueError(f"bad cascade line: {line!r}")
+            if key == "enabled":
+                fields[key] = value.lower() in ("1", "true", "yes", "on")
+            elif key == "min_confidence":
+                fields[key] = float(value)
+            elif key == "margin":
+                fields[key] = int(value)
+            else:
+                fields[key] = value
+        return cls(**fields)
+
+
+def prompt(rubric):
+    """The rubric prompt for the fast tier: the grade plus a confidence per category."""
+    return (
+        f"{rubric.prompt}\n\n"
+        f"Also return \"confidence\": for each category, a number from 0 to 1 saying how sure you are "
+        f"of that score (1 = certain; lower when the photo is hard to read or the call is borderline)."
+    )
+
+
+def gemini_schema(categories):
+    schema = scoring.gemini_schema(categories)
+    keys = [key for key, _, _ in categories]
+    schema["properties"]["confidence"] = {
+        "type": "OBJECT", "properties": {key: {"type": "NUMBER"} for key in keys}, "required": keys,
+    }
+    schema["required"].append("confidence")
+    return schema
+
+
+def json_schema(categories):
+    schema = scoring.json_schema(categories)
+    keys = [key for key, _, _ in categories]
+    schema["properties"]["confidence"] = {
+        "type": "object", "properties": {key: {"type": "number", "minimum": 0, "maximum": 1} for key in keys},
+        "required": keys, "additionalProperties": False,
+    }
+    schema["required"].append("confidence")
+    return schema
+
+
+def usage(result):
+    """(input tokens, output tokens) the provider reported for a call, or (0, 0)."""
+    meta = result.get("usageMetadata")          # Gemini
+    if isinstance(meta, dict):
+        return meta.get("promptTokenCount") or 0, meta.get("candidatesTokenCount") or 0
+    meta = result.get("usage")                  # OpenAI-style (Grok)
+    if isinstance(meta, dict):
+        return meta.get("prompt_tokens") or 0, meta.get("completion_tokens") or 0
+    return 0, 0
+
+
+def escalation(result, rubric, policy):
+    """Why a fast-tier result must be graded again ("parse", ...), or None to keep it."""
+    if "ai_error" in result:
+        return "error"
+    try:
+        text = result["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return "parse"
+    categories = rubric.categories or scoring.guess_categories(text)
+    grade, bad = scoring.parse_grade(text, categories)
+    if not categories or bad:
+        return "parse"
+    data = scoring.extract_json(text)
+    confidence = data.get("confidence") if isinstance(data, dict) else None
+    if not isinstance(confidence, dict):
+        return "confidence"
+    for key, _, _ in categories:
+        value = confidence.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < policy.min_confidence:
+            return "confidence"
+    total = sum(grade["scores"].values())
+    if any(abs(total - threshold) <= policy.margin for threshold in policy.thresholds):
+        return "threshold"
+    return None
+
+
+class Cascade:
+    """
+    analyze() / analyze_async() like a ProviderRouter, through two of them:
+    `fast` (the cheap models) first, `full` when the policy says so.
+    """
+
+    def __init__(self, fast, full):
+        self.fast = fast
+        self.full = full
+        self._stats = {tier: {"calls": 0, "seconds": 0.0, "input_tokens": 0, "output_tokens": 0} for tier in TIERS}
+        self._escalations = dict.fromkeys(REASONS, 0)
+        self._lock = threading.Lock()
+
+    def analyze(self, image, mime, rubric):
+        policy = rubric.cascade
+        start = time.monotonic()
+        if not policy.enabled:
+            return self._record("full", self.full.analyze(image, mime, rubric), start)
+        result = self._record("fast", self.fast.analyze(image, mime, rubric), start)
+        reason = self._escalate(result, rubric, policy)
+        if reason is None:
+            return result
+        start = time.monotonic()
+        return self._record("full", self.full.analyze(image, mime, rubric), start)
+
+    async def analyze_async(self, image, mime, rubric):
+        policy = rubric.cascade
+        start = time.monotonic()
+        if not policy.enabled:
+            return self._record("full", await self.full.analyze_async(image, mime, rubric), start)
+        result = self._record("fast", await self.fast.analyze_async(image, mime, rubric), start)
+        reason = self._escalate(result, rubric, policy)
+        if reason is None:
+            return result
+        start = time.monotonic()
+        return self._record("full", await self.full.analyze_async(image, mime, rubric), start)
+
+    def _escalate(self, result, rubric, policy):
+        if result.get("error_kind") in retry.CLIENT_ERRORS:
+            return None   # the photo was refused; the full tier would refuse it too
+        reason = escalation(result, rubric, policy)
+        if reason is not None:
+            with self._lock:
+                self._escalations[reason] += 1
+            metrics.inc("aigrademe_cascade_escalations_total", {"reason": reason})
+            logs.event("cascade_escalated", logging.INFO, rubric=rubric.id, reason=reason,
+                       provider=result.get("provider"))
+        return reason
+
+    def _record(self, tier, result, start):
+        seconds = time.monotonic() - start
+        tokens_in, tokens_out = usage(result)
+        with self._lock:
+            stats = self._stats[tier]
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["input_tokens"] += tokens_in
+            stats["output_tokens"] += tokens_out
+        metrics.inc("aigrademe_cascade_calls_total", {"tier": tier})
+        metrics.observe("aigrademe_cascade_seconds", seconds, {"tier": tier})
+        metrics.inc("aigrademe_cascade_tokens_total", {"tier": tier, "kind": "input"}, tokens_in)
+        metrics.inc("aigrademe_cascade_tokens_total", {"tier": tier, "kind": "output"}, tokens_out)
+        if "ai_error" not in result:
+            result["tier"] = tier
+        return result
+
+    def stats(self):
+        """Per tier: calls, average seconds and tokens; for fast, the escalation rate by reason."""
+        with self._lock:
+            tiers = {tier: dict(stats) for tier, stats in self._stats.items()}
+            escalations = dict(self._escalations)
+        for tier, stats in tiers.items():
+            calls = stats["calls"]
+            stats["avg_seconds"] = round(stats.pop("seconds") / calls, 3) if calls else None
+            stats["avg_input_tokens"] = round(stats["input_tokens"] / calls) if calls else None
+            stats["avg_output_tokens"] = round(stats["output_tokens"] / calls) if calls else None
+        fast_calls = tiers["fast"]["calls"]
+        tiers["fast"]["escalations"] = escalations
+        tiers["fast"]["escalation_rate"] = round(sum(escalations.values()) / fast_calls, 4) if fast_calls else 0.0
+        return tiers
@@ -0,0 +1,200 @@
+# utils/context_cache.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Provider-side caching of the rubric prompt (Gemini cachedContents).
+#
+# Every grade sends the same rubric prompt ahead of the photo. With
+# CONTEXT_CACHE on, the prompt is uploaded once per model and rubric
+# version as a cached-content handle, and grading calls send the handle
+# plus the photo instead (the provider bills cached tokens at a discount
+# and doesn't process them again). A handle lives CONTEXT_CACHE_TTL
+# seconds; once less than CONTEXT_CACHE_REFRESH is left, the next grade
+# extends it (or makes a new one if that fails). A new rubric version
+# gets its own handle; the old one runs out on its own.
+#
+# If the provider won't make a handle (caching not offered for the model,
+# prompt below the minimum size, no quota...), grades send the prompt
+# inline as before, and making one isn't tried again for
+# CONTEXT_CACHE_RETRY seconds. A call whose handle was deleted or expired
+# under it is sent again inline, and the handle is dropped.
+#
+# Handles are shared by all processes on the machine through a small JSON
+# file locked with flock (like the rate limiter's buckets), so a gunicorn
+# fleet makes one per rubric version, not one per worker.
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from utils import metrics
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+CONTEXT_CACHE = os.environ.get("CONTEXT_CACHE", "0").lower() in ("1", "true", "yes")   # off by default
+CONTEXT_CACHE_TTL = int(os.environ.get("CONTEXT_CACHE_TTL", "3600"))            # seconds a handle lives
+CONTEXT_CACHE_REFRESH = int(os.environ.get("CONTEXT_CACHE_REFRESH", "300"))     # extend when less is left
+CONTEXT_CACHE_RETRY = int(os.environ.get("CONTEXT_CACHE_RETRY", "600"))         # seconds after a failed create
+CONTEXT_CACHE_DIR = os.environ.get("CONTEXT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-context-cache"))
+
+MIN_LEFT = 60   # seconds a handle must still live for a call to use it (less for short TTLs)
+
+
+class ContextCache:
+    """
+    Cached-content handles per (model, rubric version).
+    create(rubric, model, ttl) returns a new handle's name or None;
+    refresh(name, ttl) returns True if the handle now lives ttl more seconds.
+    """
+
+    def __init__(self, create, refresh, enabled=CONTEXT_CACHE, ttl=CONTEXT_CACHE_TTL,
+                 refresh_margin=CONTEXT_CACHE_REFRESH, retry_after=CONTEXT_CACHE_RETRY, state_dir=CONTEXT_CACHE_DIR):
+        self.create = create
+        self.refresh = refresh
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl // 2)
+        self.min_left = min(MIN_LEFT, self.refresh_margin // 2)
+        self.retry_after = retry_after
+        self.path = os.path.join(state_dir, "handles.json")
+        self._entries = {}   # key -> {"name", "expires"} and/or {"retry_at"}, wall-clock seconds
+        self._lock = threading.Lock()
+        if enabled:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def handle(self, rubric, model):
+        """The handle to grade `rubric` on `model` with, or None to send the prompt inline."""
+        if not self.enabled:
+            return None
+        key = _key(rubric, model)
+        entry = self._entries.get(key)
+        if entry is None or not _settled(entry, time.time(), self.refresh_margin):
+            entry = self._renew(key, rubric, model)
+        return self._use(entry)
+
+    async def handle_async(self, rubric, model):
+        """handle() for the event loop: making or extending a handle runs on a thread."""
+        if not self.enabled:
+            return None
+        key = _key(rubric, model)
+        entry = self._entries.get(key)
+        if entry is None or not _settled(entry, time.time(), self.refresh_margin):
+            entry = await asyncio.to_thread(self._renew, key, rubric, model)
+        return self._use(entry)
+
+    def gone(self, error, name, rubric, model):
+        """
+        True if a call made with handle `name` failed because the provider no
+        longer has it. The handle is dropped; send the call again inline.
+        """
+        if name is None or error.get("error_kind") not in ("rejected", "auth"):
+            return False
+        if "cache" not in (error.get("details") or "").lower():
+            return False
+        key = _key(rubric, model)
+        with self._lock:
+            if self._entries.get(key, {}).get("name") == name:
+                self._entries.pop(key)
+            with self._state() as state:
+                if state.get(key, {}).get("name") == name:
+                    state.pop(key)
+        metrics.inc("aigrademe_context_cache_total", {"outcome": "gone"})
+        logging.warning("Context cache: %s for %s is gone, sending the prompt inline", name, key)
+        return True
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            entries = {key: dict(entry) for key, entry in self._entries.items()}
+        for entry in entries.values():
+            for field in ("expires", "retry_at"):
+                if field in entry:
+                    entry[field] = round(entry[field] - now)   # seconds from now
+        return {"enabled": self.enabled, "ttl": self.ttl, "handles": entries}
+
+    # ------------------------------------------------------------------
+    def _renew(self, key, rubric, model):
+        # Another process may have made or extended the handle: the file decides
+        with self._lock:
+            with self._state() as state:
+                now = time.time()
+                entry = state.get(key) or {}
+                if not _settled(entry, now, self.refresh_margin):
+                    entry = self._replace(entry, rubric, model, now)
+                    state[key] = entry
+                self._entries[key] = entry
+                return entry
+
+    def _replace(self, entry, rubric, model, now):
+        # Caller holds the file lock: extend the handle, or make a new one
+        name = entry.get("name")
+        if name and entry["expires"] > now + self.min_left and self.refresh(name, self.ttl):
+            metrics.inc("aigrademe_context_cache_total", {"outcome": "refreshed"})
+            logging.info("Context cache: extended %s for %s", name, rubric.id)
+            return {"name": name, "expires": now + self.ttl}
+        name = self.create(rubric, model, self.ttl)
+        if name:
+            metrics.inc("aigrademe_context_cache_total", {"outcome": "created"})
+            logging.info("Context cache: %s holds the %s prompt (version %s) for %s", name, rubric.id,
+                         rubric.version, model)
+            return {"name": name, "expires": now + self.ttl}
+        metrics.inc("aigrademe_context_cache_total", {"outcome": "failed"})
+        logging.warning("Context cache: no handle for %s on %s, sending the prompt inline for %ds",
+                        rubric.id, model, self.retry_after)
+        return dict(entry, retry_at=now + self.retry_after)
+
+    def _use(self, entry):
+        if entry.get("name") and entry["expires"] - time.time() > self.min_left:
+            metrics.inc("aigrademe_context_cache_total", {"outcome": "hit"})
+            return entry["name"]
+        metrics.inc("aigrademe_context_cache_total", {"outcome": "inline"})
+        return None
+
+    def _state(self):
+        return _LockedState(self.path)
+
+
+class _LockedState:
+    """The shared handles file, read and written back under flock."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, "a+", encoding="utf-8")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._file.seek(0)
+        try:
+            self.state = json.loads(self._file.read() or "{}")
+        except ValueError:
+            self.state = {}
+        return self.state
+
+    def __exit__(self, *exc):
+        try:
+            now = time.time()
+            # Handles of old rubric versions run out; forget them after that
+            state = {key: entry for key, entry in self.state.items()
+                     if entry.get("expires", 0) > now or entry.get("retry_at", 0) > now}
+            self._file.seek(0)
+            self._file.truncate()
+            json.dump(state, self._file)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+
+def _key(rubric, model):
+    return f"{model}:{rubric.id}:{rubric.version}"
+
+
+def _settled(entry, now, refresh_margin):
+    # Nothing to do now: the handle has time left, or we're waiting out a failed create
+    if entry.get("name") and entry["expires"] - now > refresh_margin:
+        return True
+    return entry.get("retry_at", 0) > now
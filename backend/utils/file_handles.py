@@ -0,0 +1,136 @@
+# utils/file_handles.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Upload a photo to the provider once (Gemini Files API) and
+# refer to it by handle in every later call for it.
+#
+# Each grading call used to carry the whole photo, base64 encoded: a retry
+# after a 503, the full-tier call after a cascade escalation, the call
+# sent again inline after a lost context-cache handle, a regrade... each
+# sent the same megabytes again. With FILE_UPLOADS on, a photo of at least
+# FILE_UPLOAD_MIN_BYTES is uploaded once and the calls name its file URI
+# instead. Handles are remembered per process by the photo's sha256 until
+# shortly before the provider deletes the file (Gemini keeps them 48 h).
+# Callers asking for the same photo at once share one upload.
+#
+# Smaller photos, providers without a file API (Grok) and failed uploads
+# send the photo inline as before; after a failed upload, that photo isn't
+# tried again for FILE_UPLOAD_RETRY seconds. A call whose file was deleted
+# or expired under it is sent again inline, and the handle is dropped.
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from utils import metrics
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+FILE_UPLOADS = os.environ.get("FILE_UPLOADS", "0").lower() in ("1", "true", "yes")   # off by default
+FILE_UPLOAD_MIN_BYTES = int(os.environ.get("FILE_UPLOAD_MIN_BYTES", str(256 * 1024)))  # smaller goes inline
+FILE_HANDLE_TTL = int(os.environ.get("FILE_HANDLE_TTL", str(47 * 3600)))   # seconds a handle is used
+FILE_HANDLE_ITEMS = int(os.environ.get("FILE_HANDLE_ITEMS", "1024"))       # handles kept per process
+FILE_UPLOAD_RETRY = int(os.environ.get("FILE_UPLOAD_RETRY", "60"))         # seconds after a failed upload
+
+
+class FileHandles:
+    """
+    Uploaded-file handles by photo hash, for one provider.
+    upload(image, mime) returns {"name", "uri", "mime"} or None.
+    """
+
+    def __init__(self, upload, enabled=FILE_UPLOADS, min_bytes=FILE_UPLOAD_MIN_BYTES, ttl=FILE_HANDLE_TTL,
+                 max_items=FILE_HANDLE_ITEMS, retry_after=FILE_UPLOAD_RETRY):
+        self.upload = upload
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.ttl = ttl
+        self.max_items = max_items
+        self.retry_after = retry_after
+        self._entries = OrderedDict()   # sha256 -> (expires, file dict or None after a failed upload)
+        self._uploading = {}            # sha256 -> Future
+        self._lock = threading.Lock()
+
+    def get(self, image, mime):
+        """The photo's file handle, uploading it first if needed; None to send it inline."""
+        if not self.enabled or len(image) < self.min_bytes:
+            return None
+        key = hashlib.sha256(image).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.inc("aigrademe_file_handles_total", {"outcome": "hit" if entry[1] else "inline"})
+                return entry[1]
+            future = self._uploading.get(key)
+            leader = future is None
+            if leader:
+                future = self._uploading[key] = Future()
+        if not leader:
+            file = future.result()
+            metrics.inc("aigrademe_file_handles_total", {"outcome": "hit" if file else "inline"})
+            return file
+        file = None
+        try:
+            file = self._upload(image, mime)
+        finally:
+            with self._lock:
+                self._remember(key, file)
+                self._uploading.pop(key, None)
+            future.set_result(file)
+        return file
+
+    async def get_async(self, image, mime):
+        """get() for the event loop: an upload runs on a thread."""
+        if not self.enabled or len(image) < self.min_bytes:
+            return None
+        return await asyncio.to_thread(self.get, image, mime)
+
+    def gone(self, error, file):
+        """
+        True if a call naming `file` failed because the provider no longer
+        has it. The handle is dropped; send the call again inline.
+        """
+        if file is None or error.get("error_kind") not in ("rejected", "auth"):
+            return False
+        if "file" not in (error.get("details") or "").lower():
+            return False
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry[1] is file:
+                    del self._entries[key]
+        metrics.inc("aigrademe_file_handles_total", {"outcome": "gone"})
+        logging.warning("File handles: %s is gone, sending the photo inline", file["name"])
+        return True
+
+    def stats(self):
+        with self._lock:
+            live = sum(1 for _, file in self._entries.values() if file)
+            return {"enabled": self.enabled, "handles": live, "failed": len(self._entries) - live,
+                    "uploading": len(self._uploading)}
+
+    # ------------------------------------------------------------------
+    def _upload(self, image, mime):
+        start = time.monotonic()
+        try:
+            file = self.upload(image, mime)
+        except Exception as e:
+            logging.warning("File upload failed: %s: %s", type(e).__name__, e)
+            file = None
+        metrics.inc("aigrademe_file_handles_total", {"outcome": "uploaded" if file else "failed"})
+        if file:
+            metrics.record_stage("file_upload", time.monotonic() - start)
+        return file
+
+    def _remember(self, key, file):
+        # Caller holds the lock
+        self._entries[key] = (time.monotonic() + (self.ttl if file else self.retry_after), file)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
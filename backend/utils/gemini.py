@@ -6,27 +6,35 @@
 # utils/gemini.py
 import os
 import base64
-import requests
+from utils import http_client, metrics, payload, rubrics
 import json
 
 GEMINI_KEY = os.environ.get("GEMINI_API_KEY")
 if not GEMINI_KEY:
     raise RuntimeError("GEMINI_API_KEY not set")
 
+# Point at tools/fake_provider.py for load tests
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+
 # ----------------------------------------------------------------------
-# Load prompt.txt (must be in the same folder as this file)
+# Rubrics come from the shared registry (prompt.txt + rubrics/*.txt)
 # ----------------------------------------------------------------------
-PROMPT_FILE = os.path.join(os.path.dirname(__file__), "..", "prompt.txt")
-with open(PROMPT_FILE, "r", encoding="utf-8") as f:
-    txt = f.read().strip()
+DEFAULT_RUBRIC = rubrics.registry.get()
+RUBRIC_TEXT, PROMPT_TEMPLATE = DEFAULT_RUBRIC.text, DEFAULT_RUBRIC.prompt
 
-# Split on the first blank line that follows a line containing "=== PROMPT ==="
-# Anything before is the rubric, anything after is the real prompt.
-parts = txt.split("\n=== PROMPT ===\n", 1)
-if len(parts) != 2:
-    raise RuntimeError("prompt.txt must contain exactly one '=== PROMPT ===' separator")
 
-RUBRIC_TEXT, PROMPT_TEMPLATE = parts[0].strip(), parts[1].strip()
+def build_body(rubric):
+    """Payload for one rubric – the prompt is the *template* part of the file."""
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {"text": rubric.prompt},
+                    {"inline_data": {"mime_type": payload.MIME, "data": payload.IMAGE}},
+                ]
+            }
+        ]
+    }
 
 
 def analyze_image(image_path: str):
@@ -34,30 +42,21 @@ def analyze_image(image_path: str):
     Sends the image to Gemini and returns the raw Gemini JSON.
     The caller (appnew.py) will parse the JSON into scores/feedback.
     """
-    # Encode image
     with open(image_path, "rb") as f:
-        encoded = base64.b64encode(f.read()).decode("utf-8")
+        image = f.read()
+    return analyze_bytes(image, payload.mime_for(image_path))
 
-    # MIME type
-    ext = os.path.splitext(image_path)[1].lower()
-    mime = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}.get(
-        ext.lstrip("."), "application/octet-stream"
-    )
 
-    # Build payload – the prompt is the *template* from prompt.txt
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": PROMPT_TEMPLATE},
-                    {"inline_data": {"mime_type": mime, "data": encoded}},
-                ]
-            }
-        ]
-    }
+def analyze_bytes(image, mime: str, rubric=None):
+    """Same as analyze_image, for an image already in memory."""
+    rubric = rubric or rubrics.registry.get()
+    with metrics.stage("encode"):
+        body = rubric.template("gemini-1.5", build_body).render(mime, image)
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_KEY}"
-    resp = requests.post(url, json=payload)
+    url = f"{GEMINI_BASE_URL}/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_KEY}"
+    with metrics.stage("provider", {"provider": "gemini"}):
+        resp = http_client.post(url, data=body, headers={"Content-Type": "application/json"})
+    metrics.inc("aigrademe_provider_responses_total", {"provider": "gemini", "status": resp.status_code})
 
     if resp.status_code == 200:
         return resp.json()
@@ -68,6 +67,6 @@ def analyze_image(image_path: str):
         }
 
 
-def get_rubric() -> str:
+def get_rubric(rubric_id=None) -> str:
     """Return the rubric text for display in the UI."""
-    return RUBRIC_TEXT
+    return rubrics.registry.get(rubric_id).text
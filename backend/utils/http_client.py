@@ -0,0 +1,249 @@
+# utils/http_client.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Shared, pooled HTTP client for the AI grading providers.
+#
+# A bare requests.post() opens a new TCP + TLS connection for every
+# submission. Going through post() here instead reuses keep-alive
+# connections from one pool per host, for every provider module.
+#
+# apost() is the asyncio counterpart for the ASGI app (asgi.py): one
+# httpx.AsyncClient per host, so hundreds of calls can wait on the network
+# in one thread.
+
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import httpx  # optional, only needed for HTTP/2 and the async client
+except ImportError:
+    httpx = None
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10"))               # keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))  # seconds to open a connection
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))       # seconds to wait for the reply
+HTTP2 = os.environ.get("HTTP2", "").lower() in ("1", "true", "yes")        # needs `pip install httpx[http2]`
+HTTP_ASYNC_POOL_SIZE = int(os.environ.get("HTTP_ASYNC_POOL_SIZE", "200"))  # per host, async; >= PROVIDER_CONCURRENCY
+
+if HTTP2 and httpx is None:
+    logging.warning("HTTP2 is set but httpx is not installed; falling back to HTTP/1.1")
+    HTTP2 = False
+
+_clients = {}
+_clients_lock = threading.Lock()
+_async_clients = {}   # (event loop, host) -> _AsyncClient
+
+# Per-host counters: requests sent and connections opened. Everything that
+# is not a new connection was served from the keep-alive pool.
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(host, key, amount=1):
+    with _stats_lock:
+        counters = _stats.setdefault(host, {"requests": 0, "new_connections": 0})
+        counters[key] += amount
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count(self.host, "new_connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count(self.host, "new_connections")
+        return super()._new_conn()
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools count every connection they open."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class _Http2Client:
+    """Thin wrapper so an httpx.Client looks like the requests path to callers."""
+
+    def __init__(self, host):
+        self.host = host
+        self.client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+        )
+        self._streams = weakref.WeakSet()   # network streams seen; closed ones drop out
+        self._lock = threading.Lock()
+
+    def post(self, url, timeout, **kwargs):
+        return self.request("POST", url, timeout, **kwargs)
+
+    def request(self, method, url, timeout, **kwargs):
+        connect, read = timeout
+        stream = kwargs.pop("stream", False)
+        data = kwargs.pop("data", None)
+        if data is not None:
+            # httpx wants bytes or an iterator; keep spliced bodies streaming.
+            kwargs["content"] = data if isinstance(data, (bytes, str)) else iter(data)
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"Content-Length": str(len(data))})
+        request = self.client.build_request(method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+        resp = self.client.send(request, stream=stream)
+        if stream and resp.status_code != 200:
+            resp.read()   # error bodies are small; callers read .text
+        # Every request on one connection shares the same network stream.
+        stream = resp.extensions.get("network_stream")
+        with self._lock:
+            if stream is not None and stream not in self._streams:
+                self._streams.add(stream)
+                _count(self.host, "new_connections")
+        return resp
+
+
+class _AsyncClient:
+    """httpx.AsyncClient for one host, counting connections like the other clients."""
+
+    def __init__(self, host):
+        self.host = host
+        self.client = httpx.AsyncClient(
+            http2=HTTP2,
+            limits=httpx.Limits(max_connections=HTTP_ASYNC_POOL_SIZE, max_keepalive_connections=HTTP_ASYNC_POOL_SIZE),
+        )
+        self._streams = weakref.WeakSet()   # network streams seen; closed ones drop out
+
+    async def post(self, url, timeout, **kwargs):
+        connect, read = timeout
+        stream = kwargs.pop("stream", False)
+        data = kwargs.pop("data", None)
+        if data is not None:
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"Content-Length": str(len(data))})
+            kwargs["content"] = data if isinstance(data, (bytes, str)) else _aiter(data)
+        request = self.client.build_request("POST", url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+        resp = await self.client.send(request, stream=stream)
+        if stream and resp.status_code != 200:
+            await resp.aread()
+        stream = resp.extensions.get("network_stream")
+        if stream is not None and stream not in self._streams:
+            self._streams.add(stream)
+            _count(self.host, "new_connections")
+        return resp
+
+
+async def _aiter(body):
+    # The async client wants an async iterator; SplicedBody's blocks are in memory.
+    for chunk in body:
+        yield chunk
+
+
+def _client_for(host):
+    with _clients_lock:
+        client = _clients.get(host)
+        if client is None:
+            if HTTP2:
+                client = _Http2Client(host)
+            else:
+                client = requests.Session()
+                adapter = _CountingAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+                client.mount("https://", adapter)
+                client.mount("http://", adapter)
+            _clients[host] = client
+        return client
+
+
+def post(url, timeout=None, **kwargs):
+    """
+    POST through the shared pool for url's host.
+    timeout defaults to (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT).
+    Returns a response with .status_code, .headers, .text and .json().
+    """
+    return request("POST", url, timeout, **kwargs)
+
+
+def request(method, url, timeout=None, **kwargs):
+    """post() for other methods (PATCH, DELETE...): same pool, timeouts and counters."""
+    host = urlsplit(url).hostname
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (HTTP_CONNECT_TIMEOUT, timeout)
+    _count(host, "requests")
+    return _client_for(host).request(method, url, timeout=timeout, **kwargs)
+
+
+async def apost(url, timeout=None, **kwargs):
+    """
+    Async post(): same arguments, for use on an asyncio event loop.
+    Returns an httpx.Response (with stream=True, read it with asse_events
+    and close it with aclose()). Needs httpx.
+    """
+    if httpx is None:
+        raise RuntimeError("the async client needs httpx (pip install httpx)")
+    host = urlsplit(url).hostname
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (HTTP_CONNECT_TIMEOUT, timeout)
+    _count(host, "requests")
+    key = (asyncio.get_running_loop(), host)
+    client = _async_clients.get(key)
+    if client is None:
+        client = _async_clients[key] = _AsyncClient(host)
+    return await client.post(url, timeout=timeout, **kwargs)
+
+
+async def asse_events(resp):
+    """Async sse_events() for a response from apost(..., stream=True)."""
+    data = []
+    async for line in resp.aiter_lines():
+        if line.startswith("data:"):
+            data.append(line[5:].lstrip())
+        elif not line and data:
+            yield "\n".join(data)
+            data = []
+    if data:
+        yield "\n".join(data)
+
+
+def sse_events(resp):
+    """
+    The data of each server-sent event in a response posted with stream=True,
+    as it arrives. Works with both the requests and the HTTP/2 client.
+    """
+    if isinstance(resp, requests.Response):
+        resp.encoding = "utf-8"
+        lines = resp.iter_lines(chunk_size=None, decode_unicode=True)   # no read-ahead buffering
+    else:
+        lines = resp.iter_lines()
+    data = []
+    for line in lines:
+        if line.startswith("data:"):
+            data.append(line[5:].lstrip())
+        elif not line and data:
+            yield "\n".join(data)
+            data = []
+    if data:
+        yield "\n".join(data)
+
+
+def stats():
+    """Return {host: {"requests", "new_connections", "reused"}} for this process."""
+    with _stats_lock:
+        return {
+            host: dict(c, reused=c["requests"] - c["new_connections"])
+            for host, c in _stats.items()
+        }
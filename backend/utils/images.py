@@ -0,0 +1,96 @@
+# utils/images.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Shrinks uploaded photos before they are sent to the AI.
+#
+# Phone photos are 3-12 MB and 4000+ px wide. A floor plan sketch grades
+# just as well at ~1600 px, and the smaller image uploads faster and costs
+# fewer image tokens. Work runs on a small thread pool (Pillow releases the
+# GIL while decoding and resizing).
+
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images pass through untouched
+    Image = None
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "1600"))             # longest side in px, 0 = keep
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()              # JPEG or WEBP
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+IMAGE_GRAYSCALE = os.environ.get("IMAGE_GRAYSCALE", "").lower() in ("1", "true", "yes")
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+
+_MIME_BY_FORMAT = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-prep")
+
+if Image is None:
+    logging.warning("Pillow not installed; uploads are sent to the AI without resizing")
+
+
+def normalize(image, mime: str):
+    """
+    Fix EXIF rotation, downscale, optionally grayscale, and re-encode.
+    Returns (image_bytes, mime). Falls back to the original on any problem,
+    or when it needed no resizing, rotation or grayscale and re-encoding
+    wouldn't make it smaller.
+    """
+    if Image is None:
+        return image, mime
+    try:
+        img = Image.open(io.BytesIO(image))
+        # Downscaled or grayscaled copies are always sent, even when a
+        # well-compressed PNG original is fewer bytes
+        changed = IMAGE_GRAYSCALE or bool(IMAGE_MAX_SIDE and max(img.size) > IMAGE_MAX_SIDE)
+        if IMAGE_MAX_SIDE:
+            # JPEG only: let the decoder skip detail we'd throw away anyway
+            img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        if IMAGE_MAX_SIDE:
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        img = img.convert("L" if IMAGE_GRAYSCALE else "RGB")
+
+        out = io.BytesIO()
+        # Saving without exif= drops EXIF (GPS, camera info) from the copy we send.
+        img.save(out, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+        result = out.getvalue()
+    except Exception as e:
+        logging.warning("Image normalization skipped (%s: %s)", type(e).__name__, e)
+        return image, mime
+
+    if not changed and len(result) >= len(image) and not _needs_rotation(image):
+        logging.info("Image normalization: kept original %d bytes (re-encode was %d)", len(image), len(result))
+        return image, mime
+    logging.info(
+        "Image normalization: %d -> %d bytes (saved %d, %dx%d)",
+        len(image), len(result), len(image) - len(result), img.width, img.height,
+    )
+    return result, _MIME_BY_FORMAT.get(IMAGE_FORMAT, "image/jpeg")
+
+
+def normalize_async(image, mime: str):
+    """Start normalize() on the image pool; returns a Future of (image_bytes, mime)."""
+    return _pool.submit(metrics.propagate(_timed_normalize), image, mime)
+
+
+def _timed_normalize(image, mime):
+    with metrics.stage("normalize"):
+        return normalize(image, mime)
+
+
+def _needs_rotation(image) -> bool:
+    # An EXIF orientation other than 1 means the original displays rotated,
+    # so the re-encoded copy is worth sending even if it is larger.
+    try:
+        return Image.open(io.BytesIO(image)).getexif().get(0x0112, 1) != 1
+    except Exception:
+        return False
@@ -0,0 +1,134 @@
+# utils/jobs.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Background grading jobs so /submit can answer right away.
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))          # grades running at once
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "32"))   # grades allowed to wait
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))               # seconds a result is kept
+JOB_DIR = os.environ.get("JOB_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-jobs"))
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class QueueFull(Exception):
+    """Raised when every worker is busy and the wait queue is full."""
+
+
+class JobQueue:
+    """
+    A bounded pool of background grading threads.
+
+    Job state is written to one small JSON file per job in JOB_DIR, so any
+    gunicorn worker can answer GET /jobs/<id>, not just the one that took
+    the upload. No outside services (Redis, Celery...) are needed.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE, job_dir=JOB_DIR, ttl=JOB_TTL):
+        self.job_dir = job_dir
+        self.ttl = ttl
+        os.makedirs(job_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grade-job")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._events = {}
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) and return the new job id. fn returns a Flask-style (html, status[, headers]) tuple."""
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._events[job_id] = threading.Event()
+        self._write(job_id, {"status": "queued", "created": time.time()})
+        try:
+            self._executor.submit(self._run, job_id, fn, args)
+        except Exception:
+            self._slots.release()
+            raise
+        self._purge_old()
+        return job_id
+
+    def get(self, job_id):
+        """Return the job's state dict, or None if the id is unknown or expired."""
+        if not JOB_ID_RE.match(job_id or ""):
+            return None
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def wait(self, job_id, timeout):
+        """
+        Block until the job changes state or timeout passes, then return it.
+        Jobs owned by this process wake up immediately; jobs owned by another
+        worker are picked up by polling their file.
+        """
+        event = self._events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        else:
+            time.sleep(min(timeout, 0.5))
+        return self.get(job_id)
+
+    def _run(self, job_id, fn, args):
+        try:
+            self._update(job_id, status="running", started=time.time())
+            html, status = fn(*args)[:2]
+            self._update(job_id, status="done", html=html, http_status=status, finished=time.time())
+        except Exception as e:
+            logging.exception("Grading job %s failed", job_id)
+            self._update(job_id, status="error", error=f"{type(e).__name__}: {e}", finished=time.time())
+        finally:
+            self._slots.release()
+            with self._lock:
+                event = self._events.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    def _update(self, job_id, **fields):
+        state = self.get(job_id) or {}
+        state.update(fields)
+        self._write(job_id, state)
+        event = self._events.get(job_id)
+        if event is not None and fields.get("status") == "running":
+            # Wake SSE listeners for the queued -> running transition too.
+            event.set()
+            event.clear()
+
+    def _write(self, job_id, state):
+        # Write to a temp file and rename, so readers never see half a file.
+        fd, tmp = tempfile.mkstemp(dir=self.job_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self._path(job_id))
+
+    def _path(self, job_id):
+        return os.path.join(self.job_dir, job_id + ".json")
+
+    def _purge_old(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        for entry in os.scandir(self.job_dir):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
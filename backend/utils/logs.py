@@ -0,0 +1,48 @@
+# utils/logs.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: One-line JSON logs.
+#
+# setup() switches the root logger to JSON lines on stdout (LOG_FORMAT=text
+# keeps the plain format). event("graded", total=87, ...) logs a message
+# with structured fields, which end up as top-level keys in the JSON.
+
+import json
+import logging
+import os
+import sys
+import time
+
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("aigrademe")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup():
+    """Replace the root handlers (aichecknew sets up plain text) with JSON on stdout."""
+    if LOG_FORMAT != "json":
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+
+
+def event(name, level=logging.INFO, **fields):
+    logger.log(level, name, extra={"fields": dict(fields, event=name)})
@@ -0,0 +1,279 @@
+# utils/metrics.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Counters, gauges and stage-timing histograms, exposed as /metrics.
+#
+# Each process keeps its own numbers and writes them to METRICS_DIR/<pid>.json
+# (at most every METRICS_FLUSH_INTERVAL seconds). /metrics adds up the files
+# of all gunicorn workers and renders the Prometheus text format, so any
+# worker can answer a scrape. No prometheus_client needed.
+#
+# stage("provider") times a block into aigrademe_stage_seconds and also
+# into the current request's Server-Timing list (see begin_request).
+
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-metrics"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "1"))
+METRICS_TTL = 24 * 3600   # files of dead workers are dropped after this long
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+# name -> (type, help)
+METRICS = {
+    "aigrademe_requests_total": ("counter", "HTTP requests by endpoint and status"),
+    "aigrademe_request_seconds": ("histogram", "HTTP request duration by endpoint"),
+    "aigrademe_requests_in_flight": ("gauge", "HTTP requests being handled"),
+    "aigrademe_stage_seconds": ("histogram", "Time per grading stage"),
+    "aigrademe_provider_responses_total": ("counter", "Provider HTTP responses by status"),
+    "aigrademe_provider_retries_total": ("counter", "Provider retries by failure kind"),
+    "aigrademe_provider_calls_in_flight": ("gauge", "Provider calls waiting for an answer"),
+    "aigrademe_cache_total": ("counter", "Grade cache lookups by result"),
+    "aigrademe_parse_total": ("counter", "AI reply parse outcomes"),
+    "aigrademe_near_duplicates_total": ("counter", "Near-duplicate uploads by outcome"),
+    "aigrademe_upload_rejections_total": ("counter", "Uploads rejected before any provider call, by reason"),
+    "aigrademe_upload_conversions_total": ("counter", "Uploads converted to JPEG, by original format"),
+    "aigrademe_multi_image_calls_total": ("counter", "Multi-image provider calls, by number of images"),
+    "aigrademe_multi_image_items_total": ("counter", "Grades sent in multi-image calls: shared, or single after all"),
+    "aigrademe_cascade_calls_total": ("counter", "Grading calls per model tier (fast, full)"),
+    "aigrademe_cascade_escalations_total": ("counter", "Fast-tier grades sent on to the full tier, by reason"),
+    "aigrademe_cascade_seconds": ("histogram", "Grading call duration per model tier"),
+    "aigrademe_cascade_tokens_total": ("counter", "Provider-reported tokens per model tier and kind (input, output)"),
+    "aigrademe_admission_total": ("counter", "Grades admitted (at once or after queueing) or turned away, by outcome"),
+    "aigrademe_admission_waiting": ("gauge", "Grades waiting for an admission slot"),
+    "aigrademe_context_cache_total": ("counter", "Rubric prompt cache handles by outcome (hit, inline, created, refreshed, failed, gone)"),
+    "aigrademe_regrades_total": ("counter", "Stored submissions graded again under the current rubric, by outcome"),
+    "aigrademe_chunked_uploads_total": ("counter", "Chunked uploads, by event (started, chunk, offset_mismatch, finished, rejected, expired)"),
+    "aigrademe_chunked_upload_bytes_total": ("counter", "Photo bytes received through chunked uploads"),
+    "aigrademe_file_handles_total": ("counter", "Photos sent by uploaded-file handle, by outcome (hit, uploaded, inline, failed, gone)"),
+    "aigrademe_context_cache_tokens_total": ("counter", "Prompt tokens the provider read from a cached-content handle"),
+}
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _key(labels):
+    if not labels:
+        return ""
+    return ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+
+
+class Registry:
+    """This process's metrics, flushed to a shared directory for aggregation."""
+
+    def __init__(self, metrics_dir=METRICS_DIR):
+        self.metrics_dir = metrics_dir
+        self._values = {}       # name -> {label key: value or [bucket counts..., sum, count]}
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+        self._timer = None
+        self._pid = os.getpid()
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+        except OSError as e:
+            logging.warning("Metrics directory unavailable: %s", e)
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            series = self._series(name)
+            key = _key(labels)
+            series[key] = series.get(key, 0) + value
+        self._maybe_flush()
+
+    def gauge_add(self, name, delta, labels=None):
+        self.inc(name, labels, delta)
+
+    def observe(self, name, seconds, labels=None):
+        with self._lock:
+            series = self._series(name)
+            key = _key(labels)
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+        self._maybe_flush()
+
+    def _series(self, name):
+        # Caller holds the lock. After a fork (gunicorn --preload) the child
+        # starts from zero instead of double-counting the parent's numbers.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._values = {}
+            self._timer = None
+        return self._values.setdefault(name, {})
+
+    def _maybe_flush(self):
+        # Write now if the last write is old enough, else once the interval is up.
+        with self._lock:
+            if self._timer is not None:
+                return
+            wait = METRICS_FLUSH_INTERVAL - (time.monotonic() - self._flushed)
+            if wait > 0:
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            self._flushed = time.monotonic()
+            snapshot = json.dumps({"pid": os.getpid(), "values": self._values})
+        path = os.path.join(self.metrics_dir, f"{os.getpid()}.json")
+        try:
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(snapshot)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("Could not write metrics: %s", e)
+
+    def collect(self):
+        """All workers' metrics added up: name -> {label key: value}."""
+        self.flush()
+        total = {}
+        now = time.time()
+        for path in glob.glob(os.path.join(self.metrics_dir, "*.json")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                alive = _alive(data["pid"])
+                if not alive and now - os.path.getmtime(path) > METRICS_TTL:
+                    os.remove(path)
+                    continue
+            except (OSError, ValueError, KeyError):
+                continue
+            for name, series in data["values"].items():
+                if METRICS.get(name, ("counter",))[0] == "gauge" and not alive:
+                    continue   # a dead worker has nothing in flight
+                merged = total.setdefault(name, {})
+                for key, value in series.items():
+                    if isinstance(value, list):
+                        current = merged.setdefault(key, [0] * len(value))
+                        merged[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+        return total
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        values = self.collect()
+        for name, (kind, help_text) in METRICS.items():
+            series = values.get(name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{{{key}}} {value}" if key else f"{name} {value}")
+                    continue
+                sep = "," if key else ""
+                for bound, count in zip(BUCKETS, value):
+                    lines.append(f'{name}_bucket{{{key}{sep}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{key}{sep}le="+Inf"}} {value[-1]}')
+                lines.append(f"{name}_sum{{{key}}} {round(value[-2], 6)}" if key else f"{name}_sum {round(value[-2], 6)}")
+                lines.append(f"{name}_count{{{key}}} {value[-1]}" if key else f"{name}_count {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+registry = Registry()
+inc = registry.inc
+gauge_add = registry.gauge_add
+observe = registry.observe
+render = registry.render
+
+
+# ----------------------------------------------------------------------
+# Stage timing and Server-Timing
+# ----------------------------------------------------------------------
+def begin_request():
+    """Start collecting Server-Timing entries for the current request."""
+    _request_timings.set([])
+
+
+def server_timing():
+    """The Server-Timing header value for the current request ("" if none)."""
+    timings = _request_timings.get() or []
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
+
+
+def record_stage(name, seconds, labels=None):
+    observe("aigrademe_stage_seconds", seconds, dict(labels or {}, stage=name))
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage(name, labels=None):
+    """with stage("parse"): ...  -> histogram + Server-Timing entry."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, labels)
+
+
+def propagate(fn):
+    """Wrap fn to run in a copy of the caller's context (keeps Server-Timing across pools)."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+def init_app(app):
+    """Request counters, durations, in-flight gauge and Server-Timing for a Flask app."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start():
+        g.metrics_start = time.perf_counter()
+        begin_request()
+        gauge_add("aigrademe_requests_in_flight", 1)
+
+    @app.after_request
+    def _finish(response):
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            gauge_add("aigrademe_requests_in_flight", -1)
+            observe("aigrademe_request_seconds", time.perf_counter() - start, {"endpoint": endpoint})
+        inc("aigrademe_requests_total", {"endpoint": endpoint, "status": response.status_code})
+        timing = server_timing()
+        if timing:
+            response.headers["Server-Timing"] = timing
+        return response
+
+    @app.teardown_request
+    def _teardown(exc):
+        # after_request is skipped on an unhandled exception
+        if g.pop("metrics_start", None) is not None:
+            gauge_add("aigrademe_requests_in_flight", -1)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
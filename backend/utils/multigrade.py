@@ -0,0 +1,161 @@
+# utils/multigrade.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Grades several sketches in one provider call.
+#
+# Each grading call resends the whole rubric prompt, and during bulk
+# grading that prompt is most of the input tokens. With MULTI_IMAGE_MAX > 1,
+# grades waiting at the same time are collected for up to
+# MULTI_IMAGE_WINDOW seconds (or until K are waiting), then sent as one
+# request: the prompt once, then "Image 1:", image, "Image 2:", image...
+# The reply is {"grades": [{"image": 1, "scores": ..., "feedback": ...}, ...]},
+# and each waiting grade gets its own object back in the usual
+# single-image shape, so parsing and caching don't change.
+#
+# A grade the reply leaves out, or a multi-image call that fails, is sent
+# again on its own by the request waiting for it (the usual hedged call).
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils import metrics, ratelimit, scoring
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+MULTI_IMAGE_MAX = int(os.environ.get("MULTI_IMAGE_MAX", "1"))              # K images per call, 1 = off
+MULTI_IMAGE_WINDOW = float(os.environ.get("MULTI_IMAGE_WINDOW", "0.2"))    # seconds to wait for more
+MULTI_IMAGE_WORKERS = int(os.environ.get("MULTI_IMAGE_WORKERS", "8"))      # multi-image calls at once
+
+
+def prompt(rubric, count):
+    """The rubric prompt, told to expect `count` labeled images."""
+    return (
+        f"{rubric.prompt}\n\n"
+        f"You will get {count} separate submissions, each a photo labeled \"Image N:\". "
+        f"Grade each one on its own, exactly as described above. Return only JSON of the form "
+        f"{{\"grades\": [{{\"image\": N, \"scores\": {{...}}, \"feedback\": \"...\"}}, ...]}} "
+        f"with one entry per image, in order."
+    )
+
+
+def tokens(rubric, count):
+    """Rate-limit estimate for one call: the prompt once, then each image and its reply."""
+    return len(prompt(rubric, count)) // 4 + count * (ratelimit.IMAGE_TOKENS + ratelimit.REPLY_TOKENS)
+
+
+def gemini_schema(categories):
+    item = scoring.gemini_schema(categories)
+    item["properties"] = {"image": {"type": "INTEGER"}, **item["properties"]}
+    item["required"] = ["image"] + item["required"]
+    return {"type": "OBJECT", "properties": {"grades": {"type": "ARRAY", "items": item}}, "required": ["grades"]}
+
+
+def json_schema(categories):
+    item = scoring.json_schema(categories)
+    item["properties"] = {"image": {"type": "integer"}, **item["properties"]}
+    item["required"] = ["image"] + item["required"]
+    return {"type": "object", "properties": {"grades": {"type": "array", "items": item}},
+            "required": ["grades"], "additionalProperties": False}
+
+
+def split(text, count):
+    """
+    One reply text per image (the single-image JSON shape), or None where
+    the reply has nothing usable for that image.
+    """
+    data = scoring.extract_json(text)
+    grades = data.get("grades") if isinstance(data, dict) else data
+    replies = [None] * count
+    if not isinstance(grades, list):
+        return replies
+    for position, grade in enumerate(grades):
+        if not isinstance(grade, dict):
+            continue
+        number = grade.pop("image", position + 1)
+        if isinstance(number, int) and 1 <= number <= count and replies[number - 1] is None:
+            replies[number - 1] = json.dumps(grade)
+    return replies
+
+
+def as_result(text):
+    # The Gemini-shaped result every caller already reads
+    return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+
+class Batcher:
+    """
+    Collects analyze(image, mime, rubric) calls and grades them K at a time.
+
+    grade_many([(image, mime), ...], rubric) returns one entry per image:
+    its result, or None when the caller should grade it on its own (see
+    ProviderRouter.analyze_many).
+    """
+
+    def __init__(self, grade_many, max_items=MULTI_IMAGE_MAX, window=MULTI_IMAGE_WINDOW,
+                 workers=MULTI_IMAGE_WORKERS):
+        self.grade_many = grade_many
+        self.max_items = max_items
+        self.window = window
+        self.workers = workers
+        self._groups = {}        # (rubric id, version) -> (rubric, [(image, mime, future)], deadline)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+
+    def submit(self, image, mime, rubric):
+        """Queue one image; returns a Future of its result (or None, see above)."""
+        future = Future()
+        key = (rubric.id, rubric.version)
+        with self._cond:
+            self._start()
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = (rubric, [], time.monotonic() + self.window)
+            group[1].append((image, mime, future))
+            if len(group[1]) >= self.max_items:
+                self._send(key)
+            else:
+                self._cond.notify()
+        return future
+
+    def _start(self):
+        # Caller holds the lock. Threads don't survive a fork, so (re)start per process.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._groups = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="multi-image")
+        self._thread = threading.Thread(target=self._loop, name="multi-image-window", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        # Sends each group when its window is up
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for key in [k for k, (_, _, deadline) in self._groups.items() if deadline <= now]:
+                    self._send(key)
+                deadlines = [deadline for _, _, deadline in self._groups.values()]
+                self._cond.wait(timeout=max(0.0, min(deadlines) - now) if deadlines else None)
+
+    def _send(self, key):
+        # Caller holds the lock
+        rubric, items, _ = self._groups.pop(key)
+        self._executor.submit(self._run, rubric, items)
+
+    def _run(self, rubric, items):
+        metrics.inc("aigrademe_multi_image_calls_total", {"images": len(items)})
+        try:
+            results = self.grade_many([(image, mime) for image, mime, _ in items], rubric)
+        except Exception:
+            logging.exception("Multi-image grade failed")
+            results = [None] * len(items)
+        for (_, _, future), result in zip(items, results):
+            metrics.inc("aigrademe_multi_image_items_total", {"outcome": "single" if result is None else "shared"})
+            future.set_result(result)
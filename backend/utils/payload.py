@@ -0,0 +1,158 @@
+# utils/payload.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Builds provider request bodies without extra copies of the image.
+#
+# The old path was: upload -> temp file -> read back -> base64 str ->
+# nested dict -> json.dumps. For a 10 MB photo that is several full copies.
+# Here the JSON around the image is serialized once, and per request only
+# the base64 bytes are produced (one encoding pass) and streamed out
+# between the pre-built pieces.
+
+import base64
+import io
+import json
+import os
+
+from flask import Request
+
+# Placeholders put in a payload dict where the image and its MIME type go
+IMAGE = "\x00IMAGE\x00"
+MIME = "\x00MIME\x00"
+
+_MIME_BY_EXT = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+def mime_for(filename: str) -> str:
+    """MIME type from a file name's extension."""
+    ext = os.path.splitext(filename)[1].lower()
+    return _MIME_BY_EXT.get(ext.lstrip("."), "application/octet-stream")
+
+
+class InMemoryRequest(Request):
+    """
+    Flask request class that keeps file uploads in a BytesIO.
+    Werkzeug's default spools anything over 500 KB to a temp file, which we
+    would only read straight back. Use with app.request_class.
+    """
+
+    # Request body cap in bytes for this request (None: the app's
+    # MAX_CONTENT_LENGTH). Set it before the form is read; werkzeug then
+    # answers 413 as soon as the upload passes it, without buffering the rest.
+    upload_limit = None
+
+    @property
+    def max_content_length(self):
+        if self.upload_limit is not None:
+            return self.upload_limit
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+def upload_bytes(file_storage):
+    """The bytes of an uploaded file; no copy when it is held in a BytesIO."""
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue()
+    return file_storage.read()
+
+
+class SplicedBody:
+    """
+    A read-only file-like request body made of several byte buffers.
+
+    requests / urllib3 read it in blocks and send a Content-Length header,
+    so the buffers are never joined into one big bytes object.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = [memoryview(c).cast("B") for c in chunks if len(c)]
+        self._length = sum(len(c) for c in self._chunks)
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            block = self.read(64 * 1024)
+            if not block:
+                return
+            yield block
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        out = []
+        while size > 0 and self._index < len(self._chunks):
+            chunk = self._chunks[self._index]
+            piece = chunk[self._offset:self._offset + size]
+            out.append(piece)
+            size -= len(piece)
+            self._offset += len(piece)
+            if self._offset >= len(chunk):
+                self._index += 1
+                self._offset = 0
+        return b"".join(out)
+
+    def tell(self):
+        return sum(len(c) for c in self._chunks[:self._index]) + self._offset
+
+    def seek(self, offset, whence=0):
+        """Rewind support for retries (and requests' redirect handling)."""
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self._length
+        self._index, self._offset = 0, 0
+        while self._index < len(self._chunks) and offset >= len(self._chunks[self._index]):
+            offset -= len(self._chunks[self._index])
+            self._index += 1
+        self._offset = offset if self._index < len(self._chunks) else 0
+        return self.tell()
+
+    def getvalue(self) -> bytes:
+        """The whole body as bytes (copies; for logging and tests only)."""
+        return b"".join(self._chunks)
+
+
+class JsonTemplate:
+    """
+    A provider payload serialized once, with holes for the image.
+
+    Build it from a dict that uses IMAGE and MIME as placeholder strings,
+    then render(mime, image_bytes) per request.
+    """
+
+    def __init__(self, payload):
+        text = json.dumps(payload, ensure_ascii=False)
+        self._pieces = []   # alternating literal bytes and placeholder names
+        for part in text.split(_json_str(IMAGE)):
+            if self._pieces:
+                self._pieces.append(IMAGE)
+            for i, literal in enumerate(part.split(_json_str(MIME))):
+                if i:
+                    self._pieces.append(MIME)
+                self._pieces.append(literal.encode("utf-8"))
+
+    def render(self, mime: str, image) -> SplicedBody:
+        """Body for one request. image may be bytes, bytearray or a memoryview."""
+        encoded = base64.b64encode(image)
+        mime_bytes = _json_str(mime).encode("utf-8")
+        chunks = []
+        for piece in self._pieces:
+            if piece is IMAGE:
+                chunks.append(encoded)
+            elif piece is MIME:
+                chunks.append(mime_bytes)
+            else:
+                chunks.append(piece)
+        return SplicedBody(chunks)
+
+
+def _json_str(value: str) -> str:
+    # The inside of a JSON string literal, without the quotes.
+    return json.dumps(value, ensure_ascii=False)[1:-1]
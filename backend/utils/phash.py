@@ -0,0 +1,188 @@
+# utils/phash.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Finds earlier photos of the same sketch (near-duplicates).
+#
+# A new photo of an unchanged sketch (other angle, light, crop) has
+# different bytes, so the exact-bytes grade cache misses it. Each graded
+# upload gets a 64-bit difference hash (dHash): similar pictures have hashes
+# that differ in few bits. Hashes are kept per student + rubric version in
+# a BK-tree, which finds everything within a Hamming distance without
+# comparing against every stored hash.
+#
+# A 64-bit dHash is coarse: adding a compass rose and a scale bar to a
+# sketch (exactly what a corrected submission looks like) moves it only a
+# few bits. So by default only an identical hash reuses a grade without a
+# provider call; anything else close goes through the confirm-only check.
+#
+# Entries live in SQLite (shared by all workers, like the grade cache)
+# with a small grayscale thumbnail, used for the confirm-only check.
+
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from utils import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it there is no near-duplicate check
+    Image = None
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+PHASH = os.environ.get("PHASH", "1").lower() in ("1", "true", "yes") and Image is not None
+PHASH_REUSE_DISTANCE = int(os.environ.get("PHASH_REUSE_DISTANCE", "0"))     # <= this: same sketch, -1: always confirm
+PHASH_CONFIRM_DISTANCE = int(os.environ.get("PHASH_CONFIRM_DISTANCE", "10"))  # <= this: ask the AI to confirm
+PHASH_DB = os.environ.get("PHASH_DB", os.path.join(tempfile.gettempdir(), "aigrademe-phash.sqlite3"))
+PHASH_TTL = int(os.environ.get("PHASH_TTL", str(30 * 86400)))               # seconds an entry is kept
+THUMB_SIDE = 256
+
+HASH_SIZE = 8   # 8x8 bits
+
+
+def fingerprint(image):
+    """(dHash as int, small JPEG thumbnail) for an upload, or None if it can't be read."""
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(image))
+        img.draft("L", (THUMB_SIDE * 2, THUMB_SIDE * 2))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img.thumbnail((THUMB_SIDE, THUMB_SIDE))
+        small = img.resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=70)
+    except Exception as e:
+        logging.warning("No perceptual hash (%s: %s)", type(e).__name__, e)
+        return None
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value, out.getvalue()
+
+
+def distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes with Hamming distance."""
+
+    def __init__(self):
+        self.root = None   # [hash, item, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, item, {}]
+            return
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, item, {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """[(distance, item)] within max_distance, closest first."""
+        found = []
+        todo = [self.root] if self.root is not None else []
+        while todo:
+            node = todo.pop()
+            d = distance(value, node[0])
+            if d <= max_distance:
+                found.append((d, node[1]))
+            # Triangle inequality: only children at d±max_distance can match.
+            for child_d, child in node[2].items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    todo.append(child)
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class NearDuplicateIndex:
+    """Per-scope BK-trees of graded uploads, backed by SQLite."""
+
+    def __init__(self, db_path=PHASH_DB, ttl=PHASH_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._trees = {}    # scope -> (BKTree, last row id loaded)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        db = self._db()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS phashes ("
+            " id INTEGER PRIMARY KEY, scope TEXT NOT NULL, hash INTEGER NOT NULL,"
+            " cache_key TEXT NOT NULL, thumb BLOB, created REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS phashes_scope ON phashes (scope, id)")
+        db.execute("DELETE FROM phashes WHERE created < ?", (time.time() - ttl,))
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _tree(self, scope):
+        # Load the scope on first use, then only rows other workers added since.
+        with self._lock:
+            tree, last_id = self._trees.get(scope, (None, 0))
+            if tree is None:
+                tree = BKTree()
+            rows = self._db().execute(
+                "SELECT id, hash, cache_key FROM phashes WHERE scope = ? AND id > ? AND created >= ?",
+                (scope, last_id, time.time() - self.ttl),
+            ).fetchall()
+            for row_id, value, cache_key in rows:
+                tree.add(value & 0xFFFFFFFFFFFFFFFF, (row_id, cache_key))
+                last_id = max(last_id, row_id)
+            self._trees[scope] = (tree, last_id)
+            return tree
+
+    def nearest(self, scope, value, max_distance=None):
+        """(distance, row id, cache key) of the closest earlier upload, or None."""
+        if max_distance is None:
+            max_distance = max(PHASH_REUSE_DISTANCE, PHASH_CONFIRM_DISTANCE)
+        start = time.perf_counter()
+        try:
+            matches = self._tree(scope).search(value, max_distance)
+        except sqlite3.Error as e:
+            logging.warning("Near-duplicate lookup failed: %s", e)
+            return None
+        finally:
+            metrics.record_stage("phash_lookup", time.perf_counter() - start)
+        if not matches:
+            return None
+        d, (row_id, cache_key) = matches[0]
+        return d, row_id, cache_key
+
+    def thumbnail(self, row_id):
+        row = self._db().execute("SELECT thumb FROM phashes WHERE id = ?", (row_id,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, scope, value, cache_key, thumb):
+        try:
+            # SQLite integers are signed 64-bit
+            signed = value - (1 << 64) if value >= 1 << 63 else value
+            self._db().execute(
+                "INSERT INTO phashes (scope, hash, cache_key, thumb, created) VALUES (?, ?, ?, ?, ?)",
+                (scope, signed, cache_key, thumb, time.time()),
+            )
+        except sqlite3.Error as e:
+            logging.warning("Near-duplicate index write failed: %s", e)
@@ -0,0 +1,111 @@
+# utils/ratelimit.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Client-side request/token budget per AI provider.
+#
+# Providers allow N requests per minute (RPM) and N tokens per minute
+# (TPM). Instead of sending until we get 429s, every call takes from a
+# token bucket first. The bucket lives in a small file locked with flock,
+# so all gunicorn workers on the machine share one budget.
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+RATE_LIMIT_DIR = os.environ.get("RATE_LIMIT_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-ratelimit"))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "5"))   # seconds to wait for budget
+
+# Rough size of one grading call in tokens: the prompt (~4 chars/token),
+# one image (Gemini bills ~258 tokens per 768px tile; a 1600px photo is
+# about 6 tiles), plus the reply.
+IMAGE_TOKENS = 1600
+REPLY_TOKENS = 400
+
+
+def estimate_tokens(prompt: str) -> int:
+    return len(prompt) // 4 + IMAGE_TOKENS + REPLY_TOKENS
+
+
+class RateLimiter:
+    """
+    Shared RPM + TPM token buckets for one provider.
+    A limit of 0 means unlimited. If both are 0 this does nothing.
+    """
+
+    def __init__(self, name, rpm=0, tpm=0, state_dir=RATE_LIMIT_DIR):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.path = os.path.join(state_dir, f"{name}.json")
+        if rpm or tpm:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def acquire(self, tokens, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        Take one request and `tokens` tokens from the budget, waiting up to
+        max_wait seconds for it to refill. Returns True if taken.
+        """
+        if not (self.rpm or self.tpm):
+            return True
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._try_take(tokens)
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                logging.warning("%s: local rate limit, need to wait %.1fs", self.name, wait)
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        acquire() for the event loop: the locked file update runs on a worker
+        thread (a slow flock must not stall other requests), the wait is an
+        asyncio.sleep.
+        """
+        if not (self.rpm or self.tpm):
+            return True
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = await asyncio.to_thread(self._try_take, tokens)
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                logging.warning("%s: local rate limit, need to wait %.1fs", self.name, wait)
+                return False
+            await asyncio.sleep(wait)
+
+    def _try_take(self, tokens):
+        # Returns 0 if taken, otherwise seconds until there will be enough.
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                now = time.time()
+                buckets = [("requests", self.rpm, 1), ("tokens", self.tpm, min(tokens, self.tpm))]
+                levels = {}
+                wait = 0.0
+                for key, per_minute, need in buckets:
+                    if not per_minute:
+                        continue
+                    level, updated = state.get(key, (per_minute, now))
+                    level = min(per_minute, level + (now - updated) * per_minute / 60)
+                    levels[key] = level - need
+                    if level < need:
+                        wait = max(wait, (need - level) * 60 / per_minute)
+                if wait > 0:
+                    return wait
+                f.seek(0)
+                f.truncate()
+                json.dump({key: (level, now) for key, level in levels.items()}, f)
+                return 0
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,182 @@
+# utils/resumable.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Chunked, resumable photo uploads for the submission page.
+#
+# The page used to POST the phone's original photo (5-12 MB) in one
+# request. On a weak classroom connection that takes minutes, holds a
+# gunicorn worker while the body trickles in, and a dropped connection
+# means starting again from zero. Now the page shrinks the photo in the
+# browser to the size advertised by GET /uploads/config (the backend
+# would downscale it to that anyway, see utils/images.py), then:
+#
+#   POST  /uploads                   name, email, rubric, size -> upload_id
+#   PATCH /uploads/<id>?offset=N     the next chunk (at most UPLOAD_CHUNK_BYTES)
+#   GET   /uploads/<id>              how much has arrived, to resume
+#   POST  /uploads/<id>/finish       mode=stream|job -> same answers as /submit
+#
+# A chunk sent at the wrong offset (say, a retry of one whose answer was
+# lost) gets a 409 with the offset the server has, and the page carries on
+# from there. Each request is short, so no worker waits long on a slow
+# body, and after a network error only the missing bytes are sent again.
+#
+# Uploads live in files under UPLOAD_SESSION_DIR, so every worker on the
+# machine can take any chunk. An upload not touched for
+# UPLOAD_SESSION_TTL seconds is deleted; finished ones are deleted as soon
+# as grading starts (but kept on a 503, so "finish" can be tried again).
+
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+
+from utils import images, metrics, uploads
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", str(256 * 1024)))   # per PATCH
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", "3600"))            # seconds since the last chunk
+UPLOAD_SESSION_DIR = os.environ.get("UPLOAD_SESSION_DIR", os.path.join(tempfile.gettempdir(), "aigrademe-uploads"))
+UPLOAD_TARGET_SIDE = int(os.environ.get("UPLOAD_TARGET_SIDE", str(images.IMAGE_MAX_SIDE or 2048)))  # px
+UPLOAD_TARGET_BYTES = int(os.environ.get("UPLOAD_TARGET_BYTES", str(1024 * 1024)))  # re-encode until below
+UPLOAD_TARGET_QUALITY = float(os.environ.get("UPLOAD_TARGET_QUALITY", "0.9"))       # first JPEG quality tried
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_MISSING = "This upload has expired or doesn't exist. Please submit again."
+_ORPHAN_GRACE = 60   # seconds: create() writes the .part just before the .json
+
+
+def client_config():
+    """What the page shrinks photos to before uploading, and the chunk size."""
+    return {
+        "max_side": UPLOAD_TARGET_SIDE,
+        "min_side": uploads.UPLOAD_MIN_SIDE,
+        "max_bytes": UPLOAD_TARGET_BYTES,
+        "quality": UPLOAD_TARGET_QUALITY,
+        "type": "image/jpeg",
+        "chunk_bytes": UPLOAD_CHUNK_BYTES,
+        "upload_max_bytes": uploads.UPLOAD_MAX_BYTES,
+    }
+
+
+class UploadError(Exception):
+    """A chunked-upload request that can't be served. .offset is set on a 409."""
+
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadSessions:
+    """Uploads in progress: <id>.json (size and form fields) and <id>.part (the bytes so far)."""
+
+    def __init__(self, directory=UPLOAD_SESSION_DIR, ttl=UPLOAD_SESSION_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, size, fields):
+        """Start an upload of `size` bytes; fields are the /submit form fields. Returns its id."""
+        if size <= 0:
+            raise UploadError(uploads.MESSAGES["empty"], 400)
+        if size > uploads.UPLOAD_MAX_BYTES:
+            uploads.reject("too_large")
+            raise UploadError(uploads.MESSAGES["too_large"], 413)
+        self.sweep()
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path = self._paths(upload_id)
+        tmp = f"{meta_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"size": size, "fields": fields, "created": time.time()}, f)
+        open(part_path, "wb").close()
+        os.replace(tmp, meta_path)
+        metrics.inc("aigrademe_chunked_uploads_total", {"event": "started"})
+        return upload_id
+
+    def status(self, upload_id):
+        meta = self._meta(upload_id)
+        return {"upload_id": upload_id, "offset": os.path.getsize(self._paths(upload_id)[1]), "size": meta["size"]}
+
+    def append(self, upload_id, offset, data):
+        """Write a chunk at `offset`, which must be where the upload stands. Returns the new offset."""
+        meta = self._meta(upload_id)
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            f = open(part_path, "r+b")   # not "ab": that would bring back a discarded upload's file
+        except FileNotFoundError:
+            raise UploadError(_MISSING, 404)
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)   # two copies of one chunk may race
+            if not os.path.exists(meta_path):   # finished or discarded since _meta
+                raise UploadError(_MISSING, 404)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                metrics.inc("aigrademe_chunked_uploads_total", {"event": "offset_mismatch"})
+                raise UploadError(f"Expected offset {current}", 409, current)
+            if current + len(data) > meta["size"]:
+                raise UploadError(f"The upload is {meta['size']} bytes", 413, current)
+            f.write(data)
+        metrics.inc("aigrademe_chunked_uploads_total", {"event": "chunk"})
+        metrics.inc("aigrademe_chunked_upload_bytes_total", value=len(data))
+        return current + len(data)
+
+    def read(self, upload_id):
+        """(fields, image bytes) of a complete upload."""
+        meta = self._meta(upload_id)
+        with open(self._paths(upload_id)[1], "rb") as f:
+            image = f.read()
+        if len(image) != meta["size"]:
+            raise UploadError(f"Only {len(image)} of {meta['size']} bytes have arrived", 409, len(image))
+        return meta["fields"], image
+
+    def discard(self, upload_id, event="finished"):
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        metrics.inc("aigrademe_chunked_uploads_total", {"event": event})
+
+    def sweep(self):
+        """Delete uploads nobody has touched for ttl seconds, and .part files left without their .json."""
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            upload_id, ext = os.path.splitext(entry.name)
+            if not _ID_RE.match(upload_id):
+                continue
+            if ext == ".json" and self._last_touched(upload_id) < now - self.ttl:
+                self.discard(upload_id, "expired")
+                logging.info("Deleted abandoned upload %s", upload_id)
+            elif ext == ".part" and not os.path.exists(self._paths(upload_id)[0]):
+                try:
+                    if entry.stat().st_mtime < now - _ORPHAN_GRACE:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    # ------------------------------------------------------------------
+    def _paths(self, upload_id):
+        base = os.path.join(self.directory, upload_id)
+        return f"{base}.json", f"{base}.part"
+
+    def _last_touched(self, upload_id):
+        try:
+            return max(os.path.getmtime(path) for path in self._paths(upload_id))
+        except OSError:
+            return 0
+
+    def _meta(self, upload_id):
+        missing = UploadError(_MISSING, 404)
+        if not _ID_RE.match(upload_id or "") or self._last_touched(upload_id) < time.time() - self.ttl:
+            raise missing
+        try:
+            with open(self._paths(upload_id)[0], encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise missing
@@ -0,0 +1,170 @@
+# utils/retry.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Retries provider calls and turns failures into clear messages.
+#
+# 429s and 5xx are retried with jittered exponential backoff, honoring the
+# provider's Retry-After header, within a total time budget. Anything that
+# still fails comes back as {"ai_error": <message for the student>,
+# "error_kind": <kind>}, one message per kind of failure, instead of a
+# blanket "AI model may be overloaded". apost() is the same for asyncio.
+
+import asyncio
+import logging
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from utils import http_client, metrics
+
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", "3"))          # retries after the first try
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))  # seconds, doubled each retry
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "8"))
+RETRY_BUDGET = float(os.environ.get("RETRY_BUDGET", "20"))           # total seconds spent retrying
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+ERROR_MESSAGES = {
+    "rate_limited": "The AI grader is busy right now. Please try again in a minute.",
+    "overloaded": "AI model may be overloaded. Please try again later.",
+    "timeout": "The AI grader took too long to answer. Please try again.",
+    "connection": "Could not reach the AI grader. Please try again shortly.",
+    "rejected": "The AI grader could not read this image. Please upload a clear JPG or PNG photo.",
+    "auth": "The grading service is not set up correctly. Please let your instructor know.",
+    "bad_response": "AI response error. Please try again later.",
+}
+
+# Failures caused by the submission itself: another provider won't do better.
+CLIENT_ERRORS = {"rejected"}
+
+
+def error(kind, details=None, retry_after=None):
+    """The error dict returned by provider modules."""
+    result = {"ai_error": ERROR_MESSAGES[kind], "error_kind": kind}
+    if details:
+        result["details"] = details
+    if retry_after:
+        result["retry_after"] = retry_after
+    return result
+
+
+def post(url, limiter=None, tokens=0, provider="AI", **kwargs):
+    """
+    POST with rate limiting and retries. Returns (response, None) on a 200,
+    or (None, error_dict) when it gave up. A file-like `data` body is
+    rewound before each retry.
+    """
+    deadline = time.monotonic() + RETRY_BUDGET
+    body = kwargs.get("data")
+    attempt = 0
+    while True:
+        if limiter is not None and not limiter.acquire(tokens):
+            return None, error("rate_limited", "local rate limit")
+
+        kind, delay, details = None, None, None
+        labels = {"provider": provider.lower()}
+        metrics.gauge_add("aigrademe_provider_calls_in_flight", 1, labels)
+        try:
+            if hasattr(body, "seek"):
+                body.seek(0)
+            resp = http_client.post(url, **kwargs)
+        except requests.Timeout as e:
+            kind, details = "timeout", str(e)
+        except requests.ConnectionError as e:
+            kind, details = "connection", str(e)
+        else:
+            metrics.inc("aigrademe_provider_responses_total", dict(labels, status=resp.status_code))
+            if resp.status_code == 200:
+                return resp, None
+            kind, delay, details = _failure(resp, provider)
+        finally:
+            metrics.gauge_add("aigrademe_provider_calls_in_flight", -1, labels)
+
+        delay, failed = _next_try(kind, delay, details, attempt, deadline, labels, provider)
+        if failed:
+            return None, failed
+        attempt += 1
+        time.sleep(delay)
+
+
+async def apost(url, limiter=None, tokens=0, provider="AI", **kwargs):
+    """post() on the event loop, through http_client.apost (needs httpx)."""
+    import httpx
+
+    deadline = time.monotonic() + RETRY_BUDGET
+    body = kwargs.get("data")
+    attempt = 0
+    while True:
+        if limiter is not None and not await limiter.acquire_async(tokens):
+            return None, error("rate_limited", "local rate limit")
+
+        kind, delay, details = None, None, None
+        labels = {"provider": provider.lower()}
+        metrics.gauge_add("aigrademe_provider_calls_in_flight", 1, labels)
+        try:
+            if hasattr(body, "seek"):
+                body.seek(0)
+            resp = await http_client.apost(url, **kwargs)
+        except httpx.TimeoutException as e:
+            kind, details = "timeout", str(e) or type(e).__name__
+        except httpx.TransportError as e:
+            kind, details = "connection", str(e) or type(e).__name__
+        else:
+            metrics.inc("aigrademe_provider_responses_total", dict(labels, status=resp.status_code))
+            if resp.status_code == 200:
+                return resp, None
+            kind, delay, details = _failure(resp, provider)
+        finally:
+            metrics.gauge_add("aigrademe_provider_calls_in_flight", -1, labels)
+
+        delay, failed = _next_try(kind, delay, details, attempt, deadline, labels, provider)
+        if failed:
+            return None, failed
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+def _failure(resp, provider):
+    # (kind, Retry-After delay or None, details) for a non-200 response
+    details = f"{provider} error {resp.status_code}: {resp.text[:200]}"
+    if resp.status_code == 429:
+        return "rate_limited", retry_after_seconds(resp.headers.get("Retry-After")), details
+    if resp.status_code in (401, 403):
+        return "auth", None, details
+    if resp.status_code in RETRY_STATUS:
+        return "overloaded", retry_after_seconds(resp.headers.get("Retry-After")), details
+    if 400 <= resp.status_code < 500:
+        return "rejected", None, details
+    return "overloaded", None, details
+
+
+def _next_try(kind, delay, details, attempt, deadline, labels, provider):
+    # -> (seconds to wait before retrying, None) or (None, error dict) to give up
+    if kind in ("timeout", "connection"):
+        metrics.inc("aigrademe_provider_responses_total", dict(labels, status=kind))
+    retryable = kind in ("rate_limited", "overloaded", "timeout", "connection")
+    if delay is None:
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if not retryable or attempt >= RETRY_ATTEMPTS or time.monotonic() + delay > deadline:
+        logging.error("%s request failed (%s): %s", provider, kind, details)
+        return None, error(kind, details, retry_after=round(delay) if kind == "rate_limited" else None)
+    metrics.inc("aigrademe_provider_retries_total", dict(labels, kind=kind))
+    logging.warning("%s %s, retry %d/%d in %.1fs", provider, kind, attempt + 1, RETRY_ATTEMPTS, delay)
+    return delay, None
+
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header (seconds or HTTP date). None if missing or bad."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
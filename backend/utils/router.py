@@ -0,0 +1,396 @@
+# utils/router.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Routes grading calls across AI providers (Gemini, Grok).
+#
+# Providers are interchangeable: each one is an analyze(image, mime, rubric)
+# function returning the Gemini-shaped response, or {"ai_error": ...}, plus
+# optionally a text-only complete(prompt, rubric, fields) used for follow-ups,
+# a stream(image, mime, rubric) generator of reply text chunks, and
+# compare(jpeg_a, jpeg_b) for the near-duplicate confirm check, and
+# analyze_many([(image, mime), ...], rubric) for multi-image calls
+# (utils/multigrade.py). For the
+# ASGI app a provider can also have async analyze / stream functions;
+# analyze_async() and stream_async() use those, with at most
+# PROVIDER_CONCURRENCY calls in flight per provider.
+#
+# - Hedging: if the primary hasn't answered within its usual latency
+#   (HEDGE_PERCENTILE of recent calls), the same image is also sent to the
+#   next provider and whichever answers first wins.
+# - Circuit breaking: a provider that keeps failing is skipped for
+#   BREAKER_COOLDOWN seconds, then gets one trial call before it is used
+#   again.
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import metrics, retry
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+HEDGE = os.environ.get("HEDGE", "1").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "2"))       # never hedge sooner than this
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "10"))  # until we have enough samples
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))       # consecutive failures to open
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))  # or this error rate...
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))          # ...over this many calls
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))    # seconds before a trial call
+PROVIDER_CONCURRENCY = int(os.environ.get("PROVIDER_CONCURRENCY", "100"))  # async calls in flight per provider
+
+MIN_SAMPLES = 20
+
+ALL_DOWN = {"ai_error": "AI graders are temporarily unavailable. Please try again in a minute."}
+
+
+def percentile(values, pct):
+    """pct-th percentile (0-100) of a non-empty sequence, nearest-rank."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Provider:
+    """One AI backend plus its recent latency, error rate and breaker state."""
+
+    def __init__(self, name, analyze, model, complete=None, stream=None, compare=None,
+                 analyze_async=None, stream_async=None, analyze_many=None):
+        self.name = name
+        self.analyze = analyze
+        self.model = model
+        self.complete = complete
+        self.stream = stream
+        self.compare = compare
+        self.analyze_async = analyze_async
+        self.stream_async = stream_async
+        self.analyze_many = analyze_many
+        self.slots = asyncio.Semaphore(PROVIDER_CONCURRENCY)   # bounds the async calls only
+        self._latencies = deque(maxlen=200)              # seconds, successful calls
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)    # True = ok
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def available(self):
+        """True if calls may go here. After the cooldown, lets one trial call through."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._open_until:
+                return False
+            if self._open_until:
+                # Half-open: this caller is the trial; hold others off until it reports.
+                self._open_until = now + BREAKER_COOLDOWN
+            return True
+
+    def record(self, ok, latency):
+        with self._lock:
+            self._outcomes.append(ok)
+            if ok:
+                self._latencies.append(latency)
+                self._consecutive_failures = 0
+                self._open_until = 0.0
+                return
+            self._consecutive_failures += 1
+            errors = self._outcomes.count(False)
+            if (self._consecutive_failures >= BREAKER_FAILURES
+                    or (len(self._outcomes) >= BREAKER_WINDOW // 2
+                        and errors / len(self._outcomes) >= BREAKER_ERROR_RATE)):
+                if not self._open_until:
+                    logging.warning("Circuit open for %s (%d failures in a row, %d/%d recent)",
+                                    self.name, self._consecutive_failures, errors, len(self._outcomes))
+                self._open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    def hedge_delay(self):
+        """Seconds to wait for this provider before hedging to the next one."""
+        with self._lock:
+            if len(self._latencies) < MIN_SAMPLES:
+                return HEDGE_DEFAULT_DELAY
+            return max(HEDGE_MIN_DELAY, percentile(self._latencies, HEDGE_PERCENTILE))
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            outcomes = list(self._outcomes)
+            is_open = time.monotonic() < self._open_until
+        return {
+            "model": self.model,
+            "state": "open" if is_open else "closed",
+            "calls": len(outcomes),
+            "error_rate": round(outcomes.count(False) / len(outcomes), 3) if outcomes else 0.0,
+            "p50": round(percentile(latencies, 50), 3) if latencies else None,
+            "p95": round(percentile(latencies, 95), 3) if latencies else None,
+        }
+
+
+class ProviderRouter:
+    """Sends each grade to the first healthy provider, hedging to the next when it is slow."""
+
+    def __init__(self, providers, max_workers=16):
+        self.providers = providers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="provider")
+        self._tasks = set()   # async calls still running after a hedge was answered
+
+    @property
+    def model(self):
+        # Used in cache keys: any configured provider may produce the answer.
+        return "+".join(p.model for p in self.providers)
+
+    def analyze(self, image, mime, rubric=None):
+        candidates = list(self.providers)
+        pending = {}
+        last_error = ALL_DOWN
+
+        def launch():
+            # Start the next provider whose breaker allows a call, if any.
+            while candidates:
+                provider = candidates.pop(0)
+                if provider.available():
+                    pending[self._executor.submit(metrics.propagate(self._call), provider, image, mime, rubric)] = provider
+                    return provider
+            return None
+
+        primary = launch()
+        if primary is None:
+            logging.error("All providers are open-circuited")
+            return ALL_DOWN
+        hedge_at = time.monotonic() + primary.hedge_delay()
+        while pending:
+            timeout = None
+            if HEDGE and candidates:
+                timeout = max(0.0, hedge_at - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge = launch()
+                if hedge is not None:
+                    logging.info("Hedging: %s slow, also asking %s", primary.name, hedge.name)
+                continue
+            for future in done:
+                pending.pop(future)
+                result = future.result()
+                if "ai_error" not in result or result.get("error_kind") in retry.CLIENT_ERRORS:
+                    # Anything still running finishes in the background; its
+                    # latency still counts toward that provider's stats.
+                    # A rejected image won't do better elsewhere, so no failover.
+                    return result
+                last_error = result
+            if not pending:
+                # Everything in flight failed: fail over right away.
+                launch()
+        return last_error
+
+    def stream(self, image, mime, rubric=None):
+        """
+        Streaming grade: yields (provider name, text chunk) as the reply is
+        generated, or (provider name, error dict) and stops. Fails over to the
+        next provider only before the first chunk; no hedging, since the
+        student is already watching this one.
+        """
+        last_error = ALL_DOWN
+        for provider in self.providers:
+            if provider.stream is None or not provider.available():
+                continue
+            start = time.monotonic()
+            started = False
+            for item in provider.stream(image, mime, rubric):
+                if isinstance(item, dict):
+                    client_error = item.get("error_kind") in retry.CLIENT_ERRORS
+                    provider.record(client_error, time.monotonic() - start)
+                    if started or client_error:
+                        yield provider.name, item
+                        return
+                    last_error = item
+                    break
+                if not started:
+                    started = True
+                    metrics.record_stage("first_token", time.monotonic() - start, {"provider": provider.name})
+                yield provider.name, item
+            else:
+                provider.record(True, time.monotonic() - start)
+                metrics.record_stage("provider", time.monotonic() - start, {"provider": provider.name})
+                return
+            logging.warning("%s stream failed before the first token, trying the next provider", provider.name)
+        yield None, last_error
+
+    async def analyze_async(self, image, mime, rubric=None):
+        """analyze() on the event loop: same hedging and failover, no threads."""
+        candidates = [p for p in self.providers if p.analyze_async is not None]
+        pending = {}
+        last_error = ALL_DOWN
+        answered = asyncio.Event()
+
+        def launch():
+            while candidates:
+                provider = candidates.pop(0)
+                if provider.available():
+                    task = asyncio.ensure_future(self._call_async(provider, image, mime, rubric, answered))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    pending[task] = provider
+                    return provider
+            return None
+
+        primary = launch()
+        if primary is None:
+            logging.error("All providers are open-circuited")
+            return ALL_DOWN
+        hedge_at = time.monotonic() + primary.hedge_delay()
+        while pending:
+            timeout = None
+            if HEDGE and candidates:
+                timeout = max(0.0, hedge_at - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge = launch()
+                if hedge is not None:
+                    logging.info("Hedging: %s slow, also asking %s", primary.name, hedge.name)
+                continue
+            for task in done:
+                pending.pop(task)
+                result = task.result()
+                if "ai_error" not in result or result.get("error_kind") in retry.CLIENT_ERRORS:
+                    # A losing call in flight keeps running (held in
+                    # self._tasks) so its latency still counts; one still
+                    # waiting for a slot gives up.
+                    answered.set()
+                    return result
+                last_error = result
+            if not pending:
+                launch()
+        return last_error
+
+    async def stream_async(self, image, mime, rubric=None):
+        """stream() as an async generator, using the providers' stream_async."""
+        last_error = ALL_DOWN
+        for provider in self.providers:
+            if provider.stream_async is None or not provider.available():
+                continue
+            start = time.monotonic()
+            started = False
+            failed = None
+            async with provider.slots, aclosing(provider.stream_async(image, mime, rubric)) as items:
+                async for item in items:
+                    if isinstance(item, dict):
+                        failed = item
+                        break
+                    if not started:
+                        started = True
+                        metrics.record_stage("first_token", time.monotonic() - start, {"provider": provider.name})
+                    yield provider.name, item
+            if failed is None:
+                provider.record(True, time.monotonic() - start)
+                metrics.record_stage("provider", time.monotonic() - start, {"provider": provider.name})
+                return
+            client_error = failed.get("error_kind") in retry.CLIENT_ERRORS
+            provider.record(client_error, time.monotonic() - start)
+            if started or client_error:
+                yield provider.name, failed
+                return
+            last_error = failed
+            logging.warning("%s stream failed before the first token, trying the next provider", provider.name)
+        yield None, last_error
+
+    def complete(self, prompt, rubric, fields=None, prefer=None):
+        """
+        Text-only follow-up (no image, no hedging). Tries `prefer` first (the
+        provider that wrote the reply being followed up), then the others.
+        """
+        return self._side_call("complete", (prompt, rubric, fields), prefer)
+
+    def compare(self, thumb_a, thumb_b):
+        """Confirm-only check on two small JPEGs: {"same": bool}, or an error dict."""
+        return self._side_call("compare", (thumb_a, thumb_b))
+
+    def analyze_many(self, items, rubric):
+        """
+        Grades several images in one call (utils/multigrade.py). Returns one
+        entry per image: its result, or None for images the reply skipped,
+        which the caller grades with analyze(). No hedging; fails over to the
+        next provider only if the whole call failed.
+        """
+        for provider in self.providers:
+            if provider.analyze_many is None or not provider.available():
+                continue
+            start = time.monotonic()
+            try:
+                results = provider.analyze_many(items, rubric)
+            except Exception as e:
+                logging.error("%s multi-image call failed: %s: %s", provider.name, type(e).__name__, e)
+                results = retry.error("overloaded", f"{type(e).__name__}: {e}")
+            metrics.record_stage("provider", time.monotonic() - start, {"provider": provider.name})
+            if isinstance(results, list):
+                for result in results:
+                    if result is not None:
+                        result["provider"] = provider.name
+                return results
+            if results.get("error_kind") in retry.CLIENT_ERRORS:
+                break   # one of the images was refused: grade each on its own
+            # Only failures count: a K-image call's latency would skew the hedge delay.
+            provider.record(False, time.monotonic() - start)
+        return [None] * len(items)
+
+    def _side_call(self, method, args, prefer=None):
+        # Small calls next to a grade: first healthy provider that has `method`.
+        providers = sorted(self.providers, key=lambda p: p.name != prefer)
+        result = ALL_DOWN
+        for provider in providers:
+            fn = getattr(provider, method)
+            if fn is None or not provider.available():
+                continue
+            start = time.monotonic()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                logging.error("%s %s failed: %s: %s", provider.name, method, type(e).__name__, e)
+                result = retry.error("overloaded", f"{type(e).__name__}: {e}")
+            if "ai_error" in result and result.get("error_kind") not in retry.CLIENT_ERRORS:
+                # Failures count toward the breaker; these short calls'
+                # latencies would skew the hedge delay, so successes aren't recorded.
+                provider.record(False, time.monotonic() - start)
+            if "ai_error" not in result:
+                result["provider"] = provider.name
+                return result
+        return result
+
+    def _call(self, provider, image, mime, rubric):
+        start = time.monotonic()
+        try:
+            result = provider.analyze(image, mime, rubric)
+        except Exception as e:
+            logging.error("%s call failed: %s: %s", provider.name, type(e).__name__, e)
+            result = retry.error("overloaded", f"{type(e).__name__}: {e}")
+        # Full round trip including retries; Server-Timing shows one entry per provider asked
+        metrics.record_stage("provider", time.monotonic() - start, {"provider": provider.name})
+        ok = "ai_error" not in result
+        # The provider answered; the submission was the problem.
+        provider.record(ok or result.get("error_kind") in retry.CLIENT_ERRORS, time.monotonic() - start)
+        if ok:
+            result["provider"] = provider.name
+        return result
+
+    async def _call_async(self, provider, image, mime, rubric, answered):
+        start = time.monotonic()
+        try:
+            async with provider.slots:
+                if answered.is_set():
+                    return ALL_DOWN
+                start = time.monotonic()   # time in the provider, not in the queue
+                result = await provider.analyze_async(image, mime, rubric)
+        except Exception as e:
+            logging.error("%s call failed: %s: %s", provider.name, type(e).__name__, e)
+            result = retry.error("overloaded", f"{type(e).__name__}: {e}")
+        metrics.record_stage("provider", time.monotonic() - start, {"provider": provider.name})
+        ok = "ai_error" not in result
+        provider.record(ok or result.get("error_kind") in retry.CLIENT_ERRORS, time.monotonic() - start)
+        if ok:
+            result["provider"] = provider.name
+        return result
+
+    def stats(self):
+        return {p.name: p.stats() for p in self.providers}
@@ -0,0 +1,167 @@
+# utils/rubrics.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Registry of grading rubrics (one per assignment).
+#
+# Each rubric is a text file in RUBRIC_DIR named <assignment id>.txt, in
+# the same format as prompt.txt (student-facing rubric, then a line
+# "=== PROMPT ===", then the grading prompt, then optionally a line
+# "=== CASCADE ===" and the rubric's cascade policy, see utils/cascade.py).
+# prompt.txt itself is always available as the "default" rubric.
+#
+# Files are read once and re-read only when their mtime changes, so
+# editing a rubric takes effect without restarting the workers. For each
+# rubric and provider the JSON request body is serialized once (see
+# payload.JsonTemplate); a request only adds the image.
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+from utils import cascade, payload, ratelimit
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RUBRIC_DIR = os.environ.get("RUBRIC_DIR", os.path.join(BACKEND_DIR, "rubrics"))
+DEFAULT_PROMPT_FILE = os.path.join(BACKEND_DIR, "prompt.txt")
+RUBRIC_CHECK_INTERVAL = float(os.environ.get("RUBRIC_CHECK_INTERVAL", "2"))  # seconds between mtime checks
+
+DEFAULT_ID = "default"
+SEPARATOR = "\n=== PROMPT ===\n"
+CASCADE_SEPARATOR = "\n=== CASCADE ===\n"
+RUBRIC_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Rubric lines like "1. Sketch – A clear house floor plan (25%)"
+CATEGORY_RE = re.compile(r"^\s*\d+[.)]\s*(?P<label>[^–:(-]+?)\s*[–:-].*\((?P<max>\d+)\s*%?\)\s*$", re.M)
+
+
+class Rubric:
+    """One parsed rubric file plus its precompiled provider request bodies."""
+
+    def __init__(self, rubric_id, path, text, mtime):
+        parts = text.strip().split(SEPARATOR, 1)
+        if len(parts) != 2:
+            raise ValueError(f"{path} must contain '=== PROMPT ===' separator")
+        self.id = rubric_id
+        self.path = path
+        self.mtime = mtime
+        prompt, _, policy = parts[1].partition(CASCADE_SEPARATOR)
+        self.text, self.prompt = parts[0].strip(), prompt.strip()
+        self.cascade = cascade.Policy.parse(policy)
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.tokens = ratelimit.estimate_tokens(self.prompt)
+        # [(key, label, max points)]; the response schema and score parser use these
+        self.categories = [
+            (m["label"].strip().lower().replace(" ", "_"), m["label"].strip(), int(m["max"]))
+            for m in CATEGORY_RE.finditer(self.text)
+        ]
+        self.checked = time.monotonic()
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def template(self, provider, build):
+        """
+        The provider's request body for this rubric, compiled on first use.
+        build(rubric) returns the payload dict with payload.IMAGE / payload.MIME
+        placeholders.
+        """
+        template = self._templates.get(provider)
+        if template is None:
+            with self._lock:
+                template = self._templates.get(provider)
+                if template is None:
+                    template = self._templates[provider] = payload.JsonTemplate(build(self))
+        return template
+
+
+class RubricRegistry:
+    def __init__(self, rubric_dir=RUBRIC_DIR, default_file=DEFAULT_PROMPT_FILE):
+        self.rubric_dir = rubric_dir
+        self.default_file = default_file
+        self._rubrics = {}
+        self._lock = threading.Lock()
+        self._scanned = 0.0
+        self._scan()
+        if DEFAULT_ID not in self._rubrics:
+            raise RuntimeError(f"No default rubric: {default_file} not found")
+
+    def get(self, rubric_id=None):
+        """The current version of a rubric. Raises KeyError if there is no such rubric."""
+        rubric_id = rubric_id or DEFAULT_ID
+        rubric = self._rubrics.get(rubric_id)
+        if rubric is None:
+            # Maybe a file was just added.
+            if RUBRIC_ID_RE.match(rubric_id) and time.monotonic() - self._scanned > RUBRIC_CHECK_INTERVAL:
+                self._scan()
+            rubric = self._rubrics.get(rubric_id)
+            if rubric is None:
+                raise KeyError(rubric_id)
+        if time.monotonic() - rubric.checked > RUBRIC_CHECK_INTERVAL:
+            rubric = self._refresh(rubric)
+        return rubric
+
+    def ids(self):
+        if time.monotonic() - self._scanned > RUBRIC_CHECK_INTERVAL:
+            self._scan()
+        return sorted(self._rubrics)
+
+    def _files(self):
+        files = {DEFAULT_ID: self.default_file}
+        try:
+            for entry in os.scandir(self.rubric_dir):
+                rubric_id, ext = os.path.splitext(entry.name)
+                if ext == ".txt" and RUBRIC_ID_RE.match(rubric_id):
+                    files[rubric_id] = entry.path
+        except FileNotFoundError:
+            pass
+        return files
+
+    def _scan(self):
+        files = self._files()
+        with self._lock:
+            self._scanned = time.monotonic()
+            for rubric_id in list(self._rubrics):
+                if rubric_id not in files:
+                    logging.info("Rubric %s removed", rubric_id)
+                    del self._rubrics[rubric_id]
+        for rubric_id, path in files.items():
+            current = self._rubrics.get(rubric_id)
+            if current is None or current.path != path:
+                self._load(rubric_id, path)
+            else:
+                try:
+                    self._refresh(current)
+                except KeyError:
+                    pass
+
+    def _refresh(self, rubric):
+        try:
+            mtime = os.stat(rubric.path).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._rubrics.pop(rubric.id, None)
+            raise KeyError(rubric.id)
+        rubric.checked = time.monotonic()
+        if mtime == rubric.mtime:
+            return rubric
+        return self._load(rubric.id, rubric.path) or rubric
+
+    def _load(self, rubric_id, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, "r", encoding="utf-8") as f:
+                rubric = Rubric(rubric_id, path, f.read(), mtime)
+        except (OSError, ValueError) as e:
+            # Keep serving the last good version while the file is being fixed.
+            logging.error("Could not load rubric %s: %s", rubric_id, e)
+            return None
+        with self._lock:
+            previous = self._rubrics.get(rubric_id)
+            self._rubrics[rubric_id] = rubric
+        if previous is not None:
+            logging.info("Rubric %s reloaded (version %s)", rubric_id, rubric.version)
+        return rubric
+
+
+registry = RubricRegistry()
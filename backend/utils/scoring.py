@@ -0,0 +1,289 @@
+# utils/scoring.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Response schema and strict score parser for AI grading replies.
+#
+# The providers are asked for JSON that matches a schema built from the
+# rubric categories (integer score per category + feedback). The reply is
+# then validated field by field against each category's maximum, so one
+# bad field can be repaired with a small text-only follow-up instead of
+# regrading the whole image.
+
+import json
+import logging
+import os
+import re
+import threading
+
+from utils import metrics
+
+# Set STRUCTURED_OUTPUT=0 to send the plain prompt (no response schema)
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "1").lower() in ("1", "true", "yes")
+# At most this many fields are repaired by follow-up; more means a bad reply
+REPAIR_MAX_FIELDS = int(os.environ.get("REPAIR_MAX_FIELDS", "2"))
+
+# Parse outcomes, per process. Exposed on /stats/parse (and /metrics).
+_stats = {"parsed": 0, "parse_failures": 0, "repaired": 0, "repair_failed": 0}
+_stats_lock = threading.Lock()
+
+
+def count(key):
+    with _stats_lock:
+        _stats[key] += 1
+    metrics.inc("aigrademe_parse_total", {"outcome": key})
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result["parse_failure_rate"] = round(result["parse_failures"] / result["parsed"], 4) if result["parsed"] else 0.0
+    return result
+
+
+# ----------------------------------------------------------------------
+# Schemas
+# ----------------------------------------------------------------------
+def gemini_schema(categories, fields=None):
+    """Gemini responseSchema (OpenAPI subset). fields limits it to some categories."""
+    keys = [key for key, _, _ in categories if fields is None or key in fields]
+    schema = {
+        "type": "OBJECT",
+        "properties": {
+            "scores": {
+                "type": "OBJECT",
+                "properties": {key: {"type": "INTEGER"} for key in keys},
+                "required": keys,
+                "propertyOrdering": keys,
+            },
+        },
+        "required": ["scores"],
+    }
+    if fields is None or "feedback" in fields:
+        schema["properties"]["feedback"] = {"type": "STRING"}
+        schema["required"].append("feedback")
+    return schema
+
+
+def json_schema(categories, fields=None):
+    """Standard JSON Schema (OpenAI-style response_format, used by Grok)."""
+    keys = [(key, top) for key, _, top in categories if fields is None or key in fields]
+    schema = {
+        "type": "object",
+        "properties": {
+            "scores": {
+                "type": "object",
+                "properties": {key: {"type": "integer", "minimum": 0, "maximum": top} for key, top in keys},
+                "required": [key for key, _ in keys],
+                "additionalProperties": False,
+            },
+        },
+        "required": ["scores"],
+        "additionalProperties": False,
+    }
+    if fields is None or "feedback" in fields:
+        schema["properties"]["feedback"] = {"type": "string"}
+        schema["required"].append("feedback")
+    return schema
+
+
+# ----------------------------------------------------------------------
+# Parsing
+# ----------------------------------------------------------------------
+def extract_json(text):
+    """json.loads, falling back to the text between the first { and the last }."""
+    text = (text or "").strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    start, end = text.find("{"), text.rfind("}") + 1
+    if start != -1 and end > start:
+        try:
+            return json.loads(text[start:end])
+        except ValueError:
+            pass
+    return None
+
+
+def parse_score(value, top):
+    """22, "22", "22/25" -> 22 if 0 <= score <= top, else None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str):
+        head, _, tail = value.strip().partition("/")
+        try:
+            value = int(head.strip())
+            if tail and int(tail.strip()) != top:
+                return None
+        except ValueError:
+            return None
+    if isinstance(value, int) and 0 <= value <= top:
+        return value
+    return None
+
+
+def _normalize(key):
+    return str(key).strip().lower().replace(" ", "_").replace("-", "_")
+
+
+def parse_grade(text, categories):
+    """
+    Validate a grading reply against the rubric categories.
+    Returns (grade, bad_fields): grade is {"scores": {key: int}, "feedback": str}
+    with only the valid fields filled in; bad_fields lists what must be repaired.
+    """
+    grade = {"scores": {}, "feedback": None}
+    data = extract_json(text)
+    if not isinstance(data, dict):
+        return grade, [key for key, _, _ in categories] + ["feedback"]
+
+    raw_scores = data.get("scores")
+    raw_scores = {_normalize(k): v for k, v in raw_scores.items()} if isinstance(raw_scores, dict) else {}
+    bad = []
+    for key, _, top in categories:
+        score = parse_score(raw_scores.get(key), top)
+        if score is None:
+            bad.append(key)
+        else:
+            grade["scores"][key] = score
+    feedback = data.get("feedback")
+    if isinstance(feedback, str) and feedback.strip():
+        grade["feedback"] = feedback.strip()
+    else:
+        bad.append("feedback")
+    return grade, bad
+
+
+def is_valid(text, rubric):
+    """True if the reply needs no repair (used to decide what gets cached)."""
+    categories = rubric.categories or guess_categories(text)
+    return bool(categories) and not parse_grade(text, categories)[1]
+
+
+def merge(grade, fix, categories):
+    """Fill the valid fields of a repair reply into grade. Returns fields still bad."""
+    fixed, _ = parse_grade(fix, categories)
+    grade["scores"].update(fixed["scores"])
+    if grade["feedback"] is None and fixed["feedback"]:
+        grade["feedback"] = fixed["feedback"]
+    still_bad = [key for key, _, _ in categories if key not in grade["scores"]]
+    if grade["feedback"] is None:
+        still_bad.append("feedback")
+    return still_bad
+
+
+def guess_categories(text):
+    """
+    For rubrics without "(N%)" lines: take the categories from the reply
+    itself, as long as every score is written "x/max".
+    """
+    data = extract_json(text)
+    scores = data.get("scores") if isinstance(data, dict) else None
+    if not isinstance(scores, dict) or not scores:
+        return []
+    categories = []
+    for label, value in scores.items():
+        _, slash, top = str(value).partition("/")
+        if not slash or not top.strip().isdigit():
+            return []
+        categories.append((_normalize(label), str(label).replace("_", " ").title(), int(top)))
+    return categories
+
+
+def validate(raw, rubric, repair=None):
+    """
+    Turn a raw grading reply into {"scores": [(label, score, max)], "total", "feedback"},
+    or None if it can't be used. If a few fields are broken, repair(prompt, fields)
+    is asked for just those (a text-only call) and should return the reply text or None.
+    """
+    categories = rubric.categories or guess_categories(raw)
+    if not categories:
+        count("parsed")
+        count("parse_failures")
+        logging.warning("Unparseable grading reply: %.200r", raw)
+        return None
+    grade, bad = parse_grade(raw, categories)
+    count("parsed")
+    if bad:
+        count("parse_failures")
+        logging.warning("Grading reply has invalid fields %s: %.200r", bad, raw)
+        if repair is not None and len(bad) <= REPAIR_MAX_FIELDS:
+            fix = repair(repair_prompt(raw, bad, categories), bad)
+            bad = merge(grade, fix, categories) if fix else bad
+            count("repair_failed" if bad else "repaired")
+        if bad:
+            return None
+    scores = [(label, grade["scores"][key], top) for key, label, top in categories]
+    return {"scores": scores, "total": sum(score for _, score, _ in scores), "feedback": grade["feedback"]}
+
+
+def repair_prompt(raw_reply, bad_fields, categories):
+    """A short text-only prompt asking the model to redo just the broken fields."""
+    wanted = ", ".join(
+        f'"{key}" (integer 0-{top})' for key, _, top in categories if key in bad_fields
+    )
+    if "feedback" in bad_fields:
+        wanted += (", " if wanted else "") + '"feedback" (2-4 sentences)'
+    return (
+        "Below is your earlier grading reply for a student's sketch. Some fields were missing or invalid: "
+        f"{wanted}.\nUsing only what your reply says, return JSON with just those fields, scores inside "
+        '"scores". No other text.\n\n--- earlier reply ---\n' + (raw_reply or "")[:4000]
+    )
+
+
+# ----------------------------------------------------------------------
+# Streaming
+# ----------------------------------------------------------------------
+_SCORE_FIELD_RE = re.compile(r'"([A-Za-z][\w -]*)"\s*:\s*("?)(\d+(?:\s*/\s*\d+)?)\2\s*[,}]')
+_FEEDBACK_RE = re.compile(r'"feedback"\s*:\s*"')
+
+
+class StreamParser:
+    """
+    Reads a grading reply as it is generated. feed(chunk) returns the new
+    events: ("score", {...}) once a category's value is complete, and
+    ("feedback", {"text": delta}) as the feedback string grows. The final
+    reply still goes through validate(); these are only for display.
+    """
+
+    def __init__(self, categories):
+        self.categories = {key: (label, top) for key, label, top in categories}
+        self.text = ""
+        self._scored = set()
+        self._feedback = ""
+
+    def feed(self, chunk):
+        self.text += chunk
+        events = []
+        for match in _SCORE_FIELD_RE.finditer(self.text):
+            key = _normalize(match.group(1))
+            if key in self._scored or key not in self.categories:
+                continue
+            label, top = self.categories[key]
+            score = parse_score(match.group(3), top)
+            if score is not None:
+                self._scored.add(key)
+                events.append(("score", {"key": key, "label": label, "score": score, "max": top}))
+        feedback = self._partial_feedback()
+        if len(feedback) > len(self._feedback):
+            events.append(("feedback", {"text": feedback[len(self._feedback):]}))
+            self._feedback = feedback
+        return events
+
+    def _partial_feedback(self):
+        match = _FEEDBACK_RE.search(self.text)
+        if match is None:
+            return self._feedback
+        raw = self.text[match.end():]
+        end = re.search(r'(?<!\\)(?:\\\\)*"', raw)
+        if end is not None:
+            raw = raw[:end.end() - 1]
+        # Drop a trailing escape that hasn't fully arrived yet (\, \u00, ...)
+        for cut in range(0, 7):
+            try:
+                return json.loads('"' + raw[:len(raw) - cut] + '"')
+            except ValueError:
+                continue
+        return self._feedback
@@ -0,0 +1,382 @@
+# utils/submissions.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Durable store of graded submissions, and regrading of the
+# ones graded under an old rubric version (or that failed).
+#
+# Every /submit and /batch upload is kept on disk by its sha256 (the
+# same photo is stored once), with one row per (rubric, student email,
+# photo) holding the parsed grade, or the error, and the rubric version it
+# was graded under. When a rubric file changes (a typo fixed in prompt.txt) or a
+# provider outage failed a run of grades, Regrader grades again just the
+# rows that are out of date, a few at a time, in the background.
+#
+# Regrading is resumable: a row is claimed for REGRADE_LEASE seconds
+# before it is graded and written back with the current version right
+# after, so a restarted (or second) run only picks up what is still out of
+# date. Rows already graded under the current version are never touched.
+# A regrade that fails keeps the earlier grade and is left for the next
+# run rather than retried in a loop.
+#
+# Rows live in SQLite (like the grade cache), shared by every gunicorn
+# worker; images are files under SUBMISSION_DIR/images. Next to them, a
+# count per (rubric version, category, score) and per total is kept up to
+# date in the same transaction as each grade, for /analytics
+# (utils/analytics.py). Only each student's latest graded photo is
+# counted: a resubmission replaces the earlier attempt in the counts
+# (table counted), so students who tried several times don't weigh more.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import cache, metrics, rubrics
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+SUBMISSION_STORE = os.environ.get("SUBMISSION_STORE", "1").lower() in ("1", "true", "yes")   # 0 = keep nothing
+SUBMISSION_DIR = os.environ.get("SUBMISSION_DIR", os.path.join(rubrics.BACKEND_DIR, "data", "submissions"))
+REGRADE_CONCURRENCY = int(os.environ.get("REGRADE_CONCURRENCY", "2"))   # regrades running at once
+REGRADE_LEASE = int(os.environ.get("REGRADE_LEASE", "300"))             # seconds a claimed row is reserved
+REGRADE_TOKEN = os.environ.get("REGRADE_TOKEN", "")                      # instructor token: POST /regrade, /batch, /analytics
+
+GRADED, FAILED = "graded", "failed"
+
+
+class SubmissionStore:
+    """Uploaded images by content hash, plus each submission's latest grade."""
+
+    def __init__(self, directory=SUBMISSION_DIR, lease=REGRADE_LEASE):
+        self.directory = directory
+        self.image_dir = os.path.join(directory, "images")
+        self.lease = lease
+        self._local = threading.local()
+        os.makedirs(self.image_dir, exist_ok=True)
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS submissions ("
+            " id INTEGER PRIMARY KEY, digest TEXT NOT NULL, mime TEXT NOT NULL,"
+            " name TEXT NOT NULL, email TEXT NOT NULL, rubric_id TEXT NOT NULL, rubric_version TEXT NOT NULL,"
+            " status TEXT NOT NULL, total INTEGER, scores TEXT, feedback TEXT, error TEXT, provider TEXT,"
+            " submitted REAL NOT NULL, graded REAL NOT NULL, attempted REAL NOT NULL,"
+            " claimed_until REAL NOT NULL DEFAULT 0,"
+            " UNIQUE (rubric_id, email, digest))"
+        )
+        self._db().execute(
+            "CREATE INDEX IF NOT EXISTS submissions_version ON submissions (rubric_id, rubric_version, status)"
+        )
+        new_counts = not self._db().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'counted'").fetchone()
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS score_counts ("
+            " rubric_id TEXT NOT NULL, rubric_version TEXT NOT NULL, category TEXT NOT NULL, top INTEGER NOT NULL,"
+            " score INTEGER NOT NULL, n INTEGER NOT NULL, PRIMARY KEY (rubric_id, rubric_version, category, score))"
+        )
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS total_counts ("
+            " rubric_id TEXT NOT NULL, rubric_version TEXT NOT NULL, total INTEGER NOT NULL, n INTEGER NOT NULL,"
+            " PRIMARY KEY (rubric_id, rubric_version, total))"
+        )
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS counted ("   # the row each student has in the counts
+            " rubric_id TEXT NOT NULL, student TEXT NOT NULL, row_id INTEGER NOT NULL,"
+            " rubric_version TEXT NOT NULL, scores TEXT NOT NULL, PRIMARY KEY (rubric_id, student))"
+        )
+        if new_counts:
+            self._recount()   # a store from before the counts (or from when every row counted)
+
+    def _db(self):
+        # One connection per thread, as in utils/cache.py
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.directory, "submissions.sqlite3"), timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save(self, image, mime, name, email, rubric, grade, error=None, provider=None):
+        """
+        Keep a graded upload. grade is scoring.validate()'s dict, or None
+        with the error shown to the student. A resubmission of the same
+        photo for the same rubric replaces the earlier row.
+        """
+        digest = cache.image_digest(image)
+        email = email.strip().lower()
+        now = time.time()
+        columns = _grade_columns(grade, error)
+        try:
+            self._write_image(digest, image)
+            with self._transaction() as db:
+                db.execute(
+                    "INSERT INTO submissions (digest, mime, name, email, rubric_id, rubric_version, status, total,"
+                    " scores, feedback, error, provider, submitted, graded, attempted)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (rubric_id, email, digest) DO UPDATE SET name = excluded.name, mime = excluded.mime,"
+                    " rubric_version = excluded.rubric_version, status = excluded.status, total = excluded.total,"
+                    " scores = excluded.scores, feedback = excluded.feedback, error = excluded.error,"
+                    " provider = excluded.provider, submitted = excluded.submitted, graded = excluded.graded,"
+                    " attempted = excluded.attempted, claimed_until = 0",
+                    (digest, mime, name, email, rubric.id, rubric.version) + columns + (provider, now, now, now),
+                )
+                row_id = db.execute("SELECT id FROM submissions WHERE rubric_id = ? AND email = ? AND digest = ?",
+                                    (rubric.id, email, digest)).fetchone()[0]
+                _count_latest(db, rubric.id, email, row_id)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Submission store write failed: %s", e)
+
+    def image(self, digest):
+        with open(self._image_path(digest), "rb") as f:
+            return f.read()
+
+    def claim(self, rubric, before):
+        """
+        The next submission of `rubric` that is out of date (another version,
+        or failed) and wasn't attempted since `before`, reserved for this
+        caller; None when there are no more.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id, digest, mime FROM submissions WHERE rubric_id = ?"
+                " AND (rubric_version != ? OR status = ?) AND attempted < ? AND claimed_until < ?"
+                " ORDER BY id LIMIT 1",
+                (rubric.id, rubric.version, FAILED, before, now),
+            ).fetchone()
+            if row is not None:
+                db.execute("UPDATE submissions SET claimed_until = ? WHERE id = ?", (now + self.lease, row[0]))
+        return row
+
+    def update(self, row_id, rubric, grade, provider=None):
+        """Write a regrade back, under rubric's current version."""
+        now = time.time()
+        columns = _grade_columns(grade, None)
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE submissions SET rubric_version = ?, status = ?, total = ?, scores = ?, feedback = ?, error = ?,"
+                " provider = ?, graded = ?, attempted = ?, claimed_until = 0 WHERE id = ?",
+                (rubric.version,) + columns + (provider, now, now, row_id),
+            )
+            email = db.execute("SELECT email FROM submissions WHERE id = ?", (row_id,)).fetchone()[0]
+            _count_latest(db, rubric.id, email, row_id)
+
+    def missed(self, row_id, error):
+        """A regrade failed: keep what the row had, try again next run."""
+        self._db().execute(
+            "UPDATE submissions SET attempted = ?, claimed_until = 0,"
+            " error = CASE WHEN status = ? THEN ? ELSE error END WHERE id = ?",
+            (time.time(), FAILED, error, row_id),
+        )
+
+    def rubric_ids(self):
+        return [row[0] for row in self._db().execute("SELECT DISTINCT rubric_id FROM submissions ORDER BY rubric_id")]
+
+    def summary(self):
+        """Per rubric id: submissions that are current, on an older version, or failed."""
+        counts = {}
+        rows = self._db().execute(
+            "SELECT rubric_id, rubric_version, status, COUNT(*) FROM submissions GROUP BY 1, 2, 3"
+        ).fetchall()
+        for rubric_id, version, status, n in rows:
+            try:
+                current = rubrics.registry.get(rubric_id).version
+            except KeyError:
+                current = None   # the rubric file was removed; its rows are left alone
+            entry = counts.setdefault(rubric_id, {"version": current, "current": 0, "outdated": 0, "failed": 0})
+            if status == FAILED:
+                entry["failed"] += n
+            elif version == current:
+                entry["current"] += n
+            else:
+                entry["outdated"] += n
+        return counts
+
+    def counts(self, rubric_id, version):
+        """
+        The graded submissions of one rubric version, as counts:
+        ({category: (max points, {score: submissions})}, {total: submissions}).
+        """
+        db = self._db()
+        categories = {}
+        for category, top, score, n in db.execute(
+                "SELECT category, top, score, n FROM score_counts WHERE rubric_id = ? AND rubric_version = ? AND n > 0",
+                (rubric_id, version)):
+            categories.setdefault(category, (top, {}))[1][score] = n
+        totals = dict(db.execute(
+            "SELECT total, n FROM total_counts WHERE rubric_id = ? AND rubric_version = ? AND n > 0",
+            (rubric_id, version)).fetchall())
+        return categories, totals
+
+    def versions(self, rubric_id):
+        """{rubric version: students counted under it} for one rubric id."""
+        return dict(self._db().execute(
+            "SELECT rubric_version, COUNT(*) FROM counted WHERE rubric_id = ? GROUP BY 1", (rubric_id,)).fetchall())
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _recount(self):
+        with self._transaction() as db:
+            db.execute("DELETE FROM score_counts")
+            db.execute("DELETE FROM total_counts")
+            db.execute("DELETE FROM counted")
+            rows = db.execute("SELECT rubric_id, email, MAX(id) FROM submissions"
+                              " GROUP BY rubric_id, CASE WHEN email = '' THEN id ELSE email END").fetchall()
+            for rubric_id, email, row_id in rows:
+                _count_latest(db, rubric_id, email, row_id)
+
+    def _image_path(self, digest):
+        return os.path.join(self.image_dir, digest[:2], digest)
+
+    def _write_image(self, digest, image):
+        path = self._image_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(image)
+        os.replace(tmp, path)   # readers never see half a file
+
+
+def _grade_columns(grade, error):
+    # (status, total, scores, feedback, error) for a row
+    if grade is None:
+        return FAILED, None, None, None, error
+    return GRADED, grade["total"], json.dumps(grade["scores"]), grade["feedback"], None
+
+
+def _count_latest(db, rubric_id, email, row_id):
+    # Put the student's latest graded row (by submission time) in the counts,
+    # in place of the one counted before. Without an email (a /batch item
+    # with no roster entry) each row is its own student.
+    student = email or f"#{row_id}"
+    if email:
+        latest = db.execute(
+            "SELECT id, rubric_version, scores FROM submissions WHERE rubric_id = ? AND email = ? AND status = ?"
+            " ORDER BY submitted DESC, id DESC LIMIT 1", (rubric_id, email, GRADED)).fetchone()
+    else:
+        latest = db.execute("SELECT id, rubric_version, scores FROM submissions WHERE id = ? AND status = ?",
+                            (row_id, GRADED)).fetchone()
+    counted = db.execute("SELECT rubric_version, scores FROM counted WHERE rubric_id = ? AND student = ?",
+                         (rubric_id, student)).fetchone()
+    if counted is not None:
+        _tally(db, rubric_id, (counted[0], GRADED, counted[1]), -1)
+    if latest is None:
+        db.execute("DELETE FROM counted WHERE rubric_id = ? AND student = ?", (rubric_id, student))
+        return
+    db.execute("INSERT OR REPLACE INTO counted (rubric_id, student, row_id, rubric_version, scores)"
+               " VALUES (?, ?, ?, ?, ?)", (rubric_id, student) + tuple(latest))
+    _tally(db, rubric_id, (latest[1], GRADED, latest[2]), 1)
+
+
+def _tally(db, rubric_id, row, sign):
+    # Add (sign 1) or take back (-1) one row's grade in the score counts.
+    # row: (rubric version, status, scores JSON)
+    if row is None or row[1] != GRADED:
+        return
+    version, scores = row[0], json.loads(row[2])
+    for label, score, top in scores:
+        db.execute(
+            "INSERT INTO score_counts (rubric_id, rubric_version, category, top, score, n) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (rubric_id, rubric_version, category, score) DO UPDATE SET n = n + excluded.n",
+            (rubric_id, version, label, top, score, sign),
+        )
+    db.execute(
+        "INSERT INTO total_counts (rubric_id, rubric_version, total, n) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT (rubric_id, rubric_version, total) DO UPDATE SET n = n + excluded.n",
+        (rubric_id, version, sum(score for _, score, _ in scores), sign),
+    )
+
+
+class Regrader:
+    """
+    Regrades a store's out-of-date submissions on background threads.
+    grade(image, mime, rubric) returns (grade or None, error, provider).
+    """
+
+    def __init__(self, store, grade, concurrency=REGRADE_CONCURRENCY):
+        self.store = store
+        self.grade = grade
+        self.concurrency = concurrency
+        self._run = None
+        self._running = 0   # worker threads still going
+        self._lock = threading.Lock()
+
+    def start(self, rubric_ids=None, concurrency=None):
+        """Start a run over rubric_ids (default: every rubric in the store) unless one is running."""
+        with self._lock:
+            if self._run is not None and self._run["status"] == "running":
+                return self.status()
+            ids = rubric_ids or self.store.rubric_ids()
+            workers = max(1, min(concurrency or self.concurrency, 16))
+            self._run = {"status": "running", "rubrics": ids, "concurrency": workers, "started": time.time(),
+                         "regraded": 0, "failed": 0, "finished": None}
+            threads = [threading.Thread(target=self._work, args=(self._run,), daemon=True, name=f"regrade-{i}")
+                       for i in range(workers)]
+            self._running = len(threads)
+        logging.info("Regrade started: rubrics %s, %d at a time", ", ".join(ids) or "-", workers)
+        for thread in threads:
+            thread.start()
+        return self.status()
+
+    def run(self, rubric_ids=None, concurrency=None):
+        """start() and wait for the run to finish (for tools/regrade.py). Returns its status."""
+        self.start(rubric_ids, concurrency)
+        while self.status()["status"] == "running":
+            time.sleep(0.5)
+        return self.status()
+
+    def status(self):
+        with self._lock:
+            return dict(self._run) if self._run is not None else {"status": "idle"}
+
+    def _work(self, run):
+        try:
+            for rubric_id in run["rubrics"]:
+                try:
+                    rubric = rubrics.registry.get(rubric_id)
+                except KeyError:
+                    continue
+                while True:
+                    row = self.store.claim(rubric, run["started"])
+                    if row is None:
+                        break
+                    self._regrade(run, rubric, *row)
+        except Exception:
+            logging.exception("Regrade worker stopped")
+        finally:
+            with self._lock:
+                self._running -= 1
+                if not self._running:
+                    run["status"], run["finished"] = "done", time.time()
+                    logging.info("Regrade finished: %d regraded, %d failed", run["regraded"], run["failed"])
+
+    def _regrade(self, run, rubric, row_id, digest, mime):
+        try:
+            image = self.store.image(digest)
+            grade, error, provider = self.grade(image, mime, rubric)
+        except Exception as e:
+            logging.exception("Regrading submission %s failed", row_id)
+            grade, error, provider = None, f"{type(e).__name__}: {e}", None
+        if grade is not None:
+            self.store.update(row_id, rubric, grade, provider)
+        else:
+            self.store.missed(row_id, error)
+        outcome = "regraded" if grade is not None else "failed"
+        with self._lock:
+            run[outcome] += 1
+        metrics.inc("aigrademe_regrades_total", {"outcome": outcome})
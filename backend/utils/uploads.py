@@ -0,0 +1,138 @@
+# utils/uploads.py
+# Author: Ron Goodson
+# Date: 2025-11-05
+# Description: Checks an upload before anything is sent to the AI.
+#
+# The file extension says little: phones send HEIC, browsers WebP, and
+# students rename files. A bad upload used to fail only after a paid
+# provider round trip. Here the format comes from the file's first bytes,
+# the size is capped while the upload is still arriving (see
+# payload.InMemoryRequest.upload_limit), and only the image header is
+# decoded to check the dimensions. Formats the providers don't take are
+# converted to JPEG when Pillow can read them; anything else is rejected
+# with a message the student can act on.
+#
+# Every rejection counts in aigrademe_upload_rejections_total: each one is
+# a grading call that was not wasted.
+
+import io
+import logging
+import os
+
+from utils import logs, metrics
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it only the magic bytes are checked
+    Image = None
+
+try:
+    import pillow_heif  # optional: lets Pillow read iPhone HEIC photos
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+# ----------------------------------------------------------------------
+# Settings (all optional, read from the environment)
+# ----------------------------------------------------------------------
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(15 * 1024 * 1024)))   # per photo
+UPLOAD_MIN_SIDE = int(os.environ.get("UPLOAD_MIN_SIDE", "200"))                     # px, shorter side
+UPLOAD_MAX_PIXELS = int(os.environ.get("UPLOAD_MAX_PIXELS", str(60_000_000)))        # width * height
+FORM_OVERHEAD = 64 * 1024   # the other form fields and multipart headers
+
+# Sent to the providers as is (both Gemini and Grok take these)
+PROVIDER_FORMATS = {"image/jpeg", "image/png", "image/webp"}
+
+_FTYP_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"hevc": "image/heic", b"hevx": "image/heic",
+    b"mif1": "image/heif", b"msf1": "image/heif", b"avif": "image/avif", b"avis": "image/avif",
+}
+
+MESSAGES = {
+    "empty": "The uploaded file is empty.",
+    "too_large": f"The photo is too large (max {UPLOAD_MAX_BYTES // (1024 * 1024)} MB). Please upload a smaller one.",
+    "not_image": "This file is not a photo. Please upload a JPG or PNG picture of your sketch.",
+    "unsupported": "This photo format can't be read. Please upload a JPG or PNG "
+                   "(on iPhone: Settings > Camera > Formats > Most Compatible).",
+    "unreadable": "The photo seems to be damaged. Please take it again and upload a JPG or PNG.",
+    "too_small": "The photo is too small to grade. Please upload a larger, clearer photo.",
+    "too_many_pixels": "The photo's resolution is too high. Please upload a smaller one.",
+}
+
+
+class Rejected(Exception):
+    """An upload that must not go to the AI. .reason is a MESSAGES key."""
+
+    def __init__(self, reason):
+        super().__init__(MESSAGES[reason])
+        self.reason = reason
+        self.status = 413 if reason == "too_large" else 400
+
+
+def sniff(head: bytes):
+    """MIME type from a file's first bytes (16 are enough), or None."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        return _FTYP_BRANDS.get(head[8:12])
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:2] == b"BM":
+        return "image/bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    return None
+
+
+def check(image):
+    """
+    (image, mime) ready for the providers, or raises Rejected.
+    image is the raw upload; it comes back converted to JPEG if needed.
+    """
+    if len(image) == 0:
+        raise reject("empty")
+    if len(image) > UPLOAD_MAX_BYTES:
+        raise reject("too_large")
+    mime = sniff(bytes(image[:16]))
+    if mime is None:
+        raise reject("not_image", head=bytes(image[:8]).hex())
+    if Image is None:
+        if mime not in PROVIDER_FORMATS:
+            raise reject("unsupported", mime=mime)
+        return image, mime
+
+    try:
+        img = Image.open(io.BytesIO(image))   # reads the header only
+        width, height = img.size
+    except Image.DecompressionBombError:
+        raise reject("too_many_pixels", mime=mime)
+    except Exception as e:
+        # Pillow has no HEIC/AVIF reader without a plugin
+        raise reject("unreadable" if mime in PROVIDER_FORMATS else "unsupported",
+                      mime=mime, error=f"{type(e).__name__}: {e}")
+    if min(width, height) < UPLOAD_MIN_SIDE:
+        raise reject("too_small", mime=mime, width=width, height=height)
+    if width * height > UPLOAD_MAX_PIXELS:
+        raise reject("too_many_pixels", mime=mime, width=width, height=height)
+    if mime in PROVIDER_FORMATS:
+        return image, mime
+
+    try:
+        out = io.BytesIO()
+        img.convert("RGB").save(out, format="JPEG", quality=90)
+    except Exception as e:
+        raise reject("unreadable", mime=mime, error=f"{type(e).__name__}: {e}")
+    metrics.inc("aigrademe_upload_conversions_total", {"format": mime})
+    logging.info("Converted %s upload to JPEG (%d -> %d bytes)", mime, len(image), out.tell())
+    return out.getvalue(), "image/jpeg"
+
+
+def reject(reason, **fields):
+    """Count and log a rejection; returns the Rejected to raise."""
+    metrics.inc("aigrademe_upload_rejections_total", {"reason": reason})
+    logs.event("upload_rejected", logging.INFO, reason=reason, **fields)
+    return Rejected(reason)